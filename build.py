@@ -3,32 +3,244 @@
 # Try not to use any packages that aren't included with Python, please.
 
 import argparse
+import collections
+import concurrent.futures
 import errno
+import fcntl
+import glob
+import hashlib
+import json
 import os
+import platform
+import re
+import select
+import shutil
+import signal
+import sqlite3
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 
 DEFAULT_KICAD_GIT_URL = "https://gitlab.com/kicad/code/kicad.git"
 
+# Universal builds run one build per architecture, each using its own Homebrew.
+ARCH_BREW_PREFIXES = {"arm64": "/opt/homebrew", "x86_64": "/usr/local"}
+
+# Targets that don't depend on the architecture, so a universal build only needs to download and build them once.
+SHARED_ASSET_TARGETS = ["docs", "symbols", "footprints", "packages3d", "templates"]
+# The package targets a universal build can run on its merged KiCad.app, after the per-architecture builds
+UNIVERSAL_PACKAGE_TARGETS = ["package-kicad-unified", "package-kicad-delta"]
+
+# Everything build.py needs to know about the host, as shell commands.  These are run at the same time, once per
+# process, and cached in the build directory.  See get_host_probes.
+HOST_PROBES = {
+    "cores": "sysctl -n hw.ncpu",
+    "macos_version": "sw_vers -productVersion | cut -d. -f1-2",
+    "host_architecture": "sysctl -n machdep.cpu.brand_string",
+    "env_architecture": "arch",
+    "rosetta": "pgrep -q oahd",
+    "brew_config": "brew config",
+    "which_brew": "which brew",
+    "brew_prefix": "brew --prefix",
+    "gettext_prefix": "brew --prefix gettext",
+    "bison_prefix": "brew --prefix bison",
+    "memory": "sysctl -n hw.memsize",
+    "make_version": "make --version | head -n 1",
+}
+
+HOST_PROBE_CACHE_FILENAME = ".host-probes.json"
+# Probes that are cheap, and whose answer can change without anything in the cache key changing, like Rosetta being
+# installed after build.py said it was needed.  These are never cached.
+UNCACHED_HOST_PROBES = {"rosetta"}
+
+CONFIGURATION_FINGERPRINT_FILENAME = ".cmake-fingerprint"
+
+# Matches make 3.81's "make[2]: *** [target] Error 2" and make 4's "make[2]: *** [Makefile:12: target] Error 2".
+MAKE_ERROR_RE = re.compile(r"^g?make(?:\[\d+\])?: \*\*\* \[(?:[^\]]*?:\d+: )?(?P<target>[^\]]+)\] Error \d+")
+# ExternalProject stamp files, like kicad/src/kicad-stamp/kicad-build or wxpython-prefix/src/wxpython-stamp/wxpython-install
+STAMP_RE = re.compile(r"^(?P<prefix>.+)/src/(?P<project>[^/]+)-stamp/(?P=project)-(?P<step>[^/]+)$")
+# Compiler and linker diagnostics, like "foo.cpp:12:5: error:" or "clang: error:", CMake errors, and make's "*** [".
+# Flags like -Werror, and files like richio_error.cpp, are in almost every command line, so they don't count.
+FAILURE_LINE_RE = re.compile(r":\d+:(?:\d+:)? (?:fatal )?error:|^\s*(?:[\w.+-]+: )?(?:fatal )?error:|^CMake Error|\*\*\* \[",
+                             re.IGNORECASE)
+MAKE_OUTPUT_TAIL_LINES = 2000
+FAILURE_EXCERPT_CONTEXT_LINES = 20
+FAILURE_EXCERPT_MAX_LINES = 80
+
+# The ExternalProjects under kicad-build-deps, and the stamp directories that tell make they are done.
+DEPS_CACHE_STAMP_DIRS = {
+    "python": "python/src/python-stamp",
+    "wxwidgets": "wxwidgets/src/wxwidgets-stamp",
+    "wxpython": "wxpython-prefix/src/wxpython-stamp",
+    "ngspice": "ngspice/src/ngspice-stamp",
+}
+# What those projects produce that the rest of the build uses, relative to the build directory.
+DEPS_CACHE_OUTPUTS = ["python-dest", "wxwidgets-dest", "ngspice-dest", "python/src/python-build/Python.framework"]
+# The files that decide what those projects produce, relative to the kicad-mac-builder directory.
+DEPS_CACHE_INPUT_FILES = ["python.cmake", "wx.cmake", "ngspice.cmake", "python-requirements.txt"]
+DEFAULT_DEPS_CACHE_DIR = os.path.join(os.path.expanduser("~"), "Library", "Caches", "kicad-mac-builder", "deps")
+# The CMake variables of the git repositories those projects are cloned from
+DEPS_CACHE_GIT_URLS = ["RELOCATABLE_PYTHON_URL", "WXWIDGETS_URL", "WXPYTHON_URL", "NGSPICE_URL"]
+
+# The default URL of each git repository an ExternalProject clones, like "set( SYMBOLS_URL https://... )", in
+# CMakeLists.txt.  KICAD_URL comes from --kicad-git-url instead.
+CMAKE_GIT_URL_RE = re.compile(r"^\s*set\( (\w+_URL) (\S+) \)$", re.MULTILINE)
+DEFAULT_GIT_MIRROR_DIR = os.path.join(os.path.expanduser("~"), "Library", "Caches", "kicad-mac-builder", "git")
+
+# A make rule for an ExternalProject step, and the message make prints when it starts, in CMakeFiles/*.dir/build.make
+BUILD_MAKE_RULE_RE = re.compile(r"^(?P<target>[^\s:#][^\s:]*):")
+BUILD_MAKE_ECHO_RE = re.compile(r'^\t@.*cmake_echo_color .*"(?P<message>[^"]+)"$')
+MAKE_PROGRESS_RE = re.compile(r"^\[\s*\d+%\]\s*")
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*m")
+BUILT_TARGET_RE = re.compile(r"^Built target (?P<target>\S+)$")
+TRACE_SUMMARY_STEPS = 10
+
+PERF_HISTORY_FILENAME = "perf-history.sqlite3"
+# The host probes worth keeping with each run, since they explain a lot of differences in build time
+PERF_HISTORY_HOST_PROBES = ["cores", "memory", "macos_version", "host_architecture", "env_architecture", "brew_prefix"]
+# Steps shorter than this are too noisy to call regressions
+PERF_REPORT_MIN_SECONDS = 30
+DISK_USAGE_SAMPLE_INTERVAL = 5
+
+# What --disk-budget removes, by the ExternalProject that makes it: its source and build trees, relative to the build
+# directory, and the steps that use them, as (project, step).  A step of None means the whole target.  The install
+# directories the rest of the build uses, like wxwidgets-dest and kicad-dest, are never removed.
+DISK_BUDGET_PRUNABLE = {
+    "symbols": (["symbols/src/symbols", "symbols/src/symbols-build"], [("kicad", "install-symbols-into-app")]),
+    "footprints": (["footprints/src/footprints", "footprints/src/footprints-build"],
+                   [("kicad", "install-footprints-into-app")]),
+    "packages3d": (["packages3d/src/packages3d", "packages3d/src/packages3d-build"],
+                   [("kicad", "install-packages3d-into-app"), ("package-extras", None)]),
+    "templates": (["templates/src/templates", "templates/src/templates-build"],
+                  [("kicad", "install-templates-into-app")]),
+    # wxPython builds against wxWidgets' source tree, and installs into python-dest and wxwidgets-dest
+    "wxwidgets": (["wxwidgets/src/wxwidgets"], [("wxpython", "install")]),
+    "wxpython": (["wxpython-prefix/src/wxpython"], [("wxpython", "install")]),
+    "ngspice": (["ngspice/src/ngspice"], [("ngspice", "install")]),
+    # package.sh gets the revision for the DMG's name from KiCad's source
+    "kicad": (["kicad/src/kicad", "kicad/src/kicad-build"],
+              [("kicad", None), ("package-kicad-nightly", None), ("package-kicad-unified", None)]),
+}
+DISK_BUDGET_STATE_FILENAME = ".disk-budget.json"
+# A target and one of the targets it depends on, or one of the targets make builds by default, in CMakeFiles/Makefile2
+MAKEFILE2_DEPENDENCY_RE = re.compile(r"^(?:CMakeFiles/(?P<target>[^/\s]+)\.dir/all|all): "
+                                     r"CMakeFiles/(?P<dependency>[^/\s]+)\.dir/all\s*$", re.MULTILINE)
+
+# Rough peak memory of one compile job, in gigabytes, for each ExternalProject.  The big C++ translation units in KiCad
+# and the sip-generated wxPython sources are the ones that push a build into swap.
+MEMORY_PER_JOB_GB = {"kicad": 1.5, "wxpython": 2.0, "wxwidgets": 0.75, "python": 0.5, "ngspice": 0.5}
+# Memory left for macOS and everything else when --adaptive-jobs works out the budget itself
+RESERVED_MEMORY_GB = 2.0
+VM_STAT_RE = re.compile(r"^Pages (?P<kind>free|inactive|speculative):\s+(?P<pages>\d+)\.$", re.MULTILINE)
+VM_STAT_PAGE_SIZE_RE = re.compile(r"page size of (?P<page_size>\d+) bytes")
+
+_host_probes = None
+
+
+def get_host_probe_cache_key():
+    # The cached probes are only reused if none of this has changed.  None of it needs a subprocess.
+    which_brew = shutil.which("brew")
+    brew_mtime = None
+    if which_brew:
+        try:
+            brew_mtime = os.stat(which_brew).st_mtime_ns
+        except OSError:
+            pass
+    return {"PATH": os.environ.get("PATH"),
+            "brew": which_brew,
+            "brew_mtime": brew_mtime,
+            "machine": platform.machine(),
+            "mac_ver": platform.mac_ver()[0],
+            "probes": HOST_PROBES}
+
+
+def run_host_probe(command):
+    completed = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return {"returncode": completed.returncode, "output": completed.stdout.decode('utf-8').strip()}
+
+
+def get_host_probes(cache_dir=None):
+    # Runs all of HOST_PROBES concurrently the first time it is called, and remembers the results for the rest of the
+    # process.  If cache_dir is given, results are also read from and written to a small cache file there.
+    global _host_probes
+    if _host_probes is not None:
+        return _host_probes
+
+    cache_path = os.path.join(cache_dir, HOST_PROBE_CACHE_FILENAME) if cache_dir else None
+    cache_key = get_host_probe_cache_key()
+    cached_probes = None
+    if cache_path:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached.get("key") == cache_key:
+                cached_probes = {name: probe for name, probe in cached["probes"].items()
+                                 if name not in UNCACHED_HOST_PROBES}
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    to_run = {name: command for name, command in HOST_PROBES.items()
+              if cached_probes is None or name not in cached_probes}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(to_run)) as executor:
+        _host_probes = dict(zip(to_run, executor.map(run_host_probe, to_run.values())))
+    if cached_probes is not None:
+        _host_probes.update(cached_probes)
+        return _host_probes
+
+    # Don't cache failures, so that installing a missing dependency is noticed the next time.
+    cacheable = {name: probe for name, probe in _host_probes.items() if name not in UNCACHED_HOST_PROBES}
+    if cache_path and all(probe["returncode"] == 0 for probe in cacheable.values()):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, "w") as f:
+                json.dump({"key": cache_key, "probes": cacheable}, f, indent=1)
+        except OSError:
+            pass
+
+    return _host_probes
+
+
+def get_host_probe(name):
+    probe = get_host_probes()[name]
+    if probe["returncode"] != 0:
+        raise subprocess.CalledProcessError(probe["returncode"], HOST_PROBES[name], output=probe["output"])
+    return probe["output"]
+
+
 def get_number_of_cores():
-    return int(subprocess.check_output("sysctl -n hw.ncpu", shell=True).strip())
+    return int(get_host_probe("cores"))
+
+
+def get_memory_size():
+    return int(get_host_probe("memory"))
+
+
+def get_make_version():
+    # Like (3, 81) for the make that comes with macOS
+    match = re.search(r"(\d+)\.(\d+)", get_host_probe("make_version"))
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
 
 def get_local_macos_version():
-    return subprocess.check_output("sw_vers -productVersion | cut -d. -f1-2", shell=True).decode('utf-8').strip()
+    return get_host_probe("macos_version")
 
 def get_host_architecture():
-    return subprocess.check_output(["sysctl", "-n", "machdep.cpu.brand_string"]).decode('utf-8').strip()
+    return get_host_probe("host_architecture")
 
 def host_is_apple_silicon():
     # We have to be careful here.  Most ways of checking, like uname or arch or things will be overriden if we're in a Rosetta terminal, for instance
     return 'Apple' in get_host_architecture()
 
 def get_env_architecture():
-    return subprocess.check_output("arch").decode('utf-8').strip()
+    return get_host_probe("env_architecture")
+
+def rosetta_is_running():
+    return get_host_probes()["rosetta"]["returncode"] == 0
 
 
 def get_brew_config():
-    return subprocess.check_output("brew config", shell=True).decode('utf-8').strip()
+    return get_host_probe("brew_config")
 
 
 def get_brew_rosetta():
@@ -70,11 +282,35 @@ def parse_args(args):
     parser.add_argument("--dmg-dir",
                         help="Path that will store the output dmgs for packaging targets.  Defaults to \"dmg/\" in the build directory.",
                         required=False)
+    parser.add_argument("--delta-base-dir",
+                        help="Path that keeps the last build packaged by package-kicad-delta, to make the next delta against.  Defaults to \"delta-base/\" in the build directory.",
+                        required=False)
     parser.add_argument("--jobs",
                         help="Tell make to build using this number of parallel jobs. Defaults to the number of cores.",
                         type=int,
                         required=False,
-                        default=get_number_of_cores()
+                        )
+    parser.add_argument("--adaptive-jobs",
+                        help="Lower the number of jobs to what fits in memory, based on an estimate of how much memory "
+                             "a job uses in each project still to be built, and keep make from starting new jobs "
+                             "while memory is low or the machine is overloaded. --jobs becomes the maximum.",
+                        action="store_true",
+                        )
+    parser.add_argument("--memory-budget",
+                        help="Memory, in gigabytes, that --adaptive-jobs may use. Defaults to the memory available when "
+                             "the build starts, less {} GB.".format(RESERVED_MEMORY_GB),
+                        type=float,
+                        )
+    parser.add_argument("--min-free-memory",
+                        help="With --adaptive-jobs, hold back jobs while less than this many gigabytes of memory are "
+                             "free. Use 0 to disable. Defaults to 1.",
+                        type=float,
+                        default=1,
+                        )
+    parser.add_argument("--load-average",
+                        help="Tell make not to start new jobs while the load average is above this. Defaults to the "
+                             "number of cores with --adaptive-jobs, and no limit otherwise.",
+                        type=float,
                         )
     parser.add_argument("--release",
                         help="Build for a release.",
@@ -120,16 +356,102 @@ def parse_args(args):
     parser.add_argument("--macos-min-version",
                         help="Minimum macOS version to build for. You must have the appropriate XCode SDK installed. "
                              " Defaults to the macOS version of this computer.",
-                        default=get_local_macos_version(),
                         )
     parser.add_argument("--arch",
-                        choices=['x86_64', 'arm64'],
-                        help="Target architecture. Required on Apple Silicon. Universal (combined) builds are not yet supported. Not all combinations of options are valid (targeting arm64 and macOS 10.15, for instance).",
-                        required=host_is_apple_silicon())
+                        choices=['x86_64', 'arm64', 'universal'],
+                        help="Target architecture. Required on Apple Silicon. universal builds arm64 and x86_64 at the same time, "
+                             "in subdirectories of the build directory, and combines them into an ad-hoc signed Universal "
+                             "KiCad.app in universal/dest. Not all combinations of options are valid (targeting arm64 and macOS 10.15, for instance).",
+                        )
+    parser.add_argument("--shared-assets-dir",
+                        help="Build directory that already contains the symbols, footprints, 3D models, templates and docs. "
+                             "They will be used from there instead of being downloaded again. Used by --arch universal.",
+                        )
+    parser.add_argument("--deps-cache-dir",
+                        help="Directory to cache builds of python, wxwidgets, wxpython and ngspice in, so that new build "
+                             "directories can restore them instead of building them. Defaults to {}.".format(DEFAULT_DEPS_CACHE_DIR),
+                        default=DEFAULT_DEPS_CACHE_DIR,
+                        )
+    parser.add_argument("--deps-cache-size",
+                        help="Maximum size of the dependency cache, in gigabytes. The least recently used builds are "
+                             "removed first. Defaults to 20.",
+                        type=float,
+                        default=20,
+                        )
+    parser.add_argument("--no-deps-cache",
+                        help="Don't use the dependency cache.",
+                        action="store_const",
+                        const=None,
+                        dest="deps_cache_dir",
+                        )
+    parser.add_argument("--git-mirror-dir",
+                        help="Directory to keep bare mirrors of the git repositories in. They're updated at the start "
+                             "of each build, and projects are cloned from them instead of from GitLab or GitHub. "
+                             "Defaults to {}.".format(DEFAULT_GIT_MIRROR_DIR),
+                        default=DEFAULT_GIT_MIRROR_DIR,
+                        )
+    parser.add_argument("--no-git-mirrors",
+                        help="Clone everything from its upstream repository instead of a mirror.",
+                        action="store_const",
+                        const=None,
+                        dest="git_mirror_dir",
+                        )
+    parser.add_argument("--skip-git-mirror-update",
+                        help="Use the git mirrors as they are, without fetching. Used by --arch universal, which updates "
+                             "them once for all of its builds.",
+                        action="store_true",
+                        )
+    parser.add_argument("--git-url",
+                        help="Clone a repository from somewhere else, like SYMBOLS_URL=/srv/git/kicad-symbols.git. The "
+                             "names are the *_URL variables in CMakeLists.txt. May be repeated.",
+                        action="append",
+                        dest="git_urls",
+                        default=[],
+                        )
+    parser.add_argument("--disk-budget",
+                        help="Remove the source and build trees of the libraries, wxWidgets, wxPython, ngspice and "
+                             "KiCad as soon as no later step of the build needs them, and report how much the disk "
+                             "usage peaked at. Meant for one-off builds, like in CI: the next build in the same "
+                             "directory clones and builds the removed projects again if anything in them needs to run.",
+                        action="store_true",
+                        )
+    parser.add_argument("--trace",
+                        help="Write a Chrome trace event JSON file to this path, showing when each step of each project "
+                             "ran. Open it in https://ui.perfetto.dev or chrome://tracing.",
+                        )
+    parser.add_argument("--perf-history",
+                        help="SQLite database to record each build's step durations, revisions, disk use and DMG "
+                             "sizes in. Defaults to {} in the build directory.".format(PERF_HISTORY_FILENAME),
+                        )
+    parser.add_argument("--no-perf-history",
+                        help="Don't record this build in the performance history.",
+                        action="store_true",
+                        )
+    parser.add_argument("--perf-report",
+                        help="Instead of building, compare the last successful build in the performance history "
+                             "against the ones before it, and exit with an error if any step got slower or any "
+                             "output got bigger.",
+                        action="store_true",
+                        )
+    parser.add_argument("--perf-report-runs",
+                        help="Number of recent successful builds --perf-report looks at. Defaults to 5.",
+                        type=int,
+                        default=5,
+                        )
+    parser.add_argument("--perf-threshold",
+                        help="Percentage a step's duration or an output's size must grow by for --perf-report to flag "
+                             "it. Defaults to 10.",
+                        type=float,
+                        default=10,
+                        )
+    parser.add_argument("--reconfigure",
+                        help="Run cmake even if the configuration hasn't changed since the last build in this build directory.",
+                        action="store_true"
+                        )
     parser.add_argument("--no-retry-failed-build",
                         help="By default, if make fails and the number of jobs is greater than one, build.py will "
-                             "rebuild using a single job to create a clearer error message. This flag disables that "
-                             "behavior.",
+                             "rebuild the step that failed, like kicad's build step, using a single job to create a "
+                             "clearer error message. This flag disables that behavior.",
                         action='store_false',
                         dest="retry_failed_build"
                         )
@@ -146,10 +468,15 @@ def parse_args(args):
     parser.add_argument("--extra-kicad-cmake-args",
                         help="Use something like '-DFOO=\"bar\"' to add FOO=bar to KiCad's CMake args.",
                         required=False)
+    parser.add_argument("--prune-python",
+                        action="append",
+                        dest="python_prune_patterns",
+                        help="Glob, relative to Python.framework/Versions/<version>, of something else to leave out of "
+                             "the Python in KiCad.app, like lib/python*/ensurepip. May be repeated.")
 
     parser.add_argument("--redistributable",
                         action="store_true",
-                        help="Fix KiCad bundle to work on other machines. This requires wrangle-bundle from dyldstyle, and is implied for releases, packaged builds, and notarized builds.")
+                        help="Fix KiCad bundle to work on other machines. This is implied for releases, packaged builds, and notarized builds.")
 
     signing_group = parser.add_argument_group('signing and notarization', description="By default, kicad-mac-builder uses ad-hoc signing and doesn't submit targets for notarization.")
     signing_group.add_argument("--signing-identity",
@@ -180,6 +507,36 @@ def parse_args(args):
 
     parsed_args = parser.parse_args(args)
 
+    # We chdir into the build directory later, so relative paths would stop working
+    parsed_args.build_dir = os.path.abspath(parsed_args.build_dir)
+    if parsed_args.trace:
+        parsed_args.trace = os.path.abspath(parsed_args.trace)
+    if parsed_args.no_perf_history:
+        parsed_args.perf_history = None
+    elif parsed_args.perf_history:
+        parsed_args.perf_history = os.path.abspath(parsed_args.perf_history)
+    else:
+        parsed_args.perf_history = os.path.join(parsed_args.build_dir, PERF_HISTORY_FILENAME)
+
+    if parsed_args.perf_report:
+        # Reporting doesn't need anything from the host
+        return parsed_args
+
+    # Probing the host is slow, so it waits until we know we aren't just printing --help.
+    get_host_probes(parsed_args.build_dir)
+
+    if parsed_args.arch is None and host_is_apple_silicon():
+        parser.error("--arch is required on Apple Silicon.")
+
+    if parsed_args.jobs is None:
+        parsed_args.jobs = get_number_of_cores()
+
+    if parsed_args.adaptive_jobs and parsed_args.load_average is None:
+        parsed_args.load_average = get_number_of_cores()
+
+    if parsed_args.macos_min_version is None:
+        parsed_args.macos_min_version = get_local_macos_version()
+
     if parsed_args.target is None:
         parsed_args.target = []
 
@@ -198,26 +555,48 @@ def parse_args(args):
     if (parsed_args.kicad_ref or parsed_args.kicad_git_url) and parsed_args.kicad_source_dir:
         parser.error("KiCad source directory builds cannot also specify KiCad git details.")
 
+    if any("=" not in git_url for git_url in parsed_args.git_urls):
+        parser.error("--git-url must look like NAME=URL, like SYMBOLS_URL=/srv/git/kicad-symbols.git.")
+
+    if parsed_args.git_mirror_dir:
+        parsed_args.git_mirror_dir = os.path.realpath(parsed_args.git_mirror_dir)
+
     if parsed_args.kicad_source_dir:
         parsed_args.kicad_source_dir = os.path.realpath(parsed_args.kicad_source_dir)
     elif not parsed_args.kicad_git_url:
         parsed_args.kicad_git_url = DEFAULT_KICAD_GIT_URL
 
     macos_major_version = int(parsed_args.macos_min_version.split(".")[0])
-    if parsed_args.arch == "arm64" and macos_major_version < 11:
-        parser.error("arm64 builds must target macOS 11 or greater.")
+    if parsed_args.arch in ("arm64", "universal") and macos_major_version < 11:
+        parser.error("arm64 and universal builds must target macOS 11 or greater.")
     # TODO prevent more footgun situations with min version and arch and things, maybe?
 
-    if parsed_args.arch == "arm64" and not host_is_apple_silicon():
+    if parsed_args.arch in ("arm64", "universal") and not host_is_apple_silicon():
         parser.error("Cannot target arm64 on x86_64 host.")
 
-    if parsed_args.arch == "x86_64" and host_is_apple_silicon():
+    if parsed_args.arch == "universal" and parsed_args.shared_assets_dir:
+        parser.error("Universal builds manage their own shared assets directory.")
+
+    if parsed_args.arch == "universal":
+        if parsed_args.apple_developer_username or parsed_args.apple_developer_password_keychain_name or \
+                parsed_args.app_notarization_id or parsed_args.dmg_notarization_id or parsed_args.asc_provider:
+            parser.error("The Universal KiCad.app is ad-hoc signed, so universal builds can't be notarized.")
+        package_targets = [target for target in parsed_args.target or [] if target.startswith("package")]
+        if set(package_targets) - set(UNIVERSAL_PACKAGE_TARGETS):
+            parser.error("Universal builds can only run {}.".format(" and ".join(UNIVERSAL_PACKAGE_TARGETS)))
+        if "package-kicad-unified" in package_targets and parsed_args.disk_budget and \
+                not parsed_args.kicad_source_dir:
+            parser.error("package-kicad-unified names the DMG from KiCad's source, which --disk-budget removes from "
+                         "the arm64 build. Use --kicad-source-dir.")
+
+    if parsed_args.shared_assets_dir:
+        parsed_args.shared_assets_dir = os.path.realpath(parsed_args.shared_assets_dir)
+
+    if parsed_args.arch in ("x86_64", "universal") and host_is_apple_silicon():
         # check on Rosetta
         # I'm not sure if we *should* need Rosetta, but right now
         # it seems to need it
-        try:
-            subprocess.check_call(["pgrep", "-q", "oahd"])
-        except subprocess.CalledProcessError:
+        if not rosetta_is_running():
             parser.error("Building KiCad x86_64 on arm64 requires Rosetta. "
                          "It doesn't appear to be installed. "
                          "One way to install it is with `/usr/sbin/softwareupdate --install-rosetta`.")
@@ -268,23 +647,17 @@ def parse_args(args):
     return parsed_args
 
 
-def get_make_command(args):
-    make_command = ["make", "-j{}".format(args.jobs)]
+def get_make_command(args, throttle=None):
+    # With a throttle, the number of jobs comes from its jobserver instead
+    make_command = ["make"] if throttle else ["make", "-j{}".format(args.jobs)]
+    if args.load_average:
+        make_command.append("-l{}".format(args.load_average))
     if args.target:
         make_command.extend(args.target)
 
     return make_command
 
-def build(args, new_path):
-
-    try:
-        os.makedirs(args.build_dir)
-    except OSError as exception:
-        if exception.errno != errno.EEXIST:
-            raise
-
-    os.chdir(args.build_dir)
-
+def get_cmake_command(args):
     cmake_command = ["cmake",
                      "-DMACOS_MIN_VERSION={}".format(args.macos_min_version),
                      "-DDOCS_TARBALL_URL={}".format(args.docs_tarball_url),
@@ -300,11 +673,12 @@ def build(args, new_path):
 
     if args.kicad_source_dir:
         cmake_command.append("-DKICAD_SOURCE_DIR={}".format(args.kicad_source_dir))
-    else:
-        if args.kicad_git_url:
-            cmake_command.append("-DKICAD_URL={}".format(args.kicad_git_url))
-        if args.kicad_ref:
-            cmake_command.append("-DKICAD_TAG={}".format(args.kicad_ref))
+    elif args.kicad_ref:
+        cmake_command.append("-DKICAD_TAG={}".format(args.kicad_ref))
+
+    # Includes KICAD_URL, from --kicad-git-url
+    for name, repository in sorted(args.git_repositories.items()):
+        cmake_command.append("-D{}={}".format(name, repository))
 
     if args.skip_docs_update:
         cmake_command.append("-DSKIP_DOCS_UPDATE=ON")
@@ -312,6 +686,9 @@ def build(args, new_path):
     if args.dmg_dir:
         cmake_command.append("-DDMG_DIR={}".format(args.dmg_dir))
 
+    if args.delta_base_dir:
+        cmake_command.append("-DDELTA_BASE_DIR={}".format(args.delta_base_dir))
+
     if args.extra_version:
         cmake_command.append("-DKICAD_VERSION_EXTRA={}".format(args.extra_version))
 
@@ -321,6 +698,9 @@ def build(args, new_path):
     if args.extra_kicad_cmake_args:
         cmake_command.append("-DKICAD_CMAKE_ARGS_EXTRA='{}'".format(args.extra_kicad_cmake_args))
 
+    if args.python_prune_patterns:
+        cmake_command.append("-DPYTHON_PRUNE_PATTERNS={}".format(";".join(args.python_prune_patterns)))
+
     if args.signing_identity:
         cmake_command.append("-DSIGNING_IDENTITY={}".format(args.signing_identity))
 
@@ -350,40 +730,979 @@ def build(args, new_path):
     if args.release_name:
         cmake_command.append("-DRELEASE_NAME={}".format(args.release_name))
 
+    if args.shared_assets_dir:
+        cmake_command.append("-DSHARED_ASSETS_BUILD_DIR={}".format(args.shared_assets_dir))
+
     cmake_command.append(args.kicad_mac_builder_cmake_dir)
 
-    print("Running {}".format(" ".join(cmake_command)), flush=True)
+    return cmake_command
+
+
+def get_configuration_fingerprint(args, cmake_command, new_path):
+    # Everything that goes into configuring the build directory: the cmake command, the kicad-mac-builder CMake
+    # files, and the PATH cmake runs with, since it uses brew to find dependencies.
+    digest = hashlib.sha256()
+    digest.update(json.dumps({"cmake_command": cmake_command, "PATH": new_path.split(":")}).encode("utf-8"))
+    cmake_dir = args.kicad_mac_builder_cmake_dir
+    for filename in sorted(os.listdir(cmake_dir)):
+        if filename == "CMakeLists.txt" or filename.endswith(".cmake"):
+            digest.update(filename.encode("utf-8") + b"\0")
+            with open(os.path.join(cmake_dir, filename), "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def configuration_is_current(args, fingerprint_path, fingerprint):
+    # cmake also writes the toolchain file outside of the build directory, so make sure that's still there too.
+    toolchain_path = os.path.join(args.kicad_mac_builder_cmake_dir, "..", "toolchain", "kicad-mac-builder.cmake")
+    for path in (os.path.join(args.build_dir, "Makefile"), os.path.join(args.build_dir, "CMakeCache.txt"),
+                 toolchain_path):
+        if not os.path.exists(path):
+            return False
     try:
-        subprocess.check_call(cmake_command, env=dict(os.environ, PATH=new_path))
-    except subprocess.CalledProcessError:
-        print("Error while running cmake. Please report this issue if you cannot fix it after reading the README.", flush=True)
-        raise
+        with open(fingerprint_path) as f:
+            return f.read() == fingerprint
+    except OSError:
+        return False
+
+
+def get_deps_cache_key(args):
+    # Hashes everything that determines the output of kicad-build-deps.  The build directory is included since the
+    # installed libraries and wx-config refer to it by absolute path.  Branches like relocatable-python's main aren't
+    # resolved, so a cached build keeps using whatever they pointed at when it was made.
+    with open(os.path.join(args.kicad_mac_builder_cmake_dir, "CMakeLists.txt")) as f:
+        python_version = re.search(r"set\( PYTHON_VERSION (\S+) \)", f.read()).group(1)
+    key = {"build_dir": args.build_dir,
+           "arch": args.arch or get_env_architecture(),
+           "macos_min_version": args.macos_min_version,
+           "build_type": args.build_type,
+           "python_version": python_version,
+           "brew_prefix": get_host_probe("brew_prefix"),
+           # Changing where a project is cloned from makes ExternalProject clone and build it again
+           "repositories": {name: args.git_repositories.get(name) for name in DEPS_CACHE_GIT_URLS},
+           "files": {}}
+    for filename in DEPS_CACHE_INPUT_FILES:
+        with open(os.path.join(args.kicad_mac_builder_cmake_dir, filename), "rb") as f:
+            key["files"][filename] = hashlib.sha256(f.read()).hexdigest()
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_deps_cache_entry_path(args, key):
+    return os.path.join(args.deps_cache_dir, "{}.tar".format(key))
+
+
+def deps_are_built(args, project):
+    return os.path.exists(os.path.join(args.build_dir, DEPS_CACHE_STAMP_DIRS[project], "{}-done".format(project)))
+
+
+def restore_deps_from_cache(args, key):
+    # Restores kicad-build-deps from the cache into a build directory that hasn't built any of them yet.
+    # Returns True if it did.
+    entry_path = get_deps_cache_entry_path(args, key)
+    if any(deps_are_built(args, project) for project in DEPS_CACHE_STAMP_DIRS) or not os.path.exists(entry_path):
+        return False
+
+    print("Restoring python, wxwidgets, wxpython and ngspice from {}".format(entry_path), flush=True)
+    with tarfile.open(entry_path) as tar:
+        if hasattr(tarfile, "fully_trusted_filter"):
+            tar.extractall(args.build_dir, filter="fully_trusted")
+        else:
+            tar.extractall(args.build_dir)
+
+    # Make everything in the stamp directories the same age, and newer than what cmake just generated, so make
+    # considers every step up to date.
+    now = time.time()
+    for stamp_dir in DEPS_CACHE_STAMP_DIRS.values():
+        for entry in os.scandir(os.path.join(args.build_dir, stamp_dir)):
+            os.utime(entry.path, (now, now))
+
+    # Mark the entry as recently used
+    os.utime(entry_path)
+    return True
+
+
+def save_deps_to_cache(args, key):
+    entry_path = get_deps_cache_entry_path(args, key)
+    if os.path.exists(entry_path) or not all(deps_are_built(args, project) for project in DEPS_CACHE_STAMP_DIRS):
+        return
+
+    print("Saving python, wxwidgets, wxpython and ngspice to {}".format(entry_path), flush=True)
+    os.makedirs(args.deps_cache_dir, exist_ok=True)
+    tmp_path = entry_path + ".tmp"
+    with tarfile.open(tmp_path, "w") as tar:
+        for path in DEPS_CACHE_OUTPUTS + list(DEPS_CACHE_STAMP_DIRS.values()):
+            tar.add(os.path.join(args.build_dir, path), arcname=path)
+    os.replace(tmp_path, entry_path)
+    evict_deps_cache(args.deps_cache_dir, int(args.deps_cache_size * 1024 ** 3), keep=entry_path)
+
+
+def evict_deps_cache(cache_dir, max_bytes, keep=None):
+    # Removes the least recently used entries until the cache fits in max_bytes.  The entry we just saved is kept even
+    # if it is bigger than the limit by itself.
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".tar") and entry.is_file():
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        print("Evicting {} from the dependency cache".format(path), flush=True)
+        os.remove(path)
+        total -= size
+
+
+def get_git_urls(args):
+    # Returns {CMake variable: URL} for every git repository the build clones from.
+    with open(os.path.join(args.kicad_mac_builder_cmake_dir, "CMakeLists.txt")) as f:
+        urls = dict(CMAKE_GIT_URL_RE.findall(f.read()))
+    if not args.kicad_source_dir:
+        urls["KICAD_URL"] = args.kicad_git_url
+    for git_url in args.git_urls:
+        name, _, url = git_url.partition("=")
+        urls[name] = url
+    return urls
+
+
+def get_git_mirror_path(mirror_dir, url):
+    # Named after the repository, so the directory is easy to find your way around, and the URL, so forks don't collide
+    name = os.path.basename(url.rstrip("/"))
+    if name.endswith(".git"):
+        name = name[:-len(".git")]
+    return os.path.join(mirror_dir, "{}-{}.git".format(name, hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]))
+
+
+def update_git_mirror(mirror_dir, url, fetch=True):
+    # Creates or fetches a bare mirror of url.  Returns the mirror's path, or None if there isn't one, in which case
+    # the build clones from url directly.  A mirror that can't be fetched is used as it is, so builds still work
+    # offline.
+    path = get_git_mirror_path(mirror_dir, url)
+    os.makedirs(mirror_dir, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        # Other build.py runs may be updating the same mirror
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            if fetch:
+                result = subprocess.run(["git", "--git-dir", path, "fetch", "--prune", "--quiet", "origin"],
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+                if result.returncode != 0:
+                    print("Unable to update the mirror of {}, so using it as it is:\n{}".format(url, result.stdout),
+                          flush=True)
+            return path
+        if not fetch:
+            return None
+        # Clone next to the mirror and then move it into place, so an interrupted clone doesn't look like a mirror
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        result = subprocess.run(["git", "clone", "--mirror", "--quiet", url, tmp_path],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if result.returncode != 0:
+            print("Unable to mirror {}, so cloning it directly:\n{}".format(url, result.stdout), flush=True)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return None
+        os.replace(tmp_path, path)
+        return path
+
+
+def get_git_repositories(args):
+    # Returns {CMake variable: repository to clone}, which is the local mirror of each repository, after updating the
+    # mirrors all at once, or its URL without --git-mirror-dir.  Projects clone from a mirror with hardlinks, and
+    # only fetch what changed since the last build from upstream.
+    urls = get_git_urls(args)
+    if not args.git_mirror_dir:
+        return urls
+
+    start_time = time.monotonic()
+    fetch = not args.skip_git_mirror_update
+    distinct_urls = sorted(set(urls.values()))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(distinct_urls)) as executor:
+        mirrors = dict(zip(distinct_urls, executor.map(lambda url: update_git_mirror(args.git_mirror_dir, url, fetch),
+                                                       distinct_urls)))
+    if fetch:
+        print("Updated the git mirrors in {} in {:.0f} seconds.".format(args.git_mirror_dir,
+                                                                       time.monotonic() - start_time), flush=True)
+    return {name: mirrors[url] or url for name, url in urls.items()}
+
+
+class BuildTrace:
+    # Records when each ExternalProject step starts and finishes, for --trace.  A step starts when make prints its
+    # message, like "Performing build step for 'kicad'", and finishes when its stamp file is touched.  The result is
+    # Chrome trace event JSON, which chrome://tracing and https://ui.perfetto.dev can show.
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.spans = []
+        self.steps_by_message = collections.defaultdict(list)
+        self.started_steps = {}
+
+    def load_steps(self, build_dir):
+        # Finds every ExternalProject step, its stamp file and its message, in the makefiles cmake generated.
+        self.steps_by_message.clear()
+        for build_make in glob.glob(os.path.join(build_dir, "CMakeFiles", "*.dir", "build.make")):
+            stamp = None
+            with open(build_make, errors="replace") as f:
+                for line in f:
+                    rule_match = BUILD_MAKE_RULE_RE.match(line)
+                    if rule_match:
+                        stamp = rule_match.group("target") if STAMP_RE.match(rule_match.group("target")) else None
+                        continue
+                    echo_match = BUILD_MAKE_ECHO_RE.match(line.rstrip("\n"))
+                    if stamp and echo_match:
+                        stamp_path = os.path.join(build_dir, stamp)
+                        if stamp_path not in self.steps_by_message[echo_match.group("message")]:
+                            self.steps_by_message[echo_match.group("message")].append(stamp_path)
+                        stamp = None
+
+    def add_span(self, name, start_time, end_time, category, args=None):
+        self.spans.append({"name": name, "cat": category, "start": start_time, "end": end_time, "args": args or {}})
+
+    def observe_make_output(self, line):
+        message = MAKE_PROGRESS_RE.sub("", ANSI_ESCAPE_RE.sub("", line)).strip()
+        for stamp_path in self.steps_by_message.get(message, []):
+            if stamp_path not in self.started_steps:
+                self.started_steps[stamp_path] = time.time()
+                break
+
+    def finish_make(self, make_start_time, make_command, returncode):
+        # Steps that were started and whose stamp is newer than their start finished at the stamp's mtime.  The
+        # rest were still running, or failed, when make exited.
+        end_time = time.time()
+        for stamp_path, start_time in self.started_steps.items():
+            match = STAMP_RE.match(stamp_path)
+            name = "{} {}".format(match.group("project"), match.group("step"))
+            try:
+                stamp_mtime = os.stat(stamp_path).st_mtime
+            except OSError:
+                stamp_mtime = None
+            if stamp_mtime is not None and stamp_mtime >= start_time - 1:
+                self.add_span(name, start_time, max(start_time, stamp_mtime), "step")
+            else:
+                self.add_span(name, start_time, end_time, "step", {"finished": False})
+        self.started_steps.clear()
+        self.add_span("make", make_start_time, end_time, "make",
+                      {"command": " ".join(make_command), "returncode": returncode})
+
+    def get_events(self, pid=1, process_name="build.py", time_offset=0):
+        # Spans that overlap go in separate rows, so what ran in parallel is easy to see.
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": process_name}}]
+        row_end_times = []
+        for span in sorted(self.spans, key=lambda span: (span["start"], -span["end"])):
+            if span["cat"] == "step":
+                for row, row_end_time in enumerate(row_end_times):
+                    if row_end_time <= span["start"]:
+                        break
+                else:
+                    row = len(row_end_times)
+                    row_end_times.append(0)
+                row_end_times[row] = span["end"]
+                tid = row + 1
+            else:
+                tid = 0
+            events.append({"name": span["name"], "cat": span["cat"], "ph": "X", "pid": pid, "tid": tid,
+                           "ts": int((span["start"] - self.start_time + time_offset) * 1000000),
+                           "dur": int((span["end"] - span["start"]) * 1000000),
+                           "args": span["args"]})
+        return events
+
+    def write(self, path, extra_events=None):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.get_events() + (extra_events or []),
+                       "displayTimeUnit": "ms",
+                       "otherData": {"start_time": self.start_time}}, f)
+
+    def print_summary(self):
+        steps = sorted((span for span in self.spans if span["cat"] == "step"),
+                       key=lambda span: span["end"] - span["start"], reverse=True)
+        if steps:
+            print("Longest steps:", flush=True)
+            for span in steps[:TRACE_SUMMARY_STEPS]:
+                print("  {:8.0f}s  {}".format(span["end"] - span["start"], span["name"]), flush=True)
+
+
+class DiskUsageMonitor:
+    # Samples how much of the build directory's disk is used while the build runs, to find the peak.
+
+    def __init__(self, path, interval=DISK_USAGE_SAMPLE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.start_used = self.peak_used = shutil.disk_usage(path).used
+
+    def start(self):
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.sample()
+
+    def sample(self):
+        self.peak_used = max(self.peak_used, shutil.disk_usage(self.path).used)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def get_peak_growth(self):
+        # Other things use the disk too, so this is only approximately what the build used
+        return self.peak_used - self.start_used
+
+
+def get_step_stamps(build_dir):
+    # Returns {(project, step): stamp path relative to the build directory} for every ExternalProject step cmake
+    # generated a rule for.
+    stamps = {}
+    for build_make in glob.glob(os.path.join(build_dir, "CMakeFiles", "*.dir", "build.make")):
+        with open(build_make, errors="replace") as f:
+            for line in f:
+                rule_match = BUILD_MAKE_RULE_RE.match(line)
+                stamp_match = rule_match and STAMP_RE.match(rule_match.group("target"))
+                if stamp_match:
+                    stamps[(stamp_match.group("project"), stamp_match.group("step"))] = rule_match.group("target")
+    return stamps
+
+
+def get_planned_targets(build_dir, targets):
+    # The targets make builds for these goals, or for "all" if there aren't any, and everything they depend on.
+    dependencies = collections.defaultdict(set)
+    with open(os.path.join(build_dir, "CMakeFiles", "Makefile2"), errors="replace") as f:
+        for match in MAKEFILE2_DEPENDENCY_RE.finditer(f.read()):
+            dependencies[match.group("target")].add(match.group("dependency"))
+    planned = set()
+    # The rules for "all" don't match the target group, so its dependencies are under None
+    pending = list(targets) if targets else list(dependencies[None])
+    while pending:
+        target = pending.pop()
+        if target not in planned:
+            planned.add(target)
+            pending.extend(dependencies[target])
+    return planned
+
+
+def get_freed_size(path):
+    # How much removing path frees.  Files with other links, like the ones stage.py hardlinked into KiCad.app, free
+    # nothing.
+    size = 0
+    for root, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            st = os.lstat(os.path.join(root, filename))
+            if st.st_nlink == 1:
+                size += st.st_blocks * 512
+    return size
+
+
+def get_disk_budget_stamp_dir(project):
+    return os.path.join(os.path.dirname(DISK_BUDGET_PRUNABLE[project][0][0]), "{}-stamp".format(project))
+
+
+def load_disk_budget_state(build_dir):
+    # Returns the projects --disk-budget removed the trees of, which restart_pruned_projects checks on the next build,
+    # and {project: revision} for the ones that were git checkouts, for the perf history.
+    try:
+        with open(os.path.join(build_dir, DISK_BUDGET_STATE_FILENAME)) as f:
+            state = json.load(f)
+        return set(state["pruned"]), state.get("revisions", {})
+    except (OSError, ValueError, KeyError):
+        return set(), {}
+
+
+def write_disk_budget_state(build_dir, pruned, revisions):
+    state_path = os.path.join(build_dir, DISK_BUDGET_STATE_FILENAME)
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"pruned": sorted(pruned),
+                   "revisions": {project: revision for project, revision in revisions.items() if project in pruned}},
+                  f, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def prune_project(build_dir, project):
+    # Removes a project's trees, but not its stamps, so make doesn't build it again.  Returns the bytes freed.
+    pruned, revisions = load_disk_budget_state(build_dir)
+    # The checkout is about to go, so get_git_revisions can't ask it later
+    revision = get_git_revision(os.path.join(build_dir, DISK_BUDGET_PRUNABLE[project][0][0]))
+    if revision:
+        revisions[project] = revision
+    write_disk_budget_state(build_dir, pruned | {project}, revisions)
+    freed = 0
+    for path in DISK_BUDGET_PRUNABLE[project][0]:
+        path = os.path.join(build_dir, path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            freed += get_freed_size(path)
+            shutil.rmtree(path)
+    print("build.py: removed the trees of {}, which nothing else in the build needs, freeing {:.1f} GB".format(
+        project, freed / 1024 ** 3), flush=True)
+    return freed
+
+
+def step_is_up_to_date(build_dir, project, target):
+    return subprocess.call(["make", "-q", "-f", os.path.join("CMakeFiles", "{}.dir".format(project), "build.make"),
+                            target], cwd=build_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def restart_pruned_projects(build_dir):
+    # A project --disk-budget pruned can't run any of its steps again, and the steps that used its trees can't either.
+    # If make would run any of them, the project's stamps are removed too, so it starts over from a fresh clone.
+    # Restarting one project can make the steps that use another run again, so this goes until nothing changes.
+    pruned, revisions = load_disk_budget_state(build_dir)
+    stamps = get_step_stamps(build_dir)
+    restarted = True
+    while restarted:
+        restarted = False
+        for project in sorted(pruned):
+            checks = [(project, "CMakeFiles/{}-complete".format(project))]
+            for consumer, step in DISK_BUDGET_PRUNABLE[project][1]:
+                checks.append((consumer, "CMakeFiles/{}-complete".format(consumer) if step is None
+                               else stamps.get((consumer, step))))
+            # Projects that aren't in this configuration, or are built in another build directory, can't run
+            checks = [(target_project, target) for target_project, target in checks
+                      if target and os.path.exists(os.path.join(build_dir, "CMakeFiles",
+                                                                "{}.dir".format(target_project), "build.make"))]
+            if all(step_is_up_to_date(build_dir, target_project, target) for target_project, target in checks):
+                continue
+            print("Building {} again from the beginning, since --disk-budget removed its trees in an earlier "
+                  "build.".format(project), flush=True)
+            shutil.rmtree(os.path.join(build_dir, get_disk_budget_stamp_dir(project)), ignore_errors=True)
+            for path in DISK_BUDGET_PRUNABLE[project][0]:
+                shutil.rmtree(os.path.join(build_dir, path), ignore_errors=True)
+            pruned.discard(project)
+            write_disk_budget_state(build_dir, pruned, revisions)
+            restarted = True
+
+
+class DiskBudget:
+    # Removes the trees in DISK_BUDGET_PRUNABLE as soon as every step this build runs that uses them has finished, for
+    # --disk-budget.  A step has finished once its stamp is touched, and a whole target once make says it built it.
+    # The removing happens on its own thread, so make's output keeps flowing.
+
+    def __init__(self, build_dir, targets, interval=DISK_USAGE_SAMPLE_INTERVAL):
+        self.build_dir = build_dir
+        self.interval = interval
+        self.start_time = time.time()
+        self.built_targets = set()
+        self.freed = 0
+        self.stamps = get_step_stamps(build_dir)
+        planned = get_planned_targets(build_dir, targets)
+        projects_with_steps = {project for project, step in self.stamps}
+        self.pending = {}
+        for project, (paths, consumers) in DISK_BUDGET_PRUNABLE.items():
+            if project not in projects_with_steps:
+                # Built in another build directory, like the shared assets of a universal build
+                continue
+            consumers = [(consumer, step) for consumer, step in consumers
+                         if consumer in planned and (step is None or (consumer, step) in self.stamps)]
+            # With nothing in this build using a project, like in the shared assets build, its trees are the point
+            if consumers:
+                self.pending[project] = consumers
+
+    def start(self):
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def observe_make_output(self, line):
+        match = BUILT_TARGET_RE.match(MAKE_PROGRESS_RE.sub("", ANSI_ESCAPE_RE.sub("", line)).strip())
+        if match:
+            self.built_targets.add(match.group("target"))
+
+    def is_finished(self, consumer, step):
+        if step is None:
+            return consumer in self.built_targets
+        try:
+            return os.stat(os.path.join(self.build_dir, self.stamps[(consumer, step)])).st_mtime >= self.start_time - 1
+        except OSError:
+            return False
+
+    def prune(self, project):
+        del self.pending[project]
+        self.freed += prune_project(self.build_dir, project)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            for project, consumers in list(self.pending.items()):
+                if all(self.is_finished(consumer, step) for consumer, step in consumers):
+                    self.prune(project)
+
+    def finish(self):
+        # Once make has succeeded, every step that uses what's left is done, even the ones that were already up to date
+        for project in list(self.pending):
+            self.prune(project)
+        print("--disk-budget freed {:.1f} GB".format(self.freed / 1024 ** 3), flush=True)
+
+
+def get_git_revision(path):
+    completed = subprocess.run(["git", "-C", path, "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    return completed.stdout.decode("utf-8").strip() if completed.returncode == 0 else None
+
+
+def get_git_revisions(args):
+    # The revisions that went into this build, for the repos that have been checked out so far.  For the checkouts
+    # --disk-budget removed, they're the revisions it recorded first.
+    assets_dir = args.shared_assets_dir or args.build_dir
+    # {name: (checkout, build directory whose --disk-budget state has it, if it's one of the build's projects)}
+    repos = {"kicad-mac-builder": (os.path.dirname(os.path.abspath(__file__)), None)}
+    if args.kicad_source_dir:
+        repos["kicad"] = (args.kicad_source_dir, None)
+    else:
+        repos["kicad"] = (os.path.join(args.build_dir, "kicad", "src", "kicad"), args.build_dir)
+    for name in ["symbols", "footprints", "packages3d", "templates"]:
+        repos[name] = (os.path.join(assets_dir, name, "src", name), assets_dir)
+    revisions = {}
+    for name, (path, build_dir) in repos.items():
+        revision = get_git_revision(path)
+        if revision is None and build_dir:
+            revision = load_disk_budget_state(build_dir)[1].get(name)
+        if revision:
+            revisions[name] = revision
+    return revisions
+
+
+def get_dmg_sizes(args, since):
+    dmg_dir = args.dmg_dir or os.path.join(args.build_dir, "dmg")
+    sizes = {}
+    for path in glob.glob(os.path.join(dmg_dir, "*.dmg")):
+        st = os.stat(path)
+        if st.st_mtime >= since:
+            sizes[os.path.basename(path)] = st.st_size
+    return sizes
+
+
+def open_perf_history(path):
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            start_time REAL,
+            duration REAL,
+            succeeded INTEGER,
+            revisions TEXT,
+            args TEXT,
+            host TEXT,
+            peak_disk_bytes INTEGER,
+            dmg_bytes INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS steps (
+            run_id INTEGER REFERENCES runs(id),
+            name TEXT,
+            duration REAL
+        );
+        CREATE TABLE IF NOT EXISTS artifacts (
+            run_id INTEGER REFERENCES runs(id),
+            name TEXT,
+            size INTEGER
+        );
+    """)
+    return db
+
+
+def record_perf_history(args, trace, succeeded, disk_monitor):
+    host_probes = get_host_probes()
+    dmg_sizes = get_dmg_sizes(args, trace.start_time)
+    db = open_perf_history(args.perf_history)
+    with db:
+        cursor = db.execute("INSERT INTO runs (start_time, duration, succeeded, revisions, args, host, "
+                            "peak_disk_bytes, dmg_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (trace.start_time, time.time() - trace.start_time, int(succeeded),
+                             json.dumps(get_git_revisions(args), sort_keys=True),
+                             json.dumps(vars(args), sort_keys=True, default=str),
+                             json.dumps({name: host_probes[name]["output"] for name in PERF_HISTORY_HOST_PROBES},
+                                        sort_keys=True),
+                             disk_monitor.get_peak_growth(),
+                             sum(dmg_sizes.values()) if dmg_sizes else None))
+        run_id = cursor.lastrowid
+        # A step can run more than once, like when it's retried with one job; the attempt that finished counts
+        durations = {}
+        for span in trace.spans:
+            if span["cat"] in ("step", "cmake", "cache") and span["args"].get("finished", True):
+                durations[span["name"]] = span["end"] - span["start"]
+        db.executemany("INSERT INTO steps (run_id, name, duration) VALUES (?, ?, ?)",
+                       [(run_id, name, duration) for name, duration in sorted(durations.items())])
+        db.executemany("INSERT INTO artifacts (run_id, name, size) VALUES (?, ?, ?)",
+                       [(run_id, name, size) for name, size in sorted(dmg_sizes.items())])
+    db.close()
+    print("Recorded this build in {}".format(args.perf_history), flush=True)
+
+
+def get_perf_regressions(latest, baseline, threshold, min_value):
+    # Compares {name: value} from the latest run against the median of the same names in earlier runs.
+    # Returns [(name, baseline median, latest value)] for the ones that grew by more than threshold.
+    regressions = []
+    for name, value in sorted(latest.items()):
+        previous = sorted(values[name] for values in baseline if values.get(name) is not None)
+        if not previous or value is None:
+            continue
+        median = previous[len(previous) // 2]
+        if value > median * (1 + threshold) and value - median >= min_value:
+            regressions.append((name, median, value))
+    return regressions
+
+
+def perf_report(args):
+    # Compares the last successful run against the successful runs before it.  Returns True if anything regressed.
+    if not os.path.exists(args.perf_history):
+        print("No build history in {}.".format(args.perf_history), flush=True)
+        return False
+    db = open_perf_history(args.perf_history)
+    runs = db.execute("SELECT id, start_time, duration, peak_disk_bytes, dmg_bytes, revisions FROM runs "
+                      "WHERE succeeded ORDER BY start_time DESC LIMIT ?", (args.perf_report_runs,)).fetchall()
+    if len(runs) < 2:
+        print("Need at least two successful builds in {} to compare.".format(args.perf_history), flush=True)
+        return False
+
+    step_durations = []
+    sizes = []
+    for run_id, _, duration, peak_disk_bytes, dmg_bytes, _ in runs:
+        steps = dict(db.execute("SELECT name, duration FROM steps WHERE run_id = ?", (run_id,)).fetchall())
+        steps["total"] = duration
+        step_durations.append(steps)
+        run_sizes = dict(db.execute("SELECT name, size FROM artifacts WHERE run_id = ?", (run_id,)).fetchall())
+        run_sizes.update({"peak disk use": peak_disk_bytes, "all DMGs": dmg_bytes})
+        sizes.append(run_sizes)
+    db.close()
+
+    latest_id, latest_start_time, _, _, _, latest_revisions = runs[0]
+    print("Comparing the build from {} against the {} successful builds before it.".format(
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(latest_start_time)), len(runs) - 1), flush=True)
+    print("Revisions: {}".format(", ".join("{} {}".format(name, revision[:10])
+                                           for name, revision in sorted(json.loads(latest_revisions).items()))))
+
+    # DMG names include the date, so only ones that keep their name from build to build get compared one by one
+    threshold = args.perf_threshold / 100
+    slower = get_perf_regressions(step_durations[0], step_durations[1:], threshold, PERF_REPORT_MIN_SECONDS)
+    bigger = get_perf_regressions(sizes[0], sizes[1:], threshold, 0)
+    for name, median, value in slower:
+        print("SLOWER: {} took {:.0f}s, up from a median of {:.0f}s".format(name, value, median), flush=True)
+    for name, median, value in bigger:
+        print("BIGGER: {} is {:.1f} MB, up from a median of {:.1f} MB".format(
+            name, value / 1024 ** 2, median / 1024 ** 2), flush=True)
+    if not slower and not bigger:
+        print("No regressions beyond {}%.".format(args.perf_threshold), flush=True)
+    return bool(slower or bigger)
+
+
+def get_available_memory():
+    # Free memory, plus what macOS would give back without swapping, in bytes.  This changes from moment to moment, so
+    # it isn't one of the cached host probes.
+    try:
+        vm_stat = subprocess.check_output(["vm_stat"], stderr=subprocess.DEVNULL).decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return get_memory_size() - int(RESERVED_MEMORY_GB * 1024 ** 3)
+    page_size_match = VM_STAT_PAGE_SIZE_RE.search(vm_stat)
+    page_size = int(page_size_match.group("page_size")) if page_size_match else 4096
+    return sum(int(match.group("pages")) for match in VM_STAT_RE.finditer(vm_stat)) * page_size
+
+
+def get_pending_projects(args):
+    # KiCad is rebuilt on nearly every run, but the dependencies only build when they haven't been built yet.
+    return ["kicad"] + [project for project in DEPS_CACHE_STAMP_DIRS if not deps_are_built(args, project)]
+
+
+def get_memory_per_job(args):
+    return max(MEMORY_PER_JOB_GB[project] for project in get_pending_projects(args)) * 1024 ** 3
+
+
+def get_memory_budget(args):
+    if args.memory_budget:
+        return args.memory_budget * 1024 ** 3
+    return get_available_memory() - RESERVED_MEMORY_GB * 1024 ** 3
+
+
+def get_adaptive_jobs(args):
+    # Runs as many jobs as fit in memory, if the hungriest project left to build is the one running, up to --jobs.
+    budget = get_memory_budget(args)
+    memory_per_job = get_memory_per_job(args)
+    jobs = max(1, min(args.jobs, int(budget // memory_per_job)))
+    print("Using {} jobs for {:.1f} GB of memory, at {:.1f} GB per job for {}".format(
+        jobs, budget / 1024 ** 3, memory_per_job / 1024 ** 3, ", ".join(get_pending_projects(args))), flush=True)
+    return jobs
+
+
+class MemoryThrottle:
+    # Stands in for make's jobserver, so that job slots can be held back while memory is low.  make takes a token from
+    # the pipe before starting each job beyond its first, and puts it back when the job is done.  Taking tokens out
+    # of the pipe ourselves stops new jobs from starting until enough memory is free again.
+
+    def __init__(self, jobs, min_free_memory, memory_per_job, interval=2):
+        self.jobs = jobs
+        self.min_free_memory = min_free_memory
+        self.memory_per_job = memory_per_job
+        self.interval = interval
+        self.held = 0
+
+    def start(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b"+" * (self.jobs - 1))
+        self.held = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def get_env(self, env):
+        # make 4.2 renamed --jobserver-fds to --jobserver-auth
+        if get_make_version() >= (4, 2):
+            makeflags = "-j{} --jobserver-auth={},{}".format(self.jobs, self.read_fd, self.write_fd)
+        else:
+            makeflags = "-j --jobserver-fds={},{}".format(self.read_fd, self.write_fd)
+        return dict(env, MAKEFLAGS=makeflags)
+
+    def take_token(self):
+        # Waits for a running job to finish and give its token back.  Newer versions of make make the pipe
+        # non-blocking, and another make may grab the token first, so wait for it to be readable and try again.
+        while not self.stopping.is_set():
+            select.select([self.read_fd], [], [], self.interval)
+            try:
+                if os.read(self.read_fd, 1):
+                    return not self.stopping.is_set()
+            except BlockingIOError:
+                pass
+        return False
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            available = get_available_memory()
+            if available < self.min_free_memory and self.held < self.jobs - 1:
+                if not self.take_token():
+                    return
+                self.held += 1
+                print("build.py: {:.1f} GB free, holding back {} of {} jobs".format(
+                    available / 1024 ** 3, self.held, self.jobs), flush=True)
+            elif self.held and available > self.min_free_memory + self.memory_per_job:
+                os.write(self.write_fd, b"+")
+                self.held -= 1
+                print("build.py: {:.1f} GB free, holding back {} of {} jobs".format(
+                    available / 1024 ** 3, self.held, self.jobs), flush=True)
+
+
+def run_make(make_command, env, throttle=None, trace=None, disk_budget=None):
+    # Runs make, passing its output through as it arrives.  Returns make's exit status, the targets make reported as
+    # failing, in the order it reported them, and the last lines of output.
+    failed_targets = []
+    output_tail = collections.deque(maxlen=MAKE_OUTPUT_TAIL_LINES)
+    pass_fds = ()
+    if throttle:
+        throttle.start()
+        env = throttle.get_env(env)
+        pass_fds = (throttle.read_fd, throttle.write_fd)
+    if disk_budget:
+        disk_budget.start()
+    make_start_time = time.time()
+    returncode = None
+    try:
+        process = subprocess.Popen(make_command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   pass_fds=pass_fds)
+        for raw_line in process.stdout:
+            line = raw_line.decode('utf-8', errors='replace')
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            output_tail.append(line)
+            if trace:
+                trace.observe_make_output(line)
+            if disk_budget:
+                disk_budget.observe_make_output(line)
+            match = MAKE_ERROR_RE.match(line)
+            if match:
+                failed_targets.append(match.group("target"))
+        returncode = process.wait()
+    finally:
+        if throttle:
+            throttle.stop()
+        if disk_budget:
+            disk_budget.stop()
+        if trace:
+            trace.finish_make(make_start_time, make_command, returncode)
+    return returncode, failed_targets, list(output_tail)
+
+
+def get_failed_step(failed_targets):
+    # Finds the ExternalProject step that failed, like ("kicad", "build", "kicad/src/kicad-stamp/kicad-build"), from
+    # the targets make reported.  Nested makes report their failures first, so the first stamp is the one we want.
+    for target in failed_targets:
+        match = STAMP_RE.match(target)
+        if match and os.path.exists(os.path.join("CMakeFiles", "{}.dir".format(match.group("project")), "build.make")):
+            return match.group("project"), match.group("step"), target
+    return None
+
+
+def get_step_make_command(project, stamp):
+    # Builds just one ExternalProject step, and the earlier steps of the same project if they need it, without
+    # rebuilding the rest of the tree.
+    return ["make", "-j1", "-f", os.path.join("CMakeFiles", "{}.dir".format(project), "build.make"), stamp]
+
+
+def print_failure_excerpt(output_tail):
+    # Shows where the failure happened, since it can be far above the end of a long, verbose build log.
+    lines = output_tail
+    for i, line in enumerate(output_tail):
+        if FAILURE_LINE_RE.search(line):
+            lines = output_tail[max(0, i - FAILURE_EXCERPT_CONTEXT_LINES):]
+            break
+    print("\nFailure excerpt:\n" + "".join(lines[:FAILURE_EXCERPT_MAX_LINES]), flush=True)
+
+
+def build(args, new_path):
+    # The perf history needs the step timings even when we aren't writing a trace
+    trace = BuildTrace() if args.trace or args.perf_history else None
+    disk_monitor = None
+    if args.perf_history or args.disk_budget:
+        os.makedirs(args.build_dir, exist_ok=True)
+        disk_monitor = DiskUsageMonitor(args.build_dir)
+        disk_monitor.start()
+    succeeded = False
+    try:
+        run_build(args, new_path, trace)
+        succeeded = True
+    finally:
+        # Write the trace even if the build failed, since that's often when it's most interesting
+        if args.trace:
+            trace.write(args.trace)
+            print("Wrote a trace of the build to {}".format(args.trace), flush=True)
+            trace.print_summary()
+        if disk_monitor:
+            disk_monitor.stop()
+            if args.disk_budget:
+                print("Disk usage peaked at {:.1f} GB more than when the build started.".format(
+                    disk_monitor.get_peak_growth() / 1024 ** 3), flush=True)
+            if args.perf_history:
+                # Don't let a problem with the history hide what happened to the build
+                try:
+                    record_perf_history(args, trace, succeeded, disk_monitor)
+                except Exception as e:
+                    print("Unable to record this build in {}: {}".format(args.perf_history, e), flush=True)
+
+
+def run_build(args, new_path, trace=None):
 
-    make_command = get_make_command(args)
-    print("Running {}".format(" ".join(make_command)), flush=True)
     try:
-        subprocess.check_call(make_command, env=dict(os.environ, PATH=new_path))
-    except subprocess.CalledProcessError:
+        os.makedirs(args.build_dir)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+
+    os.chdir(args.build_dir)
+
+    mirror_start_time = time.time()
+    args.git_repositories = get_git_repositories(args)
+    if trace and args.git_mirror_dir and not args.skip_git_mirror_update:
+        trace.add_span("update git mirrors", mirror_start_time, time.time(), "git")
+
+    cmake_command = get_cmake_command(args)
+    fingerprint_path = os.path.join(args.build_dir, CONFIGURATION_FINGERPRINT_FILENAME)
+    fingerprint = get_configuration_fingerprint(args, cmake_command, new_path)
+
+    if not args.reconfigure and configuration_is_current(args, fingerprint_path, fingerprint):
+        print("The CMake configuration is unchanged since the last run, so skipping cmake. "
+              "Use --reconfigure to run it anyway.", flush=True)
+    else:
+        # If cmake fails partway through, the old fingerprint no longer describes the build directory
+        if os.path.exists(fingerprint_path):
+            os.remove(fingerprint_path)
+        print("Running {}".format(" ".join(cmake_command)), flush=True)
+        cmake_start_time = time.time()
+        try:
+            subprocess.check_call(cmake_command, env=dict(os.environ, PATH=new_path))
+        except subprocess.CalledProcessError:
+            print("Error while running cmake. Please report this issue if you cannot fix it after reading the README.", flush=True)
+            raise
+        if trace:
+            trace.add_span("cmake", cmake_start_time, time.time(), "cmake")
+        with open(fingerprint_path, "w") as f:
+            f.write(fingerprint)
+
+    if trace:
+        trace.load_steps(args.build_dir)
+
+    # Before the dependency cache, which can restore projects this starts over
+    restart_pruned_projects(args.build_dir)
+
+    deps_cache_key = None
+    restored_deps = False
+    if args.deps_cache_dir:
+        deps_cache_key = get_deps_cache_key(args)
+        restore_start_time = time.time()
+        restored_deps = restore_deps_from_cache(args, deps_cache_key)
+        if trace and restored_deps:
+            trace.add_span("restore dependencies", restore_start_time, time.time(), "cache")
+
+    throttle = None
+    if args.adaptive_jobs:
+        args.jobs = get_adaptive_jobs(args)
+        if args.min_free_memory and args.jobs > 1:
+            throttle = MemoryThrottle(args.jobs, args.min_free_memory * 1024 ** 3, get_memory_per_job(args))
+
+    disk_budget = DiskBudget(args.build_dir, args.target) if args.disk_budget else None
+
+    make_command = get_make_command(args, throttle)
+    print("Running {}".format(" ".join(make_command)), flush=True)
+    returncode, failed_targets, output_tail = run_make(make_command, env=dict(os.environ, PATH=new_path),
+                                                       throttle=throttle, trace=trace, disk_budget=disk_budget)
+    if returncode != 0:
         if args.retry_failed_build and args.jobs > 1:
             print("Error while running make.", flush=True)
             print_summary(args)
-            print("Rebuilding with a single job. If this consistently occurs, " \
-                  "please report this issue. ", flush=True)
-            args.jobs = 1
-            make_command = get_make_command(args)
+            failed_step = get_failed_step(failed_targets)
+            if failed_step is not None:
+                project, step, stamp = failed_step
+                print("The {} step of {} failed. Rebuilding just that step with a single job. If this consistently "
+                      "occurs, please report this issue. ".format(step, project), flush=True)
+                make_command = get_step_make_command(project, stamp)
+            else:
+                print("Rebuilding with a single job. If this consistently occurs, " \
+                      "please report this issue. ", flush=True)
+                args.jobs = 1
+                make_command = get_make_command(args)
             print("Running {}".format(" ".join(make_command)), flush=True)
-            try:
-                subprocess.check_call(make_command, env=dict(os.environ, PATH=new_path))
-            except subprocess.CalledProcessError:
+            returncode, failed_targets, output_tail = run_make(make_command, env=dict(os.environ, PATH=new_path),
+                                                               trace=trace, disk_budget=disk_budget)
+            if returncode != 0:
+                print_failure_excerpt(output_tail)
                 print("Error while running make after rebuilding with a single job. Please report this issue if you " \
                       "cannot fix it after reading the README.", flush=True)
                 print_summary(args)
-                raise
+                raise subprocess.CalledProcessError(returncode, make_command)
+            if failed_step is not None:
+                # The failed step worked on its own, so pick up where the parallel build left off.
+                make_command = get_make_command(args, throttle)
+                print("Running {}".format(" ".join(make_command)), flush=True)
+                returncode, failed_targets, output_tail = run_make(make_command, env=dict(os.environ, PATH=new_path),
+                                                                   throttle=throttle, trace=trace,
+                                                                   disk_budget=disk_budget)
+                if returncode != 0:
+                    print_failure_excerpt(output_tail)
+                    print("Error while running make. Please report this issue if you cannot fix it after reading the "
+                          "README.", flush=True)
+                    print_summary(args)
+                    raise subprocess.CalledProcessError(returncode, make_command)
         else:
+            print_failure_excerpt(output_tail)
             print("Error while running make. It may be helpful to rerun with a single make job. Please report this " \
                   "issue if you cannot fix it after reading the README.", flush=True)
             print_summary(args)
-            raise
+            raise subprocess.CalledProcessError(returncode, make_command)
+
+    if disk_budget:
+        disk_budget.finish()
+
+    if deps_cache_key and not restored_deps:
+        save_start_time = time.time()
+        save_deps_to_cache(args, deps_cache_key)
+        if trace:
+            trace.add_span("save dependencies", save_start_time, time.time(), "cache")
 
     had_package_targets = any(target.startswith("package-") for target in args.target)
     if had_package_targets:
@@ -394,6 +1713,298 @@ def build(args, new_path):
 
     print("Build complete.", flush=True)
 
+def get_forwarded_args(args):
+    # The arguments each per-architecture build.py in a universal build gets from this one.
+    forwarded = ["--macos-min-version", args.macos_min_version,
+                 "--build-type", args.build_type,
+                 "--symbols-ref", args.symbols_ref,
+                 "--footprints-ref", args.footprints_ref,
+                 "--packages3d-ref", args.packages3d_ref,
+                 "--templates-ref", args.templates_ref,
+                 "--docs-tarball-url", args.docs_tarball_url,
+                 "--signing-certificate-id", args.signing_certificate_id,
+                 ]
+    if args.kicad_source_dir:
+        forwarded.extend(["--kicad-source-dir", args.kicad_source_dir])
+    else:
+        forwarded.extend(["--kicad-git-url", args.kicad_git_url, "--kicad-ref", args.kicad_ref])
+    for option, value in (("--extra-version", args.extra_version),
+                          ("--release-name", args.release_name),
+                          ("--extra-bundle-fix-dir", args.extra_bundle_fix_dir),
+                          ("--extra-kicad-cmake-args", args.extra_kicad_cmake_args),
+                          ("--signing-identity", args.signing_identity),
+                          ("--deps-cache-dir", args.deps_cache_dir),
+                          ("--git-mirror-dir", args.git_mirror_dir),
+                          ("--deps-cache-size", str(args.deps_cache_size)),
+                          ("--min-free-memory", str(args.min_free_memory)),
+                          ("--load-average", args.load_average and str(args.load_average))):
+        if value:
+            forwarded.extend([option, value])
+    for option, value in (("--release", args.release),
+                          ("--skip-docs-update", args.skip_docs_update),
+                          ("--redistributable", args.redistributable),
+                          ("--hardened-runtime", args.hardened_runtime),
+                          ("--reconfigure", args.reconfigure),
+                          ("--adaptive-jobs", args.adaptive_jobs),
+                          ("--disk-budget", args.disk_budget),
+                          ("--no-deps-cache", not args.deps_cache_dir),
+                          ("--no-git-mirrors", not args.git_mirror_dir),
+                          # This build updates the mirrors once for all of them
+                          ("--skip-git-mirror-update", True),
+                          ("--no-retry-failed-build", not args.retry_failed_build)):
+        if value:
+            forwarded.append(option)
+    for pattern in args.python_prune_patterns or []:
+        forwarded.extend(["--prune-python", pattern])
+    for git_url in args.git_urls:
+        forwarded.extend(["--git-url", git_url])
+    return forwarded
+
+
+def get_arch_env(arch):
+    # Each architecture has to find its own Homebrew first on the PATH, like ci/src/make-universal-build.sh does.
+    brew_prefix = ARCH_BREW_PREFIXES[arch]
+    return dict(os.environ,
+                PATH="{}/bin:{}".format(brew_prefix, os.environ["PATH"]),
+                CFLAGS="-I{}/include".format(brew_prefix),
+                CXXFLAGS="-I{}/include".format(brew_prefix),
+                WX_SKIP_DOXYGEN_VERSION_CHECK="true")
+
+
+def get_sub_build_trace_path(build_dir):
+    return os.path.join(build_dir, "trace.json")
+
+
+def get_sub_build_trace_events(trace, build_dirs):
+    # Adds the traces of the per-architecture builds to a universal build's trace, one process per build directory,
+    # on the universal build's clock.
+    events = []
+    for pid, build_dir in enumerate(build_dirs, start=2):
+        try:
+            with open(get_sub_build_trace_path(build_dir)) as f:
+                sub_trace = json.load(f)
+        except (OSError, ValueError):
+            continue
+        offset = int((sub_trace["otherData"]["start_time"] - trace.start_time) * 1000000)
+        for event in sub_trace["traceEvents"]:
+            event["pid"] = pid
+            if event["ph"] == "M":
+                event["args"]["name"] = os.path.basename(build_dir)
+            else:
+                event["ts"] += offset
+            events.append(event)
+    return events
+
+
+def get_universal_build_plan(args):
+    # Returns the stages of a universal build, in order.  Each stage is a list of (name, command, env, cwd) that can
+    # run at the same time.
+    build_py = os.path.abspath(__file__)
+    forwarded = get_forwarded_args(args)
+    shared_dir = os.path.join(args.build_dir, "shared")
+    universal_dir = os.path.join(args.build_dir, "universal")
+    arch_jobs = max(1, args.jobs // len(ARCH_BREW_PREFIXES))
+    # The package targets run on the merged bundle, after everything else
+    arch_targets = [target for target in args.target or [] if not target.startswith("package")]
+    package_targets = [target for target in args.target or [] if target.startswith("package")]
+
+    shared_stage = [("shared assets",
+                     [build_py, "--arch", "arm64", "--build-dir", shared_dir, "--jobs", str(args.jobs),
+                      "--target"] + SHARED_ASSET_TARGETS + forwarded,
+                     get_arch_env("arm64"), None)]
+    if args.trace:
+        shared_stage[0][1].extend(["--trace", get_sub_build_trace_path(shared_dir)])
+
+    arch_stage = []
+    for arch in ARCH_BREW_PREFIXES:
+        command = [build_py, "--arch", arch, "--build-dir", os.path.join(args.build_dir, arch),
+                   "--jobs", str(arch_jobs), "--shared-assets-dir", shared_dir] + forwarded
+        if args.adaptive_jobs:
+            # Both builds see the same free memory, so each gets half of it
+            command.extend(["--memory-budget", str(get_memory_budget(args) / 1024 ** 3 / len(ARCH_BREW_PREFIXES))])
+        if arch_targets:
+            command.extend(["--target"] + arch_targets)
+        if args.trace:
+            command.extend(["--trace", get_sub_build_trace_path(os.path.join(args.build_dir, arch))])
+        if arch == "x86_64":
+            command = ["arch", "-x86_64"] + command
+        arch_stage.append((arch, command, get_arch_env(arch), None))
+
+    thin_stage = []
+    for arch in ARCH_BREW_PREFIXES:
+        thin_stage.append(("thin {}".format(arch),
+                           ["ditto", "--arch", arch, os.path.join(args.build_dir, arch, "kicad-dest"),
+                            os.path.join(universal_dir, "thinned-{}".format(arch))],
+                           None, None))
+
+    bin_dir = os.path.join(args.kicad_mac_builder_cmake_dir, "bin")
+    merge_stage = [("merge",
+                    [os.path.join(bin_dir, "universal.py"),
+                     "--jobs", str(args.jobs),
+                     "--report", os.path.join(universal_dir, "merge-report.json"),
+                     os.path.join(universal_dir, "thinned-arm64"),
+                     os.path.join(universal_dir, "thinned-x86_64"),
+                     os.path.join(universal_dir, "dest")],
+                    None, None)]
+
+    sign_stage = [("ad-hoc sign",
+                   [os.path.join(bin_dir, "apple.py"), "sign",
+                    "--certificate-id", "-",
+                    "--jobs", str(args.jobs),
+                    "--entitlements", os.path.join(args.kicad_mac_builder_cmake_dir, "signing", "entitlements.plist"),
+                    os.path.join(universal_dir, "dest", "KiCad.app")],
+                   None, None)]
+
+    stages = [shared_stage, arch_stage, thin_stage, merge_stage, sign_stage]
+    if package_targets:
+        stages.append(get_universal_package_stage(args, package_targets))
+    return stages
+
+
+def get_universal_package_stage(args, package_targets):
+    # The package targets, run on universal/dest the way their ExternalProjects run on kicad-dest
+    bin_dir = os.path.join(args.kicad_mac_builder_cmake_dir, "bin")
+    dest_dir = os.path.join(args.build_dir, "universal", "dest")
+    dmg_dir = args.dmg_dir or os.path.join(args.build_dir, "dmg")
+    stage = []
+    for target in package_targets:
+        if target == "package-kicad-unified":
+            env = dict(os.environ,
+                       VERBOSE="1",
+                       PACKAGING_DIR=os.path.join(args.kicad_mac_builder_cmake_dir, "unified-packaging"),
+                       KICAD_SOURCE_DIR=args.kicad_source_dir or os.path.join(args.build_dir, "arm64", "kicad", "src",
+                                                                              "kicad"),
+                       KICAD_INSTALL_DIR=dest_dir,
+                       TEMPLATE="kicadtemplate.dmg",
+                       PACKAGE_TYPE="unified",
+                       DMG_DIR=dmg_dir,
+                       RELEASE_NAME=args.release_name or "",
+                       SIGNING_IDENTITY=args.signing_identity or "",
+                       APPLE_DEVELOPER_USERNAME="",
+                       APPLE_DEVELOPER_PASSWORD_KEYCHAIN_NAME="",
+                       DMG_NOTARIZATION_ID="",
+                       ASC_PROVIDER="")
+            # package.sh makes its template and mountpoint in the directory it runs in
+            stage.append((target, [os.path.join(bin_dir, "package.sh")], env,
+                          os.path.join(args.build_dir, "universal", "package")))
+        elif target == "package-kicad-delta":
+            command = [os.path.join(bin_dir, "delta.py"), "package",
+                       "--base-dir", args.delta_base_dir or os.path.join(args.build_dir, "delta-base"),
+                       "--output-dir", dmg_dir]
+            if args.release_name:
+                command.extend(["--name", args.release_name])
+            stage.append((target, command + [dest_dir], None, None))
+    return stage
+
+
+def stop_process_group(process):
+    # Each command runs in its own session, so this reaches everything it started, like a build.py's make
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def run_concurrently(stage):
+    # Starts every command in the stage, and waits for all of them.  If one fails, or this is interrupted, the others
+    # are stopped.  Returns the (name, start time, end time) of each command, for tracing.
+    processes = []
+    timings = []
+    try:
+        for name, command, env, cwd in stage:
+            print("Starting {}: {}".format(name, " ".join(command)), flush=True)
+            if cwd:
+                os.makedirs(cwd, exist_ok=True)
+            processes.append((name, subprocess.Popen(command, env=env, cwd=cwd, start_new_session=True),
+                              time.monotonic()))
+        wall_start_time = time.time()
+
+        failed = None
+        while processes:
+            for entry in list(processes):
+                name, process, start_time = entry
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                processes.remove(entry)
+                timings.append((name, wall_start_time, time.time()))
+                print("{} finished with exit status {} after {:.0f} seconds.".format(
+                    name, returncode, time.monotonic() - start_time), flush=True)
+                if returncode != 0 and failed is None:
+                    failed = (name, returncode)
+                    for _, other, _ in processes:
+                        stop_process_group(other)
+            time.sleep(0.5)
+    except BaseException:
+        for _, process, _ in processes:
+            stop_process_group(process)
+        raise
+
+    if failed is not None:
+        raise subprocess.CalledProcessError(failed[1], failed[0])
+    return timings
+
+
+def prune_after_universal_stage(args, names):
+    # With --disk-budget, removes what a universal build's stage was the last to use: the trees of the shared assets
+    # once both architectures have staged them, and the thinned bundles once they're merged.
+    if set(ARCH_BREW_PREFIXES) <= set(names):
+        shared_dir = os.path.join(args.build_dir, "shared")
+        for project in SHARED_ASSET_TARGETS:
+            if project in DISK_BUDGET_PRUNABLE and \
+                    os.path.isdir(os.path.join(shared_dir, get_disk_budget_stamp_dir(project))):
+                prune_project(shared_dir, project)
+    if "merge" in names:
+        for arch in ARCH_BREW_PREFIXES:
+            shutil.rmtree(os.path.join(args.build_dir, "universal", "thinned-{}".format(arch)), ignore_errors=True)
+
+
+def build_universal(args):
+    start_time = time.monotonic()
+    universal_dir = os.path.join(args.build_dir, "universal")
+    # ditto and universal.py want fresh output directories
+    subprocess.check_call(["rm", "-rf", universal_dir])
+    os.makedirs(universal_dir)
+
+    if args.git_mirror_dir and not args.skip_git_mirror_update:
+        get_git_repositories(args)
+
+    trace = BuildTrace() if args.trace else None
+    disk_monitor = None
+    if args.disk_budget:
+        disk_monitor = DiskUsageMonitor(args.build_dir)
+        disk_monitor.start()
+    try:
+        for stage in get_universal_build_plan(args):
+            try:
+                timings = run_concurrently(stage)
+            except subprocess.CalledProcessError:
+                print("Error during the universal build. Please report this issue if you cannot fix it after reading "
+                      "the README.", flush=True)
+                print_summary(args)
+                raise
+            if trace:
+                for name, stage_start_time, stage_end_time in timings:
+                    trace.add_span(name, stage_start_time, stage_end_time, "step")
+            if args.disk_budget:
+                prune_after_universal_stage(args, [name for name, command, env, cwd in stage])
+    finally:
+        if disk_monitor:
+            disk_monitor.stop()
+            print("Disk usage peaked at {:.1f} GB more than when the universal build started.".format(
+                disk_monitor.get_peak_growth() / 1024 ** 3), flush=True)
+        if trace:
+            sub_build_dirs = [os.path.join(args.build_dir, name) for name in ["shared"] + list(ARCH_BREW_PREFIXES)]
+            trace.write(args.trace, get_sub_build_trace_events(trace, sub_build_dirs))
+            print("Wrote a trace of the build to {}".format(args.trace), flush=True)
+
+    print("Universal build took {:.0f} seconds.".format(time.monotonic() - start_time), flush=True)
+    print("The ad-hoc signed Universal KiCad.app is in {}.".format(os.path.join(universal_dir, "dest")), flush=True)
+    if any(target.startswith("package-") for target in args.target or []):
+        print("Output DMGs should be located in {}".format(args.dmg_dir or os.path.join(args.build_dir, "dmg")),
+              flush=True)
+
+
 def print_summary(args):
     print("build.py argument summary:", flush=True)
     for attr in sorted(args.__dict__):
@@ -401,10 +2012,21 @@ def print_summary(args):
 
 def main():
     parsed_args = parse_args(sys.argv[1:])
+    if parsed_args.perf_report:
+        if not parsed_args.perf_history:
+            print("--perf-report can't be used with --no-perf-history.", flush=True)
+            sys.exit(2)
+        sys.exit(1 if perf_report(parsed_args) else 0)
+
     print_summary(parsed_args)
 
-    which_brew = subprocess.check_output("which brew", shell=True).decode('utf-8').strip()
-    brew_prefix = subprocess.check_output("brew --prefix", shell=True).decode('utf-8').strip()
+    if parsed_args.arch == "universal":
+        # Each per-architecture build.py checks its own Homebrew
+        build_universal(parsed_args)
+        return
+
+    which_brew = get_host_probe("which_brew")
+    brew_prefix = get_host_probe("brew_prefix")
 
     print(f"The detected host architecture is {get_host_architecture()}")
     print(f"The output of 'arch' is '{get_env_architecture()}'")
@@ -446,8 +2068,8 @@ def main():
             sys.exit(1)
 
 
-    gettext_path = "{}/bin".format(subprocess.check_output("brew --prefix gettext", shell=True).decode('utf-8').strip())
-    bison_path = "{}/bin".format(subprocess.check_output("brew --prefix bison", shell=True).decode('utf-8').strip())
+    gettext_path = "{}/bin".format(get_host_probe("gettext_prefix"))
+    bison_path = "{}/bin".format(get_host_probe("bison_prefix"))
     new_path = ":".join((gettext_path, bison_path, os.environ["PATH"]))
     print(f"Updated PATH is: {new_path}")
 
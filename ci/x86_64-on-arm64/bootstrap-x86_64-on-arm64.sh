@@ -17,9 +17,7 @@ set -e
 # After running this script, you could set up CLion, for instance, with
 # arch -x86_64 ./build.py --target setup-kicad-dependencies
 # checking out KiCad, opening it in Intel CLion (I am not sure if the Apple Silicon CLion will work), copying the CMake arguments in, and then doing Build > Install in CLion.
-# To do a regular package build using kicad-mac-builder, you'll need to install dyldstyle to get wrangle-bundle, which you can do with `ci/src/get-wrangle-bundle.sh`.
-# Add it to your PATH, so `wrangle-bundle` works at the CLI.
-# Then you can use build.py like:
+# To do a regular package build using kicad-mac-builder, you can use build.py like:
 # `arch -x86_64 ./build.py --target kicad`
 
 SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import os.path
 import plistlib
+import subprocess
 
 #
 # Example settings file for dmgbuild
@@ -42,12 +43,13 @@ def icon_from_app(app_path):
 # Volume format (see hdiutil create -help)
 format = defines.get('format', 'UDRW') # lets us resize the image
 
-# Volume size
-size = '9g'
-
 # Files to include
 files = [ "KiCad", "demos" ]
 
+# Volume size, worked out from the files that go in it
+size = defines.get('size') or subprocess.check_output(
+    [os.path.join('..', 'kicad-mac-builder', 'bin', 'dmgsize.py'), '--format', 'dmgbuild'] + files).decode('utf-8').strip()
+
 # Symlinks to create
 symlinks = { 'Applications': '/Applications' }
 
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
+import abc
 import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import json
 import logging
 import os
+import random
+import shlex
 import subprocess
+import tempfile
 import time
 import sys
 
@@ -20,110 +28,308 @@ import sys
 logging.basicConfig(level=logging.DEBUG)
 
 
+MACHO_MAGICS = {
+    b"\xfe\xed\xfa\xce", b"\xce\xfa\xed\xfe",  # 32-bit, big and little endian
+    b"\xfe\xed\xfa\xcf", b"\xcf\xfa\xed\xfe",  # 64-bit, big and little endian
+}
+FAT_MAGICS = {b"\xca\xfe\xba\xbe", b"\xca\xfe\xba\xbf"}  # fat and fat64, always big endian
+ARCHIVE_MAGIC = b"!<arch>\n"
+
+NOTARIZATION_STATE_VERSION = 1
+NOTARY_IN_PROGRESS = "In Progress"
+NOTARY_ACCEPTED = "Accepted"
+# How many status checks in a row can fail, like when the network drops, before we give up on a submission
+MAX_STATUS_FAILURES = 5
+
+MH_OBJECT = 0x1
+MH_EXECUTE = 0x2
+
+BUNDLE_EXTENSIONS = {".app": "apps", ".framework": "frameworks"}
+
+# Big, plentiful files that are never code.  Skipping them is only an optimization so we don't open every 3D model;
+# everything else is classified by reading its header.
+DATA_EXTENSIONS = {".step", ".stp", ".wrl", ".kicad_mod", ".kicad_sym", ".kicad_pcb", ".kicad_sch", ".kicad_pro",
+                   ".kicad_wks", ".png", ".svg", ".html", ".pdf", ".epub", ".mo", ".py", ".pyc", ".h", ".txt"}
+
+
+def get_macho_category(path):
+    # Returns the signing category for a file based on its magic bytes, or None if it isn't code.
+    try:
+        with open(path, "rb") as f:
+            header = f.read(16)
+            magic = header[:4]
+            if header[:8] == ARCHIVE_MAGIC:
+                return "archives"
+            if magic in FAT_MAGICS:
+                nfat_arch = int.from_bytes(header[4:8], "big")
+                # Java class files share the fat magic; their "nfat_arch" is the class file version, which is >= 45
+                if nfat_arch == 0 or nfat_arch >= 45:
+                    return None
+                # Classify by the first architecture; the others are the same kind of file
+                f.seek(8)
+                fat_arch = f.read(32 if magic == b"\xca\xfe\xba\xbf" else 20)
+                offset_field = fat_arch[8:16] if magic == b"\xca\xfe\xba\xbf" else fat_arch[8:12]
+                f.seek(int.from_bytes(offset_field, "big"))
+                header = f.read(16)
+                magic = header[:4]
+            if magic not in MACHO_MAGICS or len(header) < 16:
+                return None
+    except OSError:
+        return None
+
+    byteorder = "big" if magic.startswith(b"\xfe\xed") else "little"
+    filetype = int.from_bytes(header[12:16], byteorder)
+    if filetype == MH_EXECUTE:
+        return "executables"
+    if filetype == MH_OBJECT:
+        return "objects"
+    return "libraries"
+
+
+def is_python_framework_script(path, st):
+    # The scripts in Python.framework/Versions/*/bin, like pip3, idle3 and wxdemo, aren't Mach-O, but they're signed
+    # like the framework's executables are.
+    parts = os.path.normpath(path).split(os.sep)
+    return len(parts) >= 5 and parts[-2] == "bin" and parts[-4] == "Versions" and parts[-5] == "Python.framework" and \
+        bool(st.st_mode & 0o111)
+
+
 def get_kicad_paths_for_signing(dotapp_path):
+    # Walks the bundle once, depth first, and returns every Mach-O file, static archive, nested .app and .framework,
+    # and the scripts in Python.framework, in the order they should be signed (inside out), along with a breakdown of
+    # the paths by category.  Symlinks aren't followed, so each file is only found once, through its real location.
     to_sign = []
+    categories = {}
+
+    def add(path, category):
+        to_sign.append(path)
+        categories.setdefault(category, []).append(path)
+
+    def walk(directory):
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir():
+                if entry.name == "_CodeSignature":
+                    continue
+                walk(entry.path)
+                bundle_category = BUNDLE_EXTENSIONS.get(os.path.splitext(entry.name)[1])
+                if bundle_category:
+                    add(entry.path, bundle_category)
+            elif entry.is_file():
+                if os.path.splitext(entry.name)[1].lower() in DATA_EXTENSIONS:
+                    continue
+                category = get_macho_category(entry.path)
+                if category:
+                    add(entry.path, category)
+                elif is_python_framework_script(entry.path, entry.stat()):
+                    add(entry.path, "scripts")
+
+    walk(dotapp_path)
+    add(dotapp_path, "apps")
+
+    return to_sign, categories
+
+
+def get_signing_dependencies(paths):
+    # Builds the inside-out containment DAG for the paths to sign.  Each path is mapped to the nearest path in the list
+    # that contains it (its bundle), and each bundle is mapped to the set of paths it directly contains.
+    # A bundle can only be signed after everything inside it has been signed, because signing a bundle seals its contents.
+    ordered = list(dict.fromkeys(os.path.normpath(path) for path in paths))
+    path_set = set(ordered)
+
+    parents = {}
+    children = {path: set() for path in ordered}
+    for path in ordered:
+        parent = None
+        ancestor = os.path.dirname(path)
+        while ancestor and ancestor != os.path.dirname(ancestor):
+            if ancestor in path_set:
+                parent = ancestor
+                break
+            ancestor = os.path.dirname(ancestor)
+        parents[path] = parent
+        if parent is not None:
+            children[parent].add(path)
+
+    return ordered, parents, children
+
+
+def sign_paths(paths, jobs, sign_func):
+    # Calls sign_func on each path, using up to jobs worker threads.  Paths that don't contain each other are signed
+    # concurrently, but a path is never signed until all of the paths inside of it have been signed.
+    ordered, parents, children = get_signing_dependencies(paths)
+    remaining = {path: len(children[path]) for path in ordered}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        running = {}
+        for path in ordered:
+            if remaining[path] == 0:
+                running[executor.submit(sign_func, path)] = path
+
+        failed = None
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    # Let the in-flight signatures finish, but don't start any new ones
+                    if failed is None:
+                        failed = future
+                    continue
+                parent = parents[path]
+                if parent is None or failed is not None:
+                    continue
+                remaining[parent] -= 1
+                if remaining[parent] == 0:
+                    running[executor.submit(sign_func, parent)] = parent
+
+        if failed is not None:
+            failed.result()
+
+
+def get_signing_manifest_path(dotapp_path):
+    # The manifest lives next to the bundle, not inside it, since anything inside the bundle is sealed by the signature.
+    # It is hidden so that package.sh's `rsync -al "${KICAD_INSTALL_DIR}"/*` doesn't copy it into the DMG.
+    dotapp_path = os.path.normpath(dotapp_path)
+    return os.path.join(os.path.dirname(dotapp_path), ".{}.signing-manifest.json".format(os.path.basename(dotapp_path)))
+
+
+def load_signing_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != 1:
+        return {}
+    return manifest.get("entries", {})
+
+
+def write_signing_manifest(manifest_path, entries):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": 1, "entries": entries}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_content_state(path, previous_state=None):
+    # Files are identified by their content hash, but we only rehash when the size or mtime has changed.
+    # Bundles and other directories are identified by a hash of the names, sizes and mtimes of everything inside them,
+    # which changes whenever anything in them is rebuilt or re-signed.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(root, filename)
+                try:
+                    file_st = os.lstat(file_path)
+                except OSError:
+                    continue
+                digest.update("{}\0{}\0{}\n".format(os.path.relpath(file_path, path),
+                                                      file_st.st_size,
+                                                      file_st.st_mtime_ns).encode("utf-8"))
+        return {"tree_sha256": digest.hexdigest()}
+
+    if previous_state and previous_state.get("size") == st.st_size and previous_state.get("mtime_ns") == st.st_mtime_ns:
+        return previous_state
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": hash_file(path)}
+
+
+def get_content_identity(state):
+    # What a content state says about the content itself.  A file's mtime only tells us when it needs rehashing, so a
+    # file that was touched but not changed isn't signed again.
+    return {key: state[key] for key in ("size", "sha256", "tree_sha256") if key in state}
+
+
+def get_signing_inputs(key_label, hardened_runtime, secure_timestamp, entitlements_path=None):
+    return {"identity": key_label,
+            "entitlements_sha256": hash_file(entitlements_path) if entitlements_path else None,
+            "hardened_runtime": bool(hardened_runtime),
+            "timestamp": bool(secure_timestamp)}
+
+
+def get_content_states(paths, previous_entries, base_dir, jobs):
+    def state_for(path):
+        previous = previous_entries.get(os.path.relpath(path, base_dir), {})
+        return get_content_state(path, previous.get("content"))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return dict(zip(paths, executor.map(state_for, paths)))
+
+
+def get_paths_needing_signing(paths, previous_entries, base_dir, inputs, jobs):
+    # A path needs signing if it changed, if it was signed differently, or if anything inside of it needs signing.
+    ordered, parents, _ = get_signing_dependencies(paths)
+    states = get_content_states(ordered, previous_entries, base_dir, jobs)
+
+    dirty = set()
+    for path in ordered:
+        previous = previous_entries.get(os.path.relpath(path, base_dir))
+        if previous is None or previous.get("inputs") != inputs or states[path] is None or \
+                get_content_identity(previous.get("content") or {}) != get_content_identity(states[path]):
+            dirty.add(path)
 
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/eeschema.app/Contents/MacOS/eeschema"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/eeschema.app"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/gerbview.app/Contents/MacOS/gerbview"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/gerbview.app"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/pcbnew.app/Contents/MacOS/pcbnew"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/pcbnew.app"))
-    to_sign.append(
-        os.path.join(dotapp_path, "Contents/Applications/bitmap2component.app/Contents/MacOS/bitmap2component"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/bitmap2component.app"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/pcb_calculator.app/Contents/MacOS/pcb_calculator"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/pcb_calculator.app"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/pl_editor.app/Contents/MacOS/pl_editor"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Applications/pl_editor.app"))
-
-    to_sign.append(os.path.join(dotapp_path,
-                                "Contents/Frameworks/Python.framework/Versions/Current/share/doc/python3.9/examples/Tools/pynche"))
-    to_sign.append(os.path.join(dotapp_path,
-                                "Contents/Frameworks/Python.framework/Versions/Current/Resources/Python.app/Contents/MacOS/Python"))
-
-    for root, dirnames, filenames in os.walk(
-            os.path.join(dotapp_path, "Contents/Frameworks/Python.framework/Versions/Current")):
-        for filename in filenames:
-            if filename.endswith(".so") or filename.endswith(".dylib") or filename.endswith(".a"):
-                to_sign.append(os.path.join(root, filename))
-
-    for x in ['2to3',
-              '2to3-3.9',
-              'helpviewer',
-              'idle3',
-              'idle3.9',
-              'img2png',
-              'img2py',
-              'img2xpm',
-              'normalizer',
-              'pip3',
-              'pip3.9',
-              'pycrust',
-              'pydoc3',
-              'pydoc3.9',
-              'pyshell',
-              'pyslices',
-              'pyslicesshell',
-              'python3',
-              'python3-config',
-              'python3-intel64',
-              'python3.9',
-              'python3.9-config',
-              'python3.9-intel64',
-              'pywxrc',
-              'wheel',
-              'wxdemo',
-              'wxdocs',
-              'wxget',
-              ]:
-        to_sign.append(
-            os.path.join(dotapp_path, f"Contents/Frameworks/Python.framework/Versions/Current/bin/{x}"))
-
-    to_sign.append(
-        os.path.join(dotapp_path, f"Contents/Frameworks/Python.framework/Versions/Current/lib/python3.9/config-3.9-darwin/python.o"))
-
-    to_sign.append(
-        os.path.join(dotapp_path, "Contents/Frameworks/Python.framework/Versions/Current/Resources/Python.app"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/Frameworks/Python.framework"))
-
-    for root, dirnames, filenames in os.walk(os.path.join(dotapp_path, "Contents/Frameworks")):
-        if "Python.framework" in root:
-            continue
-        for filename in filenames:
-            if filename.endswith(".dylib"):
-                to_sign.append(os.path.join(root, filename))
+    for path in list(dirty):
+        parent = parents[path]
+        while parent is not None and parent not in dirty:
+            dirty.add(parent)
+            parent = parents[parent]
+
+    return [path for path in ordered if path in dirty]
+
+
+def sign(dotapp_path, key_label, hardened_runtime, secure_timestamp, entitlements_path=None, jobs=1, full=False):
+    logging.info("Signing {}".format(dotapp_path))
+    start_time = time.monotonic()
 
-    for root, dirnames, filenames in os.walk(os.path.join(dotapp_path, "Contents/Resources")):
-        if "Python.framework" in root:
-            continue
-        for filename in filenames:
-            if filename.endswith(".so"):
-                to_sign.append(os.path.join(root, filename))
+    paths, categories = get_kicad_paths_for_signing(dotapp_path)
+    for category in sorted(categories):
+        logging.info("Found {} {}".format(len(categories[category]), category))
+    paths = get_signing_dependencies(paths)[0]
+    manifest_path = get_signing_manifest_path(dotapp_path)
+    base_dir = os.path.dirname(manifest_path)
+    inputs = get_signing_inputs(key_label, hardened_runtime, secure_timestamp, entitlements_path)
 
-    for root, dirnames, filenames in os.walk(os.path.join(dotapp_path, "Contents/PlugIns")):
-        if "Python.framework" in root:
-            continue
-        for filename in filenames:
-            to_sign.append(os.path.join(root, filename))
+    previous_entries = {} if full else load_signing_manifest(manifest_path)
+    to_sign = get_paths_needing_signing(paths, previous_entries, base_dir, inputs, jobs)
+    logging.info("Signing {} of {} paths".format(len(to_sign), len(paths)))
 
-    to_sign.append(os.path.join(dotapp_path, "Contents/MacOS/dxf2idf"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/MacOS/idf2vrml"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/MacOS/idfcyl"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/MacOS/idfrect"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/MacOS/kicad-cli"))
-    to_sign.append(os.path.join(dotapp_path, "Contents/MacOS/kicad"))
+    # If signing fails partway through, the old manifest no longer describes what's on disk.
+    if to_sign and os.path.exists(manifest_path):
+        os.remove(manifest_path)
 
-    to_sign.append(dotapp_path)
+    sign_paths(to_sign,
+               jobs,
+               lambda path: sign_file(path, key_label, hardened_runtime, secure_timestamp, entitlements_path))
 
-    return to_sign
+    # Signing a bundle rewrites its main executable, so we can only record states once everything has been signed.
+    states = get_content_states(paths, previous_entries, base_dir, jobs)
+    write_signing_manifest(manifest_path,
+                           {os.path.relpath(path, base_dir): {"content": states[path], "inputs": inputs}
+                            for path in paths if states[path] is not None})
 
-
-def sign(dotapp_path, key_label, hardened_runtime, secure_timestamp, entitlements_path=None):
-    logging.info("Signing {}".format(dotapp_path))
-    start_time = time.monotonic()
-    for path in get_kicad_paths_for_signing(dotapp_path):
-        sign_file(path, key_label, hardened_runtime, secure_timestamp, entitlements_path)
     elapsed_time = time.monotonic() - start_time
     logging.debug("Signing took {} seconds".format(elapsed_time))
 
@@ -142,36 +348,309 @@ def sign_file(path, key_label, hardened_runtime, secure_timestamp, entitlements_
     subprocess.run(cmd, check=True)
 
 
-def has_secure_timestamp(path):
-    logging.info("Checking {} has a secure timestamp".format(path))
+def get_signature_details(path):
+    # Parses the key=value lines `codesign -dvv` prints to stderr.  Keys that appear more than once, like Authority,
+    # are collected into lists.
     cmd = ["codesign", "-dvv", path]
     logging.debug("Running {}".format(" ".join(cmd)))
-    completed = subprocess.run(cmd, capture_output=True, check=True)
+    completed = subprocess.run(cmd, capture_output=True)
+    output = completed.stderr.decode("utf-8", errors="replace")
 
-    stderr = completed.stderr.decode('utf-8')
-    if "Signed Time" in stderr:
-        return False
-    if "Timestamp=" not in stderr:
-        return False
-    return True
+    details = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition("=")
+        if not sep:
+            continue
+        if key in details:
+            if not isinstance(details[key], list):
+                details[key] = [details[key]]
+            details[key].append(value)
+        else:
+            details[key] = value
+    return completed.returncode, details, output
 
-def verify_signing(dotapp_path, verify_timestamps=True):
-    logging.info("Verifying signing of {}".format(dotapp_path))
-    logging.debug("Verifying with --strict")
-    cmd = ["codesign", "-vvv", "--deep", "--strict", dotapp_path]
+
+def has_secure_timestamp(details):
+    return "Timestamp" in details and "Signed Time" not in details
+
+
+def verify_path(path, verify_timestamp):
+    # Verifies one signed path, and returns a dict describing its signature and anything wrong with it.
+    result = {"path": path, "errors": []}
+
+    cmd = ["codesign", "--verify", "--strict", "-vv", path]
     logging.debug("Running {}".format(" ".join(cmd)))
-    subprocess.run(cmd, check=True)
+    completed = subprocess.run(cmd, capture_output=True)
+    if completed.returncode != 0:
+        result["errors"].append("codesign --verify failed: {}".format(
+            completed.stderr.decode("utf-8", errors="replace").strip()))
+
+    returncode, details, output = get_signature_details(path)
+    if returncode != 0:
+        result["errors"].append("codesign -dvv failed: {}".format(output.strip()))
+        return result
+
+    authority = details.get("Authority", [])
+    result["identifier"] = details.get("Identifier")
+    result["authority"] = authority if isinstance(authority, list) else [authority]
+    result["team_identifier"] = details.get("TeamIdentifier")
+    result["adhoc"] = details.get("Signature") == "adhoc"
+    result["hardened_runtime"] = "(runtime)" in output or ",runtime" in output
+    result["timestamp"] = details.get("Timestamp")
+
+    if verify_timestamp and not has_secure_timestamp(details):
+        result["errors"].append("does not have a secure timestamp")
 
-    if verify_timestamps:
-        check_timestamps = [dotapp_path]
-        with os.scandir(os.path.join(dotapp_path, "Contents", "MacOS")) as entries:
-            for entry in entries:
-                check_timestamps.append(entry.path)
-        for path in check_timestamps:
-            if not has_secure_timestamp(path):
-                raise Exception("{} does not have a secure timestamp".format(path))
-            else:
-                logging.debug("{} has a secure timestamp".format(path))
+    return result
+
+
+def get_verification_report_path(dotapp_path):
+    dotapp_path = os.path.normpath(dotapp_path)
+    return os.path.join(os.path.dirname(dotapp_path),
+                        ".{}.verification-report.json".format(os.path.basename(dotapp_path)))
+
+
+def verify_signing(dotapp_path, verify_timestamps=True, jobs=1, report_path=None):
+    # Verifies every path we sign, not just the top level bundle, using up to jobs codesign processes at a time.
+    # All of the results are written to a JSON report, and an exception is raised at the end if anything failed.
+    logging.info("Verifying signing of {}".format(dotapp_path))
+    start_time = time.monotonic()
+
+    paths = get_signing_dependencies(get_kicad_paths_for_signing(dotapp_path)[0])[0]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(lambda path: verify_path(path, verify_timestamps), paths))
+
+    failures = [result for result in results if result["errors"]]
+    report = {"bundle": os.path.normpath(dotapp_path),
+              "verify_timestamps": verify_timestamps,
+              "checked": len(results),
+              "failed": len(failures),
+              "failures": failures,
+              "results": results}
+
+    if report_path is None:
+        report_path = get_verification_report_path(dotapp_path)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=1)
+
+    elapsed_time = time.monotonic() - start_time
+    logging.debug("Verifying took {} seconds".format(elapsed_time))
+
+    for failure in failures:
+        for error in failure["errors"]:
+            logging.error("{}: {}".format(failure["path"], error))
+    if failures:
+        raise Exception("{} of {} signed paths failed verification. See {} for details.".format(
+            len(failures), len(results), report_path))
+    logging.info("Verified {} signed paths. Report written to {}".format(len(results), report_path))
+    return report
+
+
+class NotarizationError(Exception):
+    pass
+
+
+class NotaryClient(abc.ABC):
+    # The notary service, as notarize_paths uses it.  The methods are coroutines, so any number of submissions can be
+    # waited on at once.  NotarytoolClient talks to Apple; any other subclass, like a fake service, can stand in for it,
+    # but can't be created unless it implements all of them.
+
+    @abc.abstractmethod
+    async def submit(self, upload_path):
+        # Uploads a .zip, .dmg or .pkg, and returns the submission ID without waiting for the result.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_status(self, submission_id):
+        # Returns "In Progress", "Accepted", "Invalid" or "Rejected".
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_log(self, submission_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def staple(self, path):
+        raise NotImplementedError
+
+
+async def run_async(cmd, secret_args=()):
+    # Runs a command without blocking the event loop, and returns its stdout.  secret_args are left out of the log.
+    logging.debug("Running {}".format(" ".join(cmd)))
+    process = await asyncio.create_subprocess_exec(*cmd, *secret_args,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise NotarizationError("{} failed with exit status {}: {}".format(
+            " ".join(cmd), process.returncode, (stderr or stdout).decode("utf-8", errors="replace").strip()))
+    return stdout.decode("utf-8", errors="replace")
+
+
+class NotarytoolClient(NotaryClient):
+
+    def __init__(self, auth_args, notarytool=("xcrun", "notarytool"), stapler=("xcrun", "stapler")):
+        self.auth_args = list(auth_args)
+        self.notarytool = list(notarytool)
+        self.stapler = list(stapler)
+
+    async def run_json(self, *args):
+        output = await run_async(self.notarytool + list(args) + ["--output-format", "json"], self.auth_args)
+        try:
+            return json.loads(output)
+        except ValueError:
+            raise NotarizationError("Unexpected output from notarytool {}: {}".format(args[0], output))
+
+    async def submit(self, upload_path):
+        return (await self.run_json("submit", upload_path, "--no-wait"))["id"]
+
+    async def get_status(self, submission_id):
+        return (await self.run_json("info", submission_id))["status"]
+
+    async def get_log(self, submission_id):
+        return await run_async(self.notarytool + ["log", submission_id], self.auth_args)
+
+    async def staple(self, path):
+        await run_async(self.stapler + ["staple", path])
+        await run_async(self.stapler + ["validate", path])
+
+
+def get_keychain_password(item, account=None):
+    # Finds a password stored like `xcrun altool --store-password-in-keychain-item` or
+    # `security add-generic-password -s <item>` did.
+    cmd = ["security", "find-generic-password", "-s", item, "-w"]
+    if account:
+        cmd[3:3] = ["-a", account]
+    completed = subprocess.run(cmd, capture_output=True)
+    if completed.returncode != 0:
+        raise NotarizationError("Unable to find the keychain item {}: {}".format(
+            item, completed.stderr.decode("utf-8", errors="replace").strip()))
+    return completed.stdout.decode("utf-8").rstrip("\n")
+
+
+def get_notarization_state_path(path):
+    # Like the signing manifest, this lives next to what it describes, and is hidden so it isn't packaged.
+    path = os.path.normpath(path)
+    return os.path.join(os.path.dirname(path), ".{}.notarization.json".format(os.path.basename(path)))
+
+
+def load_notarization_state(state_path):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if state.get("version") != NOTARIZATION_STATE_VERSION:
+        return {}
+    return state
+
+
+def write_notarization_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(dict(state, version=NOTARIZATION_STATE_VERSION), f, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def get_backoff_delay(attempt, initial_interval, max_interval):
+    # Doubles each time, up to max_interval, and picks somewhere in the upper half of that at random, so submissions
+    # made at the same time don't all poll at the same time.
+    interval = min(max_interval, initial_interval * 2 ** attempt)
+    return random.uniform(interval / 2, interval)
+
+
+async def make_upload(path, tmp_dir):
+    # notarytool takes .dmg, .pkg and .zip files, so bundles are zipped with ditto, which keeps symlinks and the
+    # extended attributes signatures live in.
+    if not os.path.isdir(path):
+        return path
+    zip_path = os.path.join(tmp_dir, "{}.zip".format(os.path.basename(path)))
+    await run_async(["ditto", "-c", "-k", "--keepParent", path, zip_path])
+    return zip_path
+
+
+async def wait_for_notarization(client, path, submission_id, initial_interval, max_interval, timeout):
+    # Polls until the submission isn't in progress anymore, and returns its status.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempt = 0
+    failures = 0
+    while True:
+        try:
+            status = await client.get_status(submission_id)
+            failures = 0
+        except NotarizationError as e:
+            failures += 1
+            if failures >= MAX_STATUS_FAILURES:
+                raise
+            logging.warning("Unable to check on {}, will try again: {}".format(path, e))
+            status = NOTARY_IN_PROGRESS
+        if status != NOTARY_IN_PROGRESS:
+            return status
+
+        delay = get_backoff_delay(attempt, initial_interval, max_interval)
+        attempt += 1
+        if loop.time() + delay > deadline:
+            raise NotarizationError("{} (submission {}) is still in progress after {:.0f} seconds. Run notarize again "
+                                    "to keep waiting for it.".format(path, submission_id, timeout))
+        logging.info("{} is still in progress, checking again in {:.0f} seconds".format(path, delay))
+        await asyncio.sleep(delay)
+
+
+async def notarize_path(client, path, notarization_id=None, wait=True, initial_interval=15, max_interval=300,
+                        timeout=3600):
+    # Submits path, or resumes waiting on the submission an earlier run made for the same content, then staples it.
+    start_time = time.monotonic()
+    loop = asyncio.get_running_loop()
+    state_path = get_notarization_state_path(path)
+    state = load_notarization_state(state_path)
+    # Hashing a DMG takes a while, so don't hold up the other submissions
+    content = await loop.run_in_executor(None, get_content_state, path, state.get("stapled_content"))
+
+    if content is not None and content == state.get("stapled_content"):
+        logging.info("{} is already notarized and stapled".format(path))
+        return
+    if content is not None and content == state.get("content") and \
+            state.get("status") in (NOTARY_IN_PROGRESS, NOTARY_ACCEPTED):
+        logging.info("Resuming submission {} of {}".format(state["id"], path))
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            upload_path = await make_upload(path, tmp_dir)
+            logging.info("Submitting {} for notarization".format(path))
+            submission_id = await client.submit(upload_path)
+        state = {"path": os.path.abspath(path),
+                 "notarization_id": notarization_id,
+                 "content": content,
+                 "id": submission_id,
+                 "status": NOTARY_IN_PROGRESS,
+                 "submitted_at": time.time()}
+        write_notarization_state(state_path, state)
+        logging.info("Submitted {} as {}".format(path, submission_id))
+
+    if not wait:
+        return
+
+    state["status"] = await wait_for_notarization(client, path, state["id"], initial_interval, max_interval, timeout)
+    write_notarization_state(state_path, state)
+    if state["status"] != NOTARY_ACCEPTED:
+        log = await client.get_log(state["id"])
+        raise NotarizationError("Notarization of {} (submission {}) finished with status {}:\n{}".format(
+            path, state["id"], state["status"], log))
+
+    await client.staple(path)
+    state["stapled_content"] = await loop.run_in_executor(None, get_content_state, path)
+    write_notarization_state(state_path, state)
+    logging.info("Notarized and stapled {} in {:.0f} seconds".format(path, time.monotonic() - start_time))
+
+
+async def notarize_paths(client, paths, **kwargs):
+    # Notarizes all of the paths at once.  One failing doesn't stop the others, but raises once they're all done.
+    results = await asyncio.gather(*(notarize_path(client, path, **kwargs) for path in paths),
+                                   return_exceptions=True)
+    failures = [(path, result) for path, result in zip(paths, results) if isinstance(result, Exception)]
+    for path, error in failures:
+        logging.error("{}: {}".format(path, error))
+    if failures:
+        raise NotarizationError("{} of {} paths failed notarization.".format(len(failures), len(paths)))
 
 
 def parse_args(arg_list=sys.argv[1:]):
@@ -197,23 +676,114 @@ def parse_args(arg_list=sys.argv[1:]):
     sign_parser.add_argument("--timestamp",
                              action="store_true",
                              help="Enable Secure Timestamps.")
+    sign_parser.add_argument("--jobs",
+                             type=int,
+                             default=os.cpu_count() or 1,
+                             help="Number of codesign processes to run at once. Nested bundles are still signed "
+                                  "after their contents. Defaults to the number of cores.")
+    sign_parser.add_argument("--full",
+                             action="store_true",
+                             help="Re-sign everything, even paths that haven't changed since they were last signed.")
+    sign_parser.add_argument("--verification-report",
+                             help="Where to write the JSON verification report. Defaults to a hidden file next to "
+                                  "the .app.")
     sign_parser.add_argument("path", help="Path to the .app")
 
+    verify_parser = subparsers.add_parser('verify')
+    verify_parser.add_argument("--no-timestamps",
+                               action="store_false",
+                               dest="verify_timestamps",
+                               help="Don't require secure timestamps, like for ad-hoc signatures.")
+    verify_parser.add_argument("--jobs",
+                               type=int,
+                               default=os.cpu_count() or 1,
+                               help="Number of codesign processes to run at once. Defaults to the number of cores.")
+    verify_parser.add_argument("--report",
+                               help="Where to write the JSON verification report. Defaults to a hidden file next to "
+                                    "the .app.")
+    verify_parser.add_argument("path", help="Path to the .app")
+
+    notarize_parser = subparsers.add_parser('notarize')
+    notarize_parser.add_argument("--keychain-profile",
+                                 help="notarytool credentials profile, from `xcrun notarytool store-credentials`. "
+                                      "Used instead of the username, password and team ID.")
+    notarize_parser.add_argument("--apple-developer-username", help="Apple ID to submit as.")
+    notarize_parser.add_argument("--apple-developer-password-keychain-name", "--apple-developer-password-handle",
+                                 dest="apple_developer_password_keychain_name",
+                                 help="Name of the keychain item with the Apple ID's app-specific password.")
+    notarize_parser.add_argument("--asc-provider", help="Team ID to submit for.")
+    notarize_parser.add_argument("--notarization-id",
+                                 help="Identifier to record with the submission, like org.kicad.kicad. notarytool "
+                                      "doesn't need one.")
+    notarize_parser.add_argument("--no-wait",
+                                 action="store_false",
+                                 dest="wait",
+                                 help="Submit, but don't wait for the results. Run notarize again later to wait for "
+                                      "them and staple.")
+    notarize_parser.add_argument("--poll-interval",
+                                 type=float,
+                                 default=15,
+                                 help="Seconds to wait before checking on a submission the first time. The wait "
+                                      "doubles after each check. Defaults to 15.")
+    notarize_parser.add_argument("--max-poll-interval",
+                                 type=float,
+                                 default=300,
+                                 help="Longest to wait between checks, in seconds. Defaults to 300.")
+    notarize_parser.add_argument("--timeout",
+                                 type=float,
+                                 default=3600,
+                                 help="Seconds to wait for results before giving up. The submissions are remembered, "
+                                      "so running notarize again picks up where this left off. Defaults to 3600.")
+    notarize_parser.add_argument("--notarytool",
+                                 default="xcrun notarytool",
+                                 help="Command to run notarytool with, like a fake notary service for testing. "
+                                      "Defaults to `xcrun notarytool`.")
+    notarize_parser.add_argument("--stapler",
+                                 default="xcrun stapler",
+                                 help="Command to run stapler with. Defaults to `xcrun stapler`.")
+    notarize_parser.add_argument("paths", nargs="+", help="Paths to the .apps and .dmgs to notarize, all at once")
+
     args = parser.parse_args(arg_list)
 
     if args.verbose and args.quiet:
         raise argparse.ArgumentError("--verbose and --quiet cannot be specified at the same time.")
 
+    if args.subparser_name == "notarize" and not args.keychain_profile and \
+            not (args.apple_developer_username and args.apple_developer_password_keychain_name and args.asc_provider):
+        parser.error("notarize needs either --keychain-profile, or --apple-developer-username, "
+                     "--apple-developer-password-keychain-name and --asc-provider.")
+
     return args
 
 
-def handle_signing(dotapp_path, certificate_hex_id, hardened_runtime, secure_timestamp, entitlements_path):
-    sign(dotapp_path, certificate_hex_id, hardened_runtime, secure_timestamp, entitlements_path)
+def handle_signing(dotapp_path, certificate_hex_id, hardened_runtime, secure_timestamp, entitlements_path, jobs=1,
+                   full=False, report_path=None):
+    sign(dotapp_path, certificate_hex_id, hardened_runtime, secure_timestamp, entitlements_path, jobs, full)
     # Ad-hoc signatures don't seem to be able to keep secure timestamps...
     verify_signing(dotapp_path,
-                   verify_timestamps=certificate_hex_id != "-")
+                   verify_timestamps=certificate_hex_id != "-",
+                   jobs=jobs,
+                   report_path=report_path)
     print("Done. Signed and verified {}".format(dotapp_path))
 
+
+def handle_notarization(args):
+    if args.keychain_profile:
+        auth_args = ["--keychain-profile", args.keychain_profile]
+    else:
+        auth_args = ["--apple-id", args.apple_developer_username,
+                     "--team-id", args.asc_provider,
+                     "--password", get_keychain_password(args.apple_developer_password_keychain_name,
+                                                         args.apple_developer_username)]
+    client = NotarytoolClient(auth_args, shlex.split(args.notarytool), shlex.split(args.stapler))
+    asyncio.run(notarize_paths(client,
+                               args.paths,
+                               notarization_id=args.notarization_id,
+                               wait=args.wait,
+                               initial_interval=args.poll_interval,
+                               max_interval=args.max_poll_interval,
+                               timeout=args.timeout))
+
 def main():
     args = parse_args()
     if args.verbose:
@@ -225,13 +795,29 @@ def main():
 
     if "path" in args and args.path.endswith(".app/"):
         args.path = args.path[:-1]
+    if "paths" in args:
+        args.paths = [path[:-1] if path.endswith(".app/") else path for path in args.paths]
 
     if args.subparser_name == "sign":
         handle_signing(args.path,
                        args.certificate_id,
                        args.hardened_runtime,
                        args.timestamp,
-                       args.entitlements)
+                       args.entitlements,
+                       args.jobs,
+                       args.full,
+                       args.verification_report)
+    elif args.subparser_name == "verify":
+        verify_signing(args.path,
+                       verify_timestamps=args.verify_timestamps,
+                       jobs=args.jobs,
+                       report_path=args.report)
+    elif args.subparser_name == "notarize":
+        try:
+            handle_notarization(args)
+        except NotarizationError as e:
+            logging.error(str(e))
+            sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Replaces byte-identical files in the libraries staged into KiCad.app, like the .step and .wrl files shared by many
+# 3D model variants, with links to a single copy.  Files are grouped by size first, so only files that could be
+# duplicates are hashed, and the hashes are kept in a cache so a rebuild only hashes files that changed.
+
+# Duplicates become relative symlinks by default, since package.sh copies the bundle into the DMG with `rsync -al`,
+# which keeps symlinks but not hardlinks.  Links are only made within each root, so each root can be restaged on its
+# own.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+CACHE_VERSION = 1
+# A symlink takes a whole allocation block in the image, so replacing anything smaller than one saves nothing
+DEFAULT_MIN_SIZE = 4096
+EMPTY_SHA256 = hashlib.sha256().hexdigest()
+
+
+def hash_file(path):
+    # Maps the file rather than reading it in blocks, which saves a copy, and hashlib releases the GIL while it works
+    # through the mapping, so a thread pool keeps every core busy.
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return EMPTY_SHA256
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+
+def walk_files(root):
+    # Returns {path: os.stat_result} for the regular files under root, without following symlinks.
+    files = {}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files[entry.path] = entry.stat(follow_symlinks=False)
+    return files
+
+
+def load_cache(cache_path):
+    if not cache_path:
+        return {"hashes": {}, "links": {}}
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if cache.get("version") != CACHE_VERSION:
+        cache = {}
+    return {"hashes": cache.get("hashes", {}), "links": cache.get("links", {})}
+
+
+def write_cache(cache_path, hashes, links):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": CACHE_VERSION, "hashes": hashes, "links": links}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def get_library(root, path):
+    # Which library a file belongs to, for the report, like 3dmodels/Resistor_SMD.3dshapes
+    relative_path = os.path.relpath(path, root)
+    parts = relative_path.split(os.sep)
+    return "/".join([os.path.basename(root)] + parts[:1 if len(parts) > 1 else 0])
+
+
+def replace_with_link(canonical, duplicate, link_type):
+    # Swaps the duplicate for a link in one rename, so nothing ever sees the file missing
+    tmp_path = os.path.join(os.path.dirname(duplicate), ".{}.dedupe-tmp".format(os.path.basename(duplicate)))
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    if link_type == "symlink":
+        os.symlink(os.path.relpath(canonical, os.path.dirname(duplicate)), tmp_path)
+    else:
+        os.link(canonical, tmp_path)
+    os.replace(tmp_path, duplicate)
+
+
+def link_is_intact(path, canonical, link_type):
+    try:
+        if link_type == "symlink":
+            return os.path.islink(path) and \
+                os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path))) == canonical and \
+                os.path.isfile(canonical) and not os.path.islink(canonical)
+        return not os.path.islink(path) and os.path.samefile(path, canonical)
+    except OSError:
+        return False
+
+
+def dedupe(roots, link_type="symlink", cache_path=None, jobs=None, min_size=DEFAULT_MIN_SIZE):
+    # Links duplicate files within each root to one copy.  Returns a report of what was done and what it saved.
+    start_time = time.monotonic()
+    roots = [os.path.abspath(root) for root in roots]
+    cache = load_cache(cache_path)
+    hashes = {}
+    links = {}
+    report = {"roots": roots, "link_type": link_type, "files": 0, "hashed": 0, "linked": 0, "bytes_saved": 0,
+              "libraries": {}}
+
+    def record(root, path, size):
+        library = report["libraries"].setdefault(get_library(root, path), {"files": 0, "bytes_saved": 0})
+        library["files"] += 1
+        library["bytes_saved"] += size
+        report["bytes_saved"] += size
+
+    to_hash = []
+    groups_by_root = []
+    for root in roots:
+        if not os.path.isdir(root):
+            logging.warning("Skipping {}, which isn't a directory".format(root))
+            continue
+        files = walk_files(root)
+        report["files"] += len(files)
+
+        # Links from earlier runs that are still in place still count, even though there's nothing left to do
+        for path, canonical in cache["links"].items():
+            if path.startswith(root + os.sep) and path not in files and \
+                    link_is_intact(path, canonical, link_type):
+                links[path] = canonical
+                record(root, path, os.stat(canonical).st_size)
+
+        # Files that are already hardlinked to each other only need to be looked at once
+        by_inode = {}
+        for path, st in sorted(files.items()):
+            by_inode.setdefault((st.st_dev, st.st_ino), []).append(path)
+        by_size = {}
+        for paths in by_inode.values():
+            by_size.setdefault(files[paths[0]].st_size, []).append(paths)
+
+        groups = []
+        for size, inodes in by_size.items():
+            if size < min_size:
+                continue
+            if len(inodes) < 2:
+                # Nothing to hash, but hardlinks made by an earlier run still count
+                for path in inodes[0][1:]:
+                    links[path] = inodes[0][0]
+                    record(root, path, size)
+                continue
+            groups.append(inodes)
+            for paths in inodes:
+                st = files[paths[0]]
+                cached = cache["hashes"].get(paths[0])
+                if cached and cached[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                    hashes[paths[0]] = cached
+                else:
+                    to_hash.append((paths[0], st))
+        groups_by_root.append((root, files, groups))
+
+    if to_hash:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            for (path, st), sha256 in zip(to_hash, executor.map(lambda item: hash_file(item[0]), to_hash)):
+                hashes[path] = [st.st_size, st.st_mtime_ns, st.st_ino, sha256]
+        report["hashed"] = len(to_hash)
+
+    for root, files, groups in groups_by_root:
+        for inodes in groups:
+            by_hash = {}
+            for paths in inodes:
+                by_hash.setdefault(hashes[paths[0]][3], []).extend(paths)
+            for paths in by_hash.values():
+                paths.sort()
+                canonical = paths[0]
+                for path in paths[1:]:
+                    if link_type == "symlink" or not os.path.samefile(path, canonical):
+                        replace_with_link(canonical, path, link_type)
+                        report["linked"] += 1
+                    links[path] = canonical
+                    record(root, path, files[path].st_size)
+
+    if cache_path:
+        # Files that were replaced with symlinks are gone, so keep only the hashes of what's still there
+        write_cache(cache_path, {path: value for path, value in hashes.items()
+                                 if not (link_type == "symlink" and path in links)}, links)
+
+    report["elapsed_time"] = time.monotonic() - start_time
+    return report
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Replace identical files in KiCad.app's libraries with links.")
+    parser.add_argument("--link", choices=["symlink", "hardlink"], default="symlink", dest="link_type",
+                        help="What to replace duplicates with. Defaults to symlink, since package.sh only preserves "
+                             "symlinks.")
+    parser.add_argument("--cache", help="Path to keep file hashes in, so unchanged files aren't hashed again.")
+    parser.add_argument("--report", help="Path to write a JSON report of the bytes saved per library to.")
+    parser.add_argument("--min-size", type=int, default=DEFAULT_MIN_SIZE,
+                        help="Size in bytes below which files are left alone. Defaults to {}.".format(DEFAULT_MIN_SIZE))
+    parser.add_argument("--jobs", type=int,
+                        help="Number of files to hash at once. Defaults to the number of cores.")
+    parser.add_argument("roots", nargs="+",
+                        help="Directories to deduplicate, like KiCad.app/Contents/SharedSupport/3dmodels.")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    report = dedupe(args.roots, args.link_type, args.cache, args.jobs, args.min_size)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    for library, details in sorted(report["libraries"].items(), key=lambda item: -item[1]["bytes_saved"])[:10]:
+        logging.info("{}: {} duplicates, {:.1f} MB".format(library, details["files"],
+                                                           details["bytes_saved"] / 1024 ** 2))
+    logging.info("Hashed {} of {} files and linked {} duplicates in {:.1f} seconds. {:.1f} MB saved in total.".format(
+        report["hashed"], report["files"], report["linked"], report["elapsed_time"],
+        report["bytes_saved"] / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,705 @@
+#!/usr/bin/env python3
+
+# Makes small update packages between two builds of KiCad, like consecutive nightlies, and applies them.  A manifest
+# lists every file, symlink and directory in a build's kicad-dest, with each file's hash, as it's installed from the
+# DMG.  A delta against an earlier
+# manifest holds only what changed: files that are new or different, paths that went away, and for Mach-O files,
+# which change a little from build to build, patches against the earlier build's copy.  The libraries in
+# SharedSupport rarely change, so a delta is usually megabytes where the DMG is gigabytes.
+
+# Patches are made by cutting both versions of a file into chunks that end at content-defined anchors, so an insertion
+# only changes the chunks around it, and copying every chunk the earlier version already has.  Each patch or file is
+# compressed on its own, so a pool of processes can diff and compress them all at once, and files are streamed or
+# mapped rather than read into memory.
+
+# `package` is what the package-kicad-delta target runs.  It writes a delta against the build it kept last time, if
+# there is one, and keeps this build as the base for the next one.  Only the Mach-O files are kept, since nothing else
+# is diffed.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import hashlib
+import io
+import json
+import logging
+import lzma
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+
+import macho
+
+logging.basicConfig(level=logging.INFO)
+
+MANIFEST_VERSION = 1
+DELTA_VERSION = 1
+CACHE_VERSION = 1
+DELTA_INFO_MEMBER = "delta.json.xz"
+STAGING_DIRNAME = ".kicad-delta-staging"
+# package.sh moves these out of the KiCad folder to the top of the DMG, so they aren't in an installed KiCad
+NOT_INSTALLED = ("demos",)
+EMPTY_SHA256 = hashlib.sha256().hexdigest()
+
+PATCH_MAGIC = b"KDP1"
+COPY_OP = b"C"
+DATA_OP = b"D"
+# A chunk ends at the first anchor at least MIN_CHUNK bytes after it starts, or after MAX_CHUNK bytes.  In random
+# data, an anchor turns up about every 2 KB.  In code, they're mostly in small immediates and negative offsets.
+ANCHOR_RE = re.compile(rb"[\x00-\x03][\xfc-\xff]|[\xfc-\xff][\x00-\x03]")
+MIN_CHUNK = 64
+MAX_CHUNK = 16384
+# A patch that has to carry more than this fraction of the new file isn't worth it, so the file is stored instead
+MAX_LITERAL_FRACTION = 0.5
+LZMA_PRESET = 6
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class DeltaError(Exception):
+    pass
+
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return EMPTY_SHA256
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+
+def is_macho(path):
+    try:
+        return macho.read_macho(path) is not None
+    except (OSError, macho.MachOError):
+        return False
+
+
+def hash_and_identify(path):
+    return hash_file(path), is_macho(path)
+
+
+def walk_tree(root):
+    # Returns ({relative path: os.stat_result} for files, {relative path: target} for symlinks, [directories]),
+    # without following symlinks.  Nothing in the staging directory of an interrupted apply counts, and neither does
+    # anything package.sh doesn't leave in the KiCad folder.
+    files = {}
+    symlinks = {}
+    directories = []
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                relative_path = os.path.relpath(entry.path, root)
+                if relative_path == STAGING_DIRNAME or relative_path in NOT_INSTALLED:
+                    continue
+                if entry.is_symlink():
+                    symlinks[relative_path] = os.readlink(entry.path)
+                elif entry.is_dir():
+                    directories.append(relative_path)
+                    stack.append(entry.path)
+                else:
+                    files[relative_path] = entry.stat(follow_symlinks=False)
+    return files, symlinks, sorted(directories)
+
+
+def load_cache(cache_path):
+    if not cache_path:
+        return {}
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache.get("hashes", {}) if cache.get("version") == CACHE_VERSION else {}
+
+
+def write_json(path, value):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def get_manifest_id(manifest):
+    contents = {key: manifest[key] for key in ("files", "symlinks", "directories")}
+    return hashlib.sha256(json.dumps(contents, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_label(manifest):
+    return manifest.get("name") or manifest["id"][:12]
+
+
+def make_manifest(root, jobs=None, cache_path=None, name=None):
+    # Hashes every file under root, on a pool of threads.  Files whose size, mtime and inode match the cache aren't
+    # read again.
+    root = os.path.abspath(root)
+    files, symlinks, directories = walk_tree(root)
+    cache = load_cache(cache_path)
+    hashes = {}
+    to_hash = []
+    for relative_path, st in files.items():
+        cached = cache.get(relative_path)
+        if cached and cached[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+            hashes[relative_path] = cached
+        else:
+            to_hash.append(relative_path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        results = executor.map(lambda relative_path: hash_and_identify(os.path.join(root, relative_path)), to_hash)
+        for relative_path, (sha256, file_is_macho) in zip(to_hash, results):
+            st = files[relative_path]
+            hashes[relative_path] = [st.st_size, st.st_mtime_ns, st.st_ino, sha256, file_is_macho]
+
+    if cache_path:
+        write_json(cache_path, {"version": CACHE_VERSION, "hashes": hashes})
+
+    entries = {}
+    for relative_path, st in files.items():
+        entries[relative_path] = {"size": st.st_size, "sha256": hashes[relative_path][3], "mode": st.st_mode & 0o7777}
+        if hashes[relative_path][4]:
+            entries[relative_path]["macho"] = True
+    manifest = {"version": MANIFEST_VERSION, "name": name, "files": entries, "symlinks": symlinks,
+                "directories": directories}
+    manifest["id"] = get_manifest_id(manifest)
+    logging.info("Hashed {} of {} files in {}".format(len(to_hash), len(files), root))
+    return manifest
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise DeltaError("{} isn't a version {} manifest".format(path, MANIFEST_VERSION))
+    return manifest
+
+
+def get_chunks(data):
+    # Yields the (offset, length) of each chunk of data, which can be bytes or an mmap.
+    size = len(data)
+    start = 0
+    while start < size:
+        end = min(size, start + MAX_CHUNK)
+        match = ANCHOR_RE.search(data, start + MIN_CHUNK, end)
+        if match:
+            end = match.end()
+        yield start, end - start
+        start = end
+
+
+def map_file(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_patch(base_path, new_path, patch_path):
+    # Writes a compressed patch that turns base_path into new_path.  Returns the number of bytes it has to carry
+    # itself, rather than copy from base_path.
+    literal_bytes = 0
+    with open(base_path, "rb") as base_file, open(new_path, "rb") as new_file, \
+            lzma.open(patch_path, "wb", preset=LZMA_PRESET) as patch:
+        base = map_file(base_file)
+        new = map_file(new_file)
+        index = {}
+        for offset, length in get_chunks(base):
+            index.setdefault(hash(base[offset:offset + length]), offset)
+
+        patch.write(PATCH_MAGIC + struct.pack(">QQ", len(base), len(new)))
+        copy_offset = copy_length = 0
+        literal_start = literal_end = 0
+
+        def flush():
+            nonlocal copy_length, literal_start, literal_bytes
+            if copy_length:
+                patch.write(COPY_OP + struct.pack(">QI", copy_offset, copy_length))
+                copy_length = 0
+            if literal_end > literal_start:
+                patch.write(DATA_OP + struct.pack(">I", literal_end - literal_start))
+                patch.write(new[literal_start:literal_end])
+                literal_bytes += literal_end - literal_start
+            literal_start = literal_end
+
+        for offset, length in get_chunks(new):
+            chunk = new[offset:offset + length]
+            # A run of matching chunks usually continues where the last one left off in the base, even when the base
+            # was cut into different chunks there
+            if copy_length and base[copy_offset + copy_length:copy_offset + copy_length + length] == chunk:
+                copy_length += length
+                literal_start = literal_end = offset + length
+                continue
+            base_offset = index.get(hash(chunk))
+            if base_offset is not None and base[base_offset:base_offset + length] == chunk:
+                flush()
+                copy_offset, copy_length = base_offset, length
+                literal_start = literal_end = offset + length
+            else:
+                if copy_length:
+                    flush()
+                    literal_start = offset
+                literal_end = offset + length
+        flush()
+    return literal_bytes
+
+
+def compress_file(path, output_path):
+    with open(path, "rb") as f, lzma.open(output_path, "wb", preset=LZMA_PRESET) as output:
+        shutil.copyfileobj(f, output, COPY_BLOCK_SIZE)
+
+
+def encode_change(root, base_tree, relative_path, entry, base_entry, output_path):
+    # Runs in the worker processes.  Writes a patch for the file if it's Mach-O and the base's copy is the right one,
+    # and the whole file otherwise.  Returns "patch" or "file".
+    path = os.path.join(root, relative_path)
+    if base_entry and base_tree and entry.get("macho") and base_entry.get("macho"):
+        base_path = os.path.join(base_tree, relative_path)
+        if os.path.isfile(base_path) and hash_file(base_path) == base_entry["sha256"]:
+            literal_bytes = write_patch(base_path, path, output_path)
+            if literal_bytes <= MAX_LITERAL_FRACTION * entry["size"]:
+                return "patch"
+    compress_file(path, output_path)
+    return "file"
+
+
+def get_removed_paths(base, target):
+    # Everything in the base that isn't in the target as the same kind of thing
+    removed = []
+    for kind in ("files", "symlinks", "directories"):
+        target_paths = target[kind]
+        removed.extend(path for path in base[kind] if path not in target_paths)
+    return sorted(removed)
+
+
+def create_delta(base, target, root, output_path, base_tree=None, jobs=None):
+    # Writes a delta that turns a tree matching the base manifest into one matching the target manifest, which has to
+    # describe root.  Returns a report of what's in it.
+    start_time = time.monotonic()
+    root = os.path.abspath(root)
+    changes = []
+    modes = {}
+    for relative_path, entry in sorted(target["files"].items()):
+        base_entry = base["files"].get(relative_path)
+        if base_entry is None or base_entry["sha256"] != entry["sha256"]:
+            changes.append({"path": relative_path, "sha256": entry["sha256"], "size": entry["size"],
+                            "mode": entry["mode"], "base_sha256": base_entry and base_entry["sha256"]})
+        elif base_entry["mode"] != entry["mode"]:
+            modes[relative_path] = entry["mode"]
+    symlinks = {path: link for path, link in target["symlinks"].items() if base["symlinks"].get(path) != link}
+    directories = [path for path in target["directories"] if path not in base["directories"]]
+    removed = get_removed_paths(base, target)
+
+    report = {"base": get_label(base), "target": get_label(target), "files": 0, "patches": 0, "removed": len(removed),
+              "symlinks": len(symlinks), "new_bytes": 0, "delta_bytes": 0}
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            futures = []
+            for number, change in enumerate(changes):
+                change["member"] = "data/{}".format(number)
+                futures.append(executor.submit(encode_change, root, base_tree, change["path"],
+                                               target["files"][change["path"]],
+                                               base["files"].get(change["path"]),
+                                               os.path.join(tmp_dir, str(number))))
+            for change, future in zip(changes, futures):
+                change["encoding"] = future.result()
+                report["patches" if change["encoding"] == "patch" else "files"] += 1
+                report["new_bytes"] += change["size"]
+
+        info = {"version": DELTA_VERSION,
+                "base": {"id": base["id"], "name": base.get("name")},
+                "target": {"id": target["id"], "name": target.get("name")},
+                "changes": changes, "modes": modes, "symlinks": symlinks, "directories": directories,
+                "removed": removed, "manifest": target}
+        info_path = os.path.join(tmp_dir, DELTA_INFO_MEMBER)
+        with lzma.open(info_path, "wt", preset=LZMA_PRESET) as f:
+            json.dump(info, f, sort_keys=True)
+
+        tmp_path = output_path + ".tmp"
+        with tarfile.open(tmp_path, "w", format=tarfile.PAX_FORMAT) as tar:
+            tar.add(info_path, arcname=DELTA_INFO_MEMBER)
+            for number, change in enumerate(changes):
+                tar.add(os.path.join(tmp_dir, str(number)), arcname=change["member"])
+        os.replace(tmp_path, output_path)
+
+    report["delta_bytes"] = os.path.getsize(output_path)
+    report["elapsed_time"] = time.monotonic() - start_time
+    return report
+
+
+class MemberReader(io.RawIOBase):
+    # Reads one member of a delta through its own file handle, so several can be read at once.
+
+    def __init__(self, path, offset, size):
+        self.f = open(path, "rb")
+        self.f.seek(offset)
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.f.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+        self.remaining -= count
+        return count
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def open_member(delta_path, member):
+    return lzma.open(io.BufferedReader(MemberReader(delta_path, member.offset_data, member.size)))
+
+
+def check_path(relative_path):
+    # Paths come from the delta, so don't let one point outside the tree
+    if os.path.isabs(relative_path) or ".." in relative_path.split("/") or relative_path in ("", "."):
+        raise DeltaError("The delta contains a bad path: {}".format(relative_path))
+
+
+def load_delta(delta_path):
+    # Returns (the delta's description, {member name: tarfile.TarInfo}).
+    with tarfile.open(delta_path, "r:") as tar:
+        members = {member.name: member for member in tar.getmembers()}
+    if DELTA_INFO_MEMBER not in members:
+        raise DeltaError("{} isn't a KiCad delta".format(delta_path))
+    with open_member(delta_path, members[DELTA_INFO_MEMBER]) as f:
+        info = json.load(io.TextIOWrapper(f, encoding="utf-8"))
+    if info.get("version") != DELTA_VERSION:
+        raise DeltaError("{} is a version {} delta, but this only applies version {}".format(
+            delta_path, info.get("version"), DELTA_VERSION))
+    return info, members
+
+
+def get_current_hash(path):
+    try:
+        return hash_file(path) if os.path.isfile(path) and not os.path.islink(path) else None
+    except OSError:
+        return None
+
+
+def apply_patch(base_path, patch, output):
+    # Reads a patch from the file object patch, and writes what it makes from base_path to output.
+    with open(base_path, "rb") as base_file:
+        base = map_file(base_file)
+        header = patch.read(len(PATCH_MAGIC) + 16)
+        if header[:len(PATCH_MAGIC)] != PATCH_MAGIC:
+            raise DeltaError("Bad patch for {}".format(base_path))
+        base_size, new_size = struct.unpack(">QQ", header[len(PATCH_MAGIC):])
+        if base_size != len(base):
+            raise DeltaError("{} is {} bytes, but the patch is for a {} byte file".format(base_path, len(base),
+                                                                                        base_size))
+        while True:
+            op = patch.read(1)
+            if not op:
+                break
+            if op == COPY_OP:
+                offset, length = struct.unpack(">QI", patch.read(12))
+                output.write(base[offset:offset + length])
+            elif op == DATA_OP:
+                length = struct.unpack(">I", patch.read(4))[0]
+                while length:
+                    block = patch.read(min(length, COPY_BLOCK_SIZE))
+                    if not block:
+                        raise DeltaError("Truncated patch for {}".format(base_path))
+                    output.write(block)
+                    length -= len(block)
+            else:
+                raise DeltaError("Bad patch for {}".format(base_path))
+
+
+class HashingWriter:
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.f.write(data)
+
+
+def decode_change(delta_path, member, root, change, staging_path):
+    # Runs on the worker threads.  Writes the new version of the file to staging_path, and checks its hash.
+    with open_member(delta_path, member) as source, open(staging_path, "wb") as f:
+        output = HashingWriter(f)
+        if change["encoding"] == "patch":
+            apply_patch(os.path.join(root, change["path"]), source, output)
+        else:
+            shutil.copyfileobj(source, output, COPY_BLOCK_SIZE)
+    if output.digest.hexdigest() != change["sha256"]:
+        raise DeltaError("{} came out different than expected".format(change["path"]))
+    os.chmod(staging_path, change["mode"])
+
+
+def get_kind(path):
+    # Returns which of a manifest's lists path belongs in, or None if it doesn't exist
+    if os.path.islink(path):
+        return "symlinks"
+    if os.path.isdir(path):
+        return "directories"
+    return "files" if os.path.exists(path) else None
+
+
+def get_target_kind(manifest, relative_path):
+    for kind in ("files", "symlinks", "directories"):
+        if relative_path in manifest[kind]:
+            return kind
+    return None
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def apply_delta(delta_path, root, jobs=None):
+    # Updates root, which has to match the delta's base, to match its target.  Nothing is changed until every new
+    # file has been made and checked.  Changes that were already made, like by an interrupted apply, are skipped.
+    # Returns counts of what was done.
+    start_time = time.monotonic()
+    root = os.path.abspath(root)
+    info, members = load_delta(delta_path)
+    for path in [change["path"] for change in info["changes"]] + list(info["symlinks"]) + info["directories"] + \
+            info["removed"] + list(info["modes"]):
+        check_path(path)
+
+    # Make sure this is the build the delta was made from before touching anything
+    pending = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        current_hashes = executor.map(lambda change: get_current_hash(os.path.join(root, change["path"])),
+                                      info["changes"])
+        mismatched = []
+        for change, current_hash in zip(info["changes"], current_hashes):
+            if current_hash == change["sha256"]:
+                continue
+            if current_hash != change["base_sha256"]:
+                mismatched.append(change["path"])
+            pending.append(change)
+    if mismatched:
+        raise DeltaError("{} doesn't match the build this delta was made from ({}). These files are different:\n{}".format(
+            root, info["base"]["name"] or info["base"]["id"][:12], "\n".join(sorted(mismatched)[:20])))
+
+    staging_dir = os.path.join(root, STAGING_DIRNAME)
+    remove_path(staging_dir)
+    os.makedirs(staging_dir)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            futures = [executor.submit(decode_change, delta_path, members[change["member"]], root, change,
+                                       os.path.join(staging_dir, str(number)))
+                       for number, change in enumerate(pending)]
+            for future in futures:
+                future.result()
+
+        # Everything is ready, so make the changes.  What goes away goes first, since a directory may become a file.
+        # A path that's already what the target has, like a file that became a directory in an interrupted apply, is
+        # left alone, since what's in it may already be done.
+        for relative_path in sorted(info["removed"], reverse=True):
+            path = os.path.join(root, relative_path)
+            if get_kind(path) != get_target_kind(info["manifest"], relative_path):
+                remove_path(path)
+        for relative_path in info["directories"]:
+            path = os.path.join(root, relative_path)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.remove(path)
+            os.makedirs(path, exist_ok=True)
+        for number, change in enumerate(pending):
+            path = os.path.join(root, change["path"])
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(os.path.join(staging_dir, str(number)), path)
+        for relative_path, link in info["symlinks"].items():
+            path = os.path.join(root, relative_path)
+            if os.path.islink(path) and os.readlink(path) == link:
+                continue
+            remove_path(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.symlink(link, path)
+        for relative_path, mode in info["modes"].items():
+            os.chmod(os.path.join(root, relative_path), mode)
+    finally:
+        remove_path(staging_dir)
+
+    elapsed_time = time.monotonic() - start_time
+    logging.info("Updated {} to {} in {:.1f} seconds: {} files written, {} already up to date, {} removed".format(
+        root, info["target"]["name"] or info["target"]["id"][:12], elapsed_time, len(pending),
+        len(info["changes"]) - len(pending), len(info["removed"])))
+    return {"written": len(pending), "skipped": len(info["changes"]) - len(pending), "removed": len(info["removed"])}
+
+
+def verify_tree(manifest, root, jobs=None):
+    # Returns (problems, extra paths): how root differs from the manifest, and what's in root that the manifest
+    # doesn't mention, which is usually harmless.
+    root = os.path.abspath(root)
+    files, symlinks, directories = walk_tree(root)
+    problems = []
+    expected = manifest["files"]
+    to_hash = sorted(path for path in expected if path in files)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        for relative_path, sha256 in zip(to_hash, executor.map(lambda path: hash_file(os.path.join(root, path)),
+                                                                to_hash)):
+            if sha256 != expected[relative_path]["sha256"]:
+                problems.append("{} is different".format(relative_path))
+            elif files[relative_path].st_mode & 0o7777 != expected[relative_path]["mode"]:
+                problems.append("{} has mode {:o} instead of {:o}".format(
+                    relative_path, files[relative_path].st_mode & 0o7777, expected[relative_path]["mode"]))
+    problems.extend("{} is missing".format(path) for path in expected if path not in files)
+    for relative_path, link in manifest["symlinks"].items():
+        if symlinks.get(relative_path) != link:
+            problems.append("{} should be a symlink to {}".format(relative_path, link))
+    problems.extend("{} should be a directory".format(path) for path in manifest["directories"]
+                    if path not in directories)
+    known = set(expected) | set(manifest["symlinks"]) | set(manifest["directories"])
+    extra = sorted(path for path in list(files) + list(symlinks) + directories if path not in known)
+    return sorted(problems), extra
+
+
+def update_base(base_dir, manifest, root):
+    # Keeps a copy of this build's Mach-O files, and its manifest, to make the next delta against.  The manifest is
+    # written last, so an interrupted update leaves a base that deltas won't trust.
+    files_dir = os.path.join(base_dir, "files")
+    manifest_path = os.path.join(base_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    wanted = {path for path, entry in manifest["files"].items() if entry.get("macho")}
+    if os.path.isdir(files_dir):
+        kept_files, kept_symlinks, _ = walk_tree(files_dir)
+        for relative_path in list(kept_files) + list(kept_symlinks):
+            if relative_path not in wanted:
+                os.remove(os.path.join(files_dir, relative_path))
+
+    def keep(relative_path):
+        destination = os.path.join(files_dir, relative_path)
+        if get_current_hash(destination) == manifest["files"][relative_path]["sha256"]:
+            return
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if os.path.lexists(destination):
+            os.remove(destination)
+        shutil.copy2(os.path.join(root, relative_path), destination)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        list(executor.map(keep, sorted(wanted)))
+    write_json(manifest_path, manifest)
+
+
+def package(root, base_dir, output_dir, name=None, jobs=None):
+    # Writes this build's manifest, and a delta from the last build packaged with the same base_dir if there was one,
+    # into output_dir, and makes this build the new base.  Returns the delta's path, or None.
+    manifest = make_manifest(root, jobs, os.path.join(base_dir, "hashes.json"), name)
+    os.makedirs(output_dir, exist_ok=True)
+    write_json(os.path.join(output_dir, "kicad-manifest-{}.json".format(get_label(manifest))), manifest)
+
+    delta_path = None
+    base_manifest_path = os.path.join(base_dir, "manifest.json")
+    if not os.path.exists(base_manifest_path):
+        logging.info("No earlier build in {}, so there's nothing to make a delta against".format(base_dir))
+    else:
+        base = load_manifest(base_manifest_path)
+        if base["id"] == manifest["id"]:
+            logging.info("Nothing changed since {}".format(get_label(base)))
+        else:
+            delta_path = os.path.join(output_dir, "kicad-delta-{}-to-{}.kdelta".format(get_label(base),
+                                                                                       get_label(manifest)))
+            report = create_delta(base, manifest, root, delta_path, os.path.join(base_dir, "files"), jobs)
+            log_report(report)
+
+    update_base(base_dir, manifest, root)
+    return delta_path
+
+
+def log_report(report):
+    logging.info("Made a delta from {} to {} in {:.1f} seconds: {} patched and {} whole files ({:.1f} MB), {} "
+                 "symlinks and {} removed paths, in {:.1f} MB".format(
+                     report["base"], report["target"], report["elapsed_time"], report["patches"], report["files"],
+                     report["new_bytes"] / 1024 ** 2, report["symlinks"], report["removed"],
+                     report["delta_bytes"] / 1024 ** 2))
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Make and apply update packages between builds of KiCad.")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of files to hash, diff or compress at once. Defaults to the number of cores.")
+    subparsers = parser.add_subparsers(dest="subparser_name", required=True)
+
+    manifest_parser = subparsers.add_parser("manifest", help="Write the manifest of a tree, like kicad-dest.")
+    manifest_parser.add_argument("--cache", help="Path to keep file hashes in, so unchanged files aren't hashed again.")
+    manifest_parser.add_argument("--name", help="Name for the build, like a release name, used to name deltas.")
+    manifest_parser.add_argument("tree")
+    manifest_parser.add_argument("output")
+
+    create_parser = subparsers.add_parser("create", help="Make a delta from an earlier manifest to a tree.")
+    create_parser.add_argument("--base-tree",
+                               help="The earlier build, or at least its Mach-O files, to make patches against. "
+                                    "Without it, changed files are stored whole.")
+    create_parser.add_argument("--cache", help="Path to keep file hashes in, so unchanged files aren't hashed again.")
+    create_parser.add_argument("--name", help="Name for the new build, like a release name.")
+    create_parser.add_argument("base_manifest")
+    create_parser.add_argument("tree")
+    create_parser.add_argument("output")
+
+    apply_parser = subparsers.add_parser("apply", help="Update a tree, like /Applications/KiCad, with a delta.")
+    apply_parser.add_argument("delta")
+    apply_parser.add_argument("tree")
+
+    verify_parser = subparsers.add_parser("verify", help="Check a tree against a manifest, or a delta's target.")
+    verify_parser.add_argument("manifest", help="A manifest, or a delta.")
+    verify_parser.add_argument("tree")
+
+    package_parser = subparsers.add_parser("package",
+                                           help="Write a manifest and a delta from the last packaged build, and keep "
+                                                "this build as the base for the next one.")
+    package_parser.add_argument("--base-dir", required=True,
+                                help="Directory to keep the last packaged build's manifest and Mach-O files in.")
+    package_parser.add_argument("--output-dir", required=True, help="Directory to write the manifest and delta to.")
+    package_parser.add_argument("--name", help="Name for the build, like a release name. Defaults to its hash.")
+    package_parser.add_argument("tree")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    try:
+        if args.subparser_name == "manifest":
+            write_json(args.output, make_manifest(args.tree, args.jobs, args.cache, args.name))
+        elif args.subparser_name == "create":
+            base = load_manifest(args.base_manifest)
+            target = make_manifest(args.tree, args.jobs, args.cache, args.name)
+            log_report(create_delta(base, target, args.tree, args.output, args.base_tree, args.jobs))
+        elif args.subparser_name == "apply":
+            apply_delta(args.delta, args.tree, args.jobs)
+            info, _ = load_delta(args.delta)
+            problems, extra = verify_tree(info["manifest"], args.tree, args.jobs)
+            if problems:
+                raise DeltaError("{} doesn't match the delta's target after applying it:\n{}".format(
+                    args.tree, "\n".join(problems[:20])))
+        elif args.subparser_name == "verify":
+            if tarfile.is_tarfile(args.manifest):
+                manifest = load_delta(args.manifest)[0]["manifest"]
+            else:
+                manifest = load_manifest(args.manifest)
+            problems, extra = verify_tree(manifest, args.tree, args.jobs)
+            for path in extra:
+                logging.warning("{} isn't in the manifest".format(path))
+            if problems:
+                raise DeltaError("{} doesn't match {}:\n{}".format(args.tree, get_label(manifest),
+                                                                  "\n".join(problems)))
+            logging.info("{} matches {}".format(args.tree, get_label(manifest)))
+        elif args.subparser_name == "package":
+            package(args.tree, args.base_dir, args.output_dir, args.name or None, args.jobs)
+    except DeltaError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
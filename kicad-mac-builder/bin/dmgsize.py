@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Works out how big a disk image needs to be to hold some files, so DMGs don't have to be made with a hardcoded size.
+# The trees are walked once.  Each file is rounded up to whole allocation blocks, each file, directory and symlink
+# gets a share of the catalog, and the filesystem's own structures (journal, allocation bitmap, volume headers and
+# B-tree reserves) are added on top, before a configurable headroom.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import logging
+import math
+import os
+import sys
+
+logging.basicConfig(level=logging.INFO)
+
+SECTOR_SIZE = 512
+
+# block_size: allocation block size hdiutil uses for images of this size
+# entry_overhead: catalog (or APFS filesystem tree) space per file, directory or symlink, including B-tree node slack
+# fixed_overhead: volume headers, the extents and attributes B-trees' initial size, and for APFS, the container's
+# space manager, checkpoints and object map
+# journal: size of the HFS+ journal per 100 GB of volume, and its minimum
+FILESYSTEMS = {
+    "hfs+": {"block_size": 4096, "entry_overhead": 512, "fixed_overhead": 16 * 1024 ** 2,
+             "journal_per_100gb": 8 * 1024 ** 2, "min_journal": 8 * 1024 ** 2, "bitmap": True},
+    "apfs": {"block_size": 4096, "entry_overhead": 1024, "fixed_overhead": 64 * 1024 ** 2,
+             "journal_per_100gb": 0, "min_journal": 0, "bitmap": True},
+}
+DEFAULT_FILESYSTEM = "hfs+"
+DEFAULT_HEADROOM = 0.1
+
+
+def round_up(size, block_size):
+    return (size + block_size - 1) // block_size * block_size
+
+
+def measure(paths, block_size, count_hardlinks_once=False):
+    # Walks each path once, without following symlinks.  Returns (bytes of data rounded up to whole blocks, number of
+    # files, directories and symlinks).  rsync -a doesn't preserve hardlinks, so by default each link is counted as
+    # its own copy.
+    data_bytes = 0
+    entries = 0
+    seen = set()
+    stack = list(paths)
+    while stack:
+        path = stack.pop()
+        st = os.lstat(path)
+        entries += 1
+        if os.path.isdir(path) and not os.path.islink(path):
+            with os.scandir(path) as it:
+                stack.extend(entry.path for entry in it)
+            continue
+        if count_hardlinks_once and st.st_nlink > 1:
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+        # A symlink's target is stored in its data fork, which takes a block like any other small file
+        data_bytes += round_up(max(st.st_size, 1) if os.path.islink(path) else st.st_size, block_size)
+    return data_bytes, entries
+
+
+def get_filesystem_overhead(filesystem, volume_size):
+    settings = FILESYSTEMS[filesystem]
+    overhead = settings["fixed_overhead"]
+    overhead += max(settings["min_journal"], math.ceil(volume_size / (100 * 1000 ** 3) * settings["journal_per_100gb"]))
+    if settings["bitmap"]:
+        # One bit per allocation block
+        overhead += round_up(math.ceil(volume_size / settings["block_size"] / 8), settings["block_size"])
+    return overhead
+
+
+def estimate(paths, filesystem=DEFAULT_FILESYSTEM, headroom=DEFAULT_HEADROOM, count_hardlinks_once=False):
+    # Returns the details of the estimate, with the size an image needs to be, in bytes and rounded to a whole
+    # number of sectors, in "size".
+    settings = FILESYSTEMS[filesystem]
+    data_bytes, entries = measure(paths, settings["block_size"], count_hardlinks_once)
+    content_bytes = data_bytes + entries * settings["entry_overhead"]
+
+    # The journal and bitmap depend on the size of the volume, which depends on them, but they're small enough that
+    # a second pass settles it
+    size = content_bytes * (1 + headroom)
+    for _ in range(2):
+        overhead = get_filesystem_overhead(filesystem, size)
+        size = (content_bytes + overhead) * (1 + headroom)
+
+    return {
+        "filesystem": filesystem,
+        "data_bytes": data_bytes,
+        "entries": entries,
+        "metadata_bytes": entries * settings["entry_overhead"],
+        "filesystem_overhead_bytes": overhead,
+        "headroom": headroom,
+        "size": round_up(int(math.ceil(size)), settings["block_size"]),
+    }
+
+
+def format_size(size, size_format):
+    if size_format == "sectors":
+        return str(size // SECTOR_SIZE)
+    if size_format == "dmgbuild":
+        # dmgbuild passes this to `hdiutil create -size`
+        return "{}k".format(math.ceil(size / 1024))
+    return str(size)
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Print the size a disk image needs to be to hold some files.")
+    parser.add_argument("--format", choices=["bytes", "sectors", "dmgbuild"], default="bytes", dest="size_format",
+                        help="Print bytes, 512 byte sectors for `hdiutil resize -sectors`, or a size for dmgbuild's "
+                             "settings. Defaults to bytes.")
+    parser.add_argument("--filesystem", choices=sorted(FILESYSTEMS), default=DEFAULT_FILESYSTEM,
+                        help="Filesystem of the image. Defaults to {}.".format(DEFAULT_FILESYSTEM))
+    parser.add_argument("--headroom", type=float, default=DEFAULT_HEADROOM,
+                        help="Extra space to leave, as a fraction of the estimate. Defaults to {}.".format(
+                            DEFAULT_HEADROOM))
+    parser.add_argument("--count-hardlinks-once", action="store_true",
+                        help="Count hardlinked files once, for copies that preserve hardlinks, like `rsync -H`.")
+    parser.add_argument("paths", nargs="+", help="Files and directories that will go in the image.")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    details = estimate(args.paths, args.filesystem, args.headroom, args.count_hardlinks_once)
+    logging.info("{} bytes of data in {} entries, {} bytes of metadata and {} bytes of {} overhead, plus {:.0%} "
+                 "headroom: {} bytes".format(details["data_bytes"], details["entries"], details["metadata_bytes"],
+                                             details["filesystem_overhead_bytes"], details["filesystem"],
+                                             details["headroom"], details["size"]))
+    print(format_size(details["size"], args.size_format))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Installs the help from a KiCad docs tarball, like kicad-doc-HEAD.tar.gz, into KiCad.app.  The tarball is read as a
+# stream, and only the HTML help under share/doc/kicad/help is written, so the PDFs and EPUBs are never extracted just
+# to be deleted.  The tarball's digest is recorded next to the tarball, once per destination, and when it hasn't
+# changed and the installed help is still there, nothing is written at all.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+HELP_PREFIX = "share/doc/kicad/help/"
+DEFAULT_EXCLUDED_EXTENSIONS = [".pdf", ".epub"]
+STATE_VERSION = 1
+
+
+class HashingReader:
+    # Hashes everything read through it, so we get the tarball's digest in the same pass that extracts it.
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+    def finish(self):
+        for block in iter(lambda: self.read(1024 * 1024), b""):
+            pass
+        return self.digest.hexdigest()
+
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return HashingReader(f).finish()
+
+
+def get_state_path(tarball_path, destination):
+    # One state file per destination, since both halves of a universal build install from the same tarball at once
+    destination_id = hashlib.sha256(os.path.abspath(destination).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(os.path.dirname(os.path.abspath(tarball_path)),
+                        ".{}.{}.install-state.json".format(os.path.basename(tarball_path), destination_id))
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if state.get("version") != STATE_VERSION:
+        return {}
+    return state
+
+
+def write_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def get_help_path(member_name):
+    # Returns the path of a member relative to the help directory, or None if it isn't in it.  The tarball may or may
+    # not have a single top level directory, like kicad-doc-HEAD/, so accept either.
+    name = member_name
+    while name.startswith("./"):
+        name = name[2:]
+    if not name.startswith(HELP_PREFIX):
+        name = name.partition("/")[2]
+        if not name.startswith(HELP_PREFIX):
+            return None
+    relative_path = name[len(HELP_PREFIX):].rstrip("/")
+    if not relative_path or os.path.isabs(relative_path) or ".." in relative_path.split("/"):
+        return None
+    return relative_path
+
+
+def extract_help(tarball_path, destination, excluded_extensions):
+    # Streams the help out of the tarball into destination, which must not exist yet.
+    # Returns (the tarball's digest, the relative paths of the installed files).
+    installed = []
+    real_destination = os.path.realpath(destination)
+    with open(tarball_path, "rb") as f:
+        reader = HashingReader(f)
+        with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+            for member in tar:
+                relative_path = get_help_path(member.name)
+                if relative_path is None:
+                    continue
+                path = os.path.join(destination, relative_path)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+                if os.path.splitext(relative_path)[1].lower() in excluded_extensions:
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if member.issym():
+                    # Relative links can climb out too, like ../../../../Frameworks
+                    target = os.path.realpath(os.path.join(os.path.dirname(path), member.linkname))
+                    if os.path.isabs(member.linkname) or os.path.commonpath([target, real_destination]) != \
+                            real_destination:
+                        logging.warning("Skipping {}, which links outside the docs".format(member.name))
+                        continue
+                    os.symlink(member.linkname, path)
+                elif member.isfile():
+                    with tar.extractfile(member) as source, open(path, "wb") as output:
+                        shutil.copyfileobj(source, output, 1024 * 1024)
+                    os.chmod(path, member.mode & 0o755 | 0o644)
+                    os.utime(path, (member.mtime, member.mtime))
+                else:
+                    continue
+                installed.append(relative_path)
+        digest = reader.finish()
+    return digest, sorted(installed)
+
+
+def help_is_installed(destination, installed):
+    return os.path.isdir(destination) and all(os.path.lexists(os.path.join(destination, relative_path))
+                                              for relative_path in installed)
+
+
+def install_docs(tarball_path, destination, excluded_extensions=DEFAULT_EXCLUDED_EXTENSIONS, force=False):
+    # Returns True if the help was (re)installed, False if the installed help was already up to date.
+    start_time = time.monotonic()
+    tarball_path = os.path.abspath(tarball_path)
+    destination = os.path.abspath(destination)
+    excluded_extensions = sorted(extension.lower() for extension in excluded_extensions)
+    state_path = get_state_path(tarball_path, destination)
+    state = load_state(state_path)
+    st = os.stat(tarball_path)
+
+    if not force and state.get("excluded_extensions") == excluded_extensions and \
+            help_is_installed(destination, state.get("installed", [])):
+        # Only hash the tarball if it looks different; redownloading the same docs shouldn't reinstall them.
+        if (state.get("size"), state.get("mtime_ns")) == (st.st_size, st.st_mtime_ns) or \
+                hash_file(tarball_path) == state.get("sha256"):
+            state["size"] = st.st_size
+            state["mtime_ns"] = st.st_mtime_ns
+            write_state(state_path, state)
+            logging.info("{} is already installed in {}".format(tarball_path, destination))
+            return False
+
+    # Extract next to the destination, then swap it in, so an interrupted install doesn't leave half the docs behind
+    tmp_destination = destination + ".tmp"
+    if os.path.lexists(tmp_destination):
+        shutil.rmtree(tmp_destination)
+    os.makedirs(tmp_destination)
+    digest, installed = extract_help(tarball_path, tmp_destination, excluded_extensions)
+    if not installed:
+        shutil.rmtree(tmp_destination)
+        raise Exception("{} doesn't contain anything under {}".format(tarball_path, HELP_PREFIX))
+    if os.path.lexists(destination):
+        shutil.rmtree(destination)
+    os.replace(tmp_destination, destination)
+
+    write_state(state_path, {"version": STATE_VERSION,
+                             "excluded_extensions": excluded_extensions,
+                             "size": st.st_size,
+                             "mtime_ns": st.st_mtime_ns,
+                             "sha256": digest,
+                             "installed": installed})
+
+    elapsed_time = time.monotonic() - start_time
+    logging.info("Installed {} files from {} into {} in {:.1f} seconds".format(len(installed), tarball_path,
+                                                                            destination, elapsed_time))
+    return True
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Install the help from a KiCad docs tarball.")
+    parser.add_argument("--exclude-extension", action="append", dest="excluded_extensions",
+                        help="File extension to leave out, like .pdf. May be repeated. Defaults to {}.".format(
+                            " and ".join(DEFAULT_EXCLUDED_EXTENSIONS)))
+    parser.add_argument("--force", action="store_true",
+                        help="Reinstall the help even if this tarball is already installed.")
+    parser.add_argument("tarball", help="Docs tarball, like kicad-doc-HEAD.tar.gz.")
+    parser.add_argument("destination", help="Directory to install the help into, like KiCad.app/Contents/SharedSupport/help.")
+    args = parser.parse_args(arg_list)
+    if args.excluded_extensions is None:
+        args.excluded_extensions = DEFAULT_EXCLUDED_EXTENSIONS
+    return args
+
+
+def main():
+    args = parse_args()
+    install_docs(args.tarball, args.destination, args.excluded_extensions, args.force)
+
+
+if __name__ == "__main__":
+    main()
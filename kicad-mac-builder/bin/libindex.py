@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+
+# Indexes the symbol and footprint libraries staged into KiCad.app, so they can be searched without parsing thousands
+# of S-expression files first.  Each .kicad_sym and .kicad_mod file is read by a streaming tokenizer that only keeps
+# the few lists it cares about, on a pool of processes, and the index records each symbol's and footprint's name,
+# keywords, description, pin or pad count, and where it is in its file.
+
+# The index is a single file that's meant to be mapped, not loaded: fixed-size records sorted by name, a string table,
+# and a sorted word list with the records each word appears in.  LibraryIndex, below, is the query API.  It finds
+# names and words by binary search in the mapping, and only decodes the records it returns.
+
+# Building the index reports how fast the libraries parsed, so a library release that's much slower to load stands
+# out.  The benchmark command parses them again with different numbers of processes.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+INDEX_MAGIC = b"KLIX"
+INDEX_VERSION = 1
+DEFAULT_INDEX_FILENAME = "library-index.bin"
+# magic, version, then the count and offset of the records, strings and words, the offset of the string data and of
+# the word postings, and two unused words
+HEADER = struct.Struct("<4sI10I")
+# kind, pin or pad count, then string numbers for the library, name, keywords, description and file, and the offset
+# and length of the symbol or footprint in its file
+RECORD = struct.Struct("<B3xIIIIIIII")
+# offset and length in the string data
+STRING = struct.Struct("<II")
+# string number, first posting and number of postings
+WORD = struct.Struct("<III")
+POSTING = struct.Struct("<I")
+
+KINDS = ["symbol", "footprint"]
+SYMBOL = 0
+FOOTPRINT = 1
+
+# A list opening, with its head and the atoms before its first nested list, a whole list with no lists in it, which is
+# most of them, a list closing, or a quoted string, which is only matched so the parentheses in it are skipped.
+# Everything else is passed over by finditer without coming back to Python.
+SCAN_RE = re.compile(rb'\(\s*([^\s()"]*)((?:[^()"]+|"(?:[^"\\]+|\\.)*")*)(\))?|(\))|"(?:[^"\\]+|\\.)*"', re.DOTALL)
+ATOM_RE = re.compile(rb'"((?:[^"\\]+|\\.)*)"|([^\s()"]+)', re.DOTALL)
+ESCAPE_RE = re.compile(rb"\\(.)", re.DOTALL)
+ESCAPES = {b"n": b"\n", b"t": b"\t", b"r": b"\r"}
+WORD_RE = re.compile(r"[^\W_]+")
+
+SYMBOL_HEADS = {b"symbol", b"property", b"extends", b"number"}
+FOOTPRINT_HEADS = {b"footprint", b"module", b"descr", b"tags", b"pad"}
+# What KiCad has called the description and keyword properties of a symbol
+DESCRIPTION_PROPERTIES = [b"Description", b"ki_description"]
+KEYWORD_PROPERTIES = [b"ki_keywords"]
+
+
+class LibraryIndexError(Exception):
+    pass
+
+
+def unescape(value):
+    return ESCAPE_RE.sub(lambda match: ESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def split_atoms(text):
+    atoms = []
+    for match in ATOM_RE.finditer(text):
+        if match.lastindex == 1:
+            value = match.group(1)
+            atoms.append(unescape(value) if b"\\" in value else value)
+        else:
+            atoms.append(match.group(2))
+    return atoms
+
+
+def iter_lists(data, heads):
+    # Walks the S-expression in data, which can be bytes or an mmap, and yields (head, atoms, start, end, parents) for
+    # each list whose head is in heads, as it closes.  atoms are the strings and bare atoms after the head, up to the
+    # first nested list, as bytes, start and end are its offsets in data, and parents are the lists it's in, outermost
+    # first, as (head, atoms, start).  Nothing is kept for the other lists.
+    stack = []
+    for match in SCAN_RE.finditer(data):
+        head, text, leaf, close = match.groups()
+        if head is not None:
+            if leaf:
+                if head in heads:
+                    yield head, split_atoms(text), match.start(), match.end(), stack
+            else:
+                stack.append((head, split_atoms(text) if head in heads else None, match.start()))
+        elif close:
+            if not stack:
+                raise LibraryIndexError("Unbalanced ) at offset {}".format(match.start()))
+            head, atoms, start = stack.pop()
+            if atoms is not None:
+                yield head, atoms, start, match.end(), stack
+    if stack:
+        raise LibraryIndexError("Unclosed ({} at offset {}".format(decode(stack[-1][0]), stack[-1][2]))
+
+
+def decode(value):
+    return value.decode("utf-8", "replace") if value else ""
+
+
+def get_first(properties, names):
+    for name in names:
+        if properties.get(name):
+            return properties[name]
+    return b""
+
+
+def parse_symbol_library(data, library, relative_path):
+    # Returns a record tuple for each symbol in a .kicad_sym file.  Derived symbols get their pins, and any missing
+    # description or keywords, from the symbol they extend.
+    symbols = []
+    properties = {}
+    extends = None
+    pins = set()
+    for head, atoms, start, end, parents in iter_lists(data, SYMBOL_HEADS):
+        depth = len(parents)
+        if head == b"number":
+            if parents[-1][0] == b"pin" and atoms:
+                pins.add(atoms[0])
+        elif depth == 2 and parents[1][0] == b"symbol":
+            if head == b"property" and len(atoms) >= 2:
+                properties[atoms[0]] = atoms[1]
+            elif head == b"extends" and atoms:
+                extends = atoms[0]
+        elif head == b"symbol" and depth == 1 and atoms:
+            symbols.append((atoms[0], properties, extends, pins, start, end - start))
+            properties = {}
+            extends = None
+            pins = set()
+
+    by_name = {symbol[0]: symbol for symbol in symbols}
+    records = []
+    for name, properties, extends, pins, offset, length in symbols:
+        description = get_first(properties, DESCRIPTION_PROPERTIES)
+        keywords = get_first(properties, KEYWORD_PROPERTIES)
+        seen = {name}
+        while extends in by_name and extends not in seen:
+            seen.add(extends)
+            parent = by_name[extends]
+            pins = pins or parent[3]
+            description = description or get_first(parent[1], DESCRIPTION_PROPERTIES)
+            keywords = keywords or get_first(parent[1], KEYWORD_PROPERTIES)
+            extends = parent[2]
+        records.append((SYMBOL, library, decode(name), decode(keywords), decode(description), len(pins),
+                        relative_path, offset, length))
+    return records
+
+
+def parse_footprint(data, library, name, relative_path):
+    # Returns the record tuple for a .kicad_mod file.  KiCad names footprints after their files.  Pads without a
+    # number, like mounting holes, and pads that share a number only count once, like KiCad's pad count.
+    description = keywords = b""
+    pads = set()
+    offset = length = 0
+    for head, atoms, start, end, parents in iter_lists(data, FOOTPRINT_HEADS):
+        if len(parents) == 1:
+            if head == b"descr" and atoms:
+                description = atoms[0]
+            elif head == b"tags" and atoms:
+                keywords = atoms[0]
+            elif head == b"pad" and len(atoms) >= 2 and atoms[0] and atoms[1] != b"np_thru_hole":
+                pads.add(atoms[0])
+        elif not parents:
+            offset, length = start, end - start
+    return (FOOTPRINT, library, name, decode(keywords), decode(description), len(pads), relative_path, offset,
+            length)
+
+
+def find_library_files(root):
+    # Returns the (relative path, size) of the .kicad_sym files in root/symbols and the .kicad_mod files in the
+    # .pretty directories in root/footprints, biggest first, so the pool isn't left waiting on one big library at the
+    # end.  Files dedupe.py replaced with symlinks are followed.
+    paths = []
+    for subdirectory, extension in (("symbols", ".kicad_sym"), ("footprints", ".kicad_mod")):
+        for directory, dirnames, filenames in os.walk(os.path.join(root, subdirectory)):
+            dirnames.sort()
+            if extension == ".kicad_mod" and not directory.endswith(".pretty"):
+                continue
+            for filename in sorted(filenames):
+                if filename.endswith(extension):
+                    path = os.path.join(directory, filename)
+                    paths.append((os.path.relpath(path, root), os.stat(path).st_size))
+    return sorted(paths, key=lambda item: -item[1])
+
+
+def parse_files(root, relative_paths):
+    # Runs in the worker processes.  Returns (records, {relative path: error message}).
+    records = []
+    failures = {}
+    for relative_path in relative_paths:
+        try:
+            with open(os.path.join(root, relative_path), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    raise LibraryIndexError("Empty file")
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    directory, filename = os.path.split(relative_path)
+                    name = os.path.splitext(filename)[0]
+                    if filename.endswith(".kicad_sym"):
+                        records.extend(parse_symbol_library(data, name, relative_path))
+                    else:
+                        library = os.path.splitext(os.path.basename(directory))[0]
+                        records.append(parse_footprint(data, library, name, relative_path))
+        except (OSError, ValueError, LibraryIndexError) as e:
+            failures[relative_path] = str(e)
+    return records, failures
+
+
+def parse_libraries(root, jobs=None):
+    # Parses every library under root on a pool of processes.  Returns (records, failures, report).
+    start_time = time.monotonic()
+    files = find_library_files(root)
+    jobs = jobs or os.cpu_count() or 1
+    # Footprints are a few kilobytes each, so hand the files out in batches of about the same size
+    target_size = max(1, sum(size for path, size in files) // (jobs * 8))
+    batches = []
+    batch = []
+    batch_size = 0
+    for relative_path, size in files:
+        batch.append(relative_path)
+        batch_size += size
+        if batch_size >= target_size:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if batch:
+        batches.append(batch)
+
+    records = []
+    failures = {}
+    if jobs == 1:
+        results = map(lambda batch: parse_files(root, batch), batches)
+        for batch_records, batch_failures in results:
+            records.extend(batch_records)
+            failures.update(batch_failures)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for batch_records, batch_failures in executor.map(parse_files, [root] * len(batches), batches):
+                records.extend(batch_records)
+                failures.update(batch_failures)
+
+    elapsed_time = time.monotonic() - start_time
+    total_size = sum(size for path, size in files)
+    report = {"jobs": jobs, "files": len(files), "bytes": total_size, "failures": len(failures),
+              "symbols": sum(1 for record in records if record[0] == SYMBOL),
+              "footprints": sum(1 for record in records if record[0] == FOOTPRINT),
+              "elapsed_time": elapsed_time,
+              "mb_per_second": total_size / 1024 ** 2 / elapsed_time if elapsed_time else 0,
+              "files_per_second": len(files) / elapsed_time if elapsed_time else 0}
+    return records, failures, report
+
+
+def get_sort_key(record):
+    return record[0], record[2].casefold(), record[1].casefold(), record[2], record[1]
+
+
+def get_words(record):
+    words = set()
+    for text in (record[1], record[2], record[3], record[4]):
+        words.update(WORD_RE.findall(text.casefold()))
+    return words
+
+
+def write_index(records, index_path):
+    records = sorted(records, key=get_sort_key)
+    strings = {}
+
+    def intern(value):
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    postings_by_word = {}
+    packed_records = []
+    for number, record in enumerate(records):
+        kind, library, name, keywords, description, count, relative_path, offset, length = record
+        packed_records.append(RECORD.pack(kind, count, intern(library), intern(name), intern(keywords),
+                                          intern(description), intern(relative_path), offset, length))
+        for word in get_words(record):
+            postings_by_word.setdefault(word, []).append(number)
+
+    packed_words = []
+    postings = []
+    for word in sorted(postings_by_word):
+        packed_words.append(WORD.pack(intern(word), len(postings), len(postings_by_word[word])))
+        postings.extend(postings_by_word[word])
+
+    packed_strings = []
+    string_data = []
+    string_offset = 0
+    for value in strings:
+        encoded = value.encode("utf-8")
+        packed_strings.append(STRING.pack(string_offset, len(encoded)))
+        string_data.append(encoded)
+        string_offset += len(encoded)
+
+    records_offset = HEADER.size
+    strings_offset = records_offset + RECORD.size * len(packed_records)
+    words_offset = strings_offset + STRING.size * len(packed_strings)
+    postings_offset = words_offset + WORD.size * len(packed_words)
+    string_data_offset = postings_offset + POSTING.size * len(postings)
+    header = HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(packed_records), records_offset, len(packed_strings),
+                         strings_offset, len(packed_words), words_offset, postings_offset, string_data_offset, 0, 0)
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(b"".join(packed_records))
+        f.write(b"".join(packed_strings))
+        f.write(b"".join(packed_words))
+        f.write(struct.pack("<{}I".format(len(postings)), *postings))
+        f.write(b"".join(string_data))
+    os.replace(tmp_path, index_path)
+    return os.path.getsize(index_path)
+
+
+class LibraryIndex:
+    # Reads an index written by write_index.  Entries are dicts with the kind ("symbol" or "footprint"), library,
+    # name, keywords, description, count of pins or pads, and the path, relative to SharedSupport, offset and length
+    # of the symbol or footprint in its file.
+
+    def __init__(self, index_path):
+        self.f = open(index_path, "rb")
+        try:
+            self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.f.close()
+            raise LibraryIndexError("{} is empty".format(index_path))
+        header = HEADER.unpack_from(self.data) if len(self.data) >= HEADER.size else None
+        if not header or header[0] != INDEX_MAGIC or header[1] != INDEX_VERSION:
+            self.close()
+            raise LibraryIndexError("{} is not a version {} library index. Rebuild it.".format(index_path,
+                                                                                                INDEX_VERSION))
+        (self.record_count, self.records_offset, self.string_count, self.strings_offset, self.word_count,
+         self.words_offset, self.postings_offset, self.string_data_offset) = header[2:10]
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.record_count
+
+    def __getitem__(self, number):
+        if not 0 <= number < self.record_count:
+            raise IndexError(number)
+        kind, count, library, name, keywords, description, path, offset, length = RECORD.unpack_from(
+            self.data, self.records_offset + number * RECORD.size)
+        return {"kind": KINDS[kind], "library": self.get_string(library), "name": self.get_string(name),
+                "keywords": self.get_string(keywords), "description": self.get_string(description), "count": count,
+                "path": self.get_string(path), "offset": offset, "length": length}
+
+    def __iter__(self):
+        return (self[number] for number in range(self.record_count))
+
+    def get_string(self, number):
+        offset, length = STRING.unpack_from(self.data, self.strings_offset + number * STRING.size)
+        start = self.string_data_offset + offset
+        return self.data[start:start + length].decode("utf-8")
+
+    def get_record_key(self, number):
+        kind, count, library, name = RECORD.unpack_from(self.data, self.records_offset + number * RECORD.size)[:4]
+        return kind, self.get_string(name).casefold()
+
+    def get_word(self, number):
+        return self.get_string(WORD.unpack_from(self.data, self.words_offset + number * WORD.size)[0])
+
+    def bisect(self, count, get_key, key):
+        # The first of count items whose key isn't less than key
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if get_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, name, kind=None):
+        # Returns the entries named name, ignoring case, from every library
+        entries = []
+        for kind_number in ([KINDS.index(kind)] if kind else range(len(KINDS))):
+            key = (kind_number, name.casefold())
+            number = self.bisect(self.record_count, self.get_record_key, key)
+            while number < self.record_count and self.get_record_key(number) == key:
+                entries.append(self[number])
+                number += 1
+        return entries
+
+    def get_postings(self, prefix):
+        # The record numbers of every entry with a word that starts with prefix
+        numbers = set()
+        word_number = self.bisect(self.word_count, self.get_word, prefix)
+        while word_number < self.word_count:
+            string, first, count = WORD.unpack_from(self.data, self.words_offset + word_number * WORD.size)
+            if not self.get_string(string).startswith(prefix):
+                break
+            start = self.postings_offset + first * POSTING.size
+            numbers.update(struct.unpack_from("<{}I".format(count), self.data, start))
+            word_number += 1
+        return numbers
+
+    def search(self, query, kind=None, limit=None):
+        # Returns the entries with a word starting with each word of the query in their name, library, keywords or
+        # description.  Exact name matches come first, then names that start with the query, then the rest, by name.
+        terms = WORD_RE.findall(query.casefold())
+        if not terms:
+            return []
+        numbers = None
+        for term in sorted(terms, key=len, reverse=True):
+            postings = self.get_postings(term)
+            numbers = postings if numbers is None else numbers & postings
+            if not numbers:
+                return []
+        entries = [self[number] for number in sorted(numbers)]
+        if kind:
+            entries = [entry for entry in entries if entry["kind"] == kind]
+        folded_query = query.strip().casefold()
+
+        def rank(entry):
+            name = entry["name"].casefold()
+            return (0 if name == folded_query else 1 if name.startswith(folded_query) else 2), name, entry["library"]
+        entries.sort(key=rank)
+        return entries[:limit] if limit else entries
+
+    def read(self, entry, shared_support_dir):
+        # Returns the S-expression for an entry, from the library file it came from
+        with open(os.path.join(shared_support_dir, entry["path"]), "rb") as f:
+            f.seek(entry["offset"])
+            return f.read(entry["length"]).decode("utf-8")
+
+
+def build(root, index_path, report_path=None, jobs=None):
+    records, failures, report = parse_libraries(root, jobs)
+    for relative_path, message in sorted(failures.items()):
+        logging.warning("Unable to index {}: {}".format(relative_path, message))
+    report["index_bytes"] = write_index(records, index_path)
+    if report_path:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    logging.info("Indexed {} symbols and {} footprints from {} files ({:.1f} MB) in {:.1f} seconds, {:.1f} MB/s, {} "
+                 "failed. The index is {:.1f} MB.".format(report["symbols"], report["footprints"], report["files"],
+                                                          report["bytes"] / 1024 ** 2, report["elapsed_time"],
+                                                          report["mb_per_second"], report["failures"],
+                                                          report["index_bytes"] / 1024 ** 2))
+    return report
+
+
+def benchmark(root, jobs_list, repeat):
+    # Parses the libraries repeat times with each number of processes, and returns the best run of each
+    results = []
+    for jobs in jobs_list:
+        best = None
+        for _ in range(repeat):
+            report = parse_libraries(root, jobs)[2]
+            if best is None or report["elapsed_time"] < best["elapsed_time"]:
+                best = report
+        logging.info("{} processes: {} files ({:.1f} MB) in {:.2f} seconds, {:.1f} MB/s, {:.0f} files/s".format(
+            jobs, best["files"], best["bytes"] / 1024 ** 2, best["elapsed_time"], best["mb_per_second"],
+            best["files_per_second"]))
+        results.append(best)
+    return results
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Index the symbol and footprint libraries in KiCad.app, and search "
+                                                 "the index.")
+    subparsers = parser.add_subparsers(dest="subparser_name", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Parse the libraries and write the index.")
+    build_parser.add_argument("--output",
+                              help="Path to write the index to. Defaults to {} in the SharedSupport directory.".format(
+                                  DEFAULT_INDEX_FILENAME))
+    build_parser.add_argument("--report", help="Path to write a JSON report of the parse throughput to.")
+    build_parser.add_argument("--jobs", type=int,
+                              help="Number of processes to parse with. Defaults to the number of cores.")
+    build_parser.add_argument("shared_support",
+                              help="Directory with the symbols and footprints directories, like "
+                                   "KiCad.app/Contents/SharedSupport.")
+
+    search_parser = subparsers.add_parser("search", help="Search an index.")
+    search_parser.add_argument("--kind", choices=KINDS, help="Only return symbols or footprints.")
+    search_parser.add_argument("--limit", type=int, default=20, help="Most results to show. Defaults to 20.")
+    search_parser.add_argument("--exact", action="store_true", help="Look the query up as a name, ignoring case.")
+    search_parser.add_argument("index")
+    search_parser.add_argument("query", nargs="+")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Measure how fast the libraries parse.")
+    benchmark_parser.add_argument("--jobs", type=int, action="append", dest="jobs_list",
+                                  help="Number of processes to parse with. May be repeated. Defaults to 1 and the "
+                                       "number of cores.")
+    benchmark_parser.add_argument("--repeat", type=int, default=3,
+                                  help="Number of times to parse with each number of processes. The best is reported. "
+                                       "Defaults to 3.")
+    benchmark_parser.add_argument("--report", help="Path to write a JSON report of the results to.")
+    benchmark_parser.add_argument("shared_support")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    if args.subparser_name == "build":
+        build(args.shared_support, args.output or os.path.join(args.shared_support, DEFAULT_INDEX_FILENAME),
+              args.report, args.jobs)
+    elif args.subparser_name == "search":
+        try:
+            with LibraryIndex(args.index) as index:
+                query = " ".join(args.query)
+                entries = index.lookup(query, args.kind) if args.exact else index.search(query, args.kind, args.limit)
+        except LibraryIndexError as e:
+            logging.error(str(e))
+            sys.exit(1)
+        for entry in entries:
+            print("{kind} {library}:{name} ({count}) {description}".format(**entry))
+    elif args.subparser_name == "benchmark":
+        results = benchmark(args.shared_support, args.jobs_list or sorted({1, os.cpu_count() or 1}), args.repeat)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+
+# Reads Mach-O and fat (universal) headers and load commands without otool, file or lipo.
+# This lets us look at every binary in a bundle in one pass, instead of spawning a process per file, and it works on
+# any platform, since it only reads bytes.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import struct
+import sys
+
+logging.basicConfig(level=logging.INFO)
+
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+MH_CIGAM = 0xcefaedfe
+MH_CIGAM_64 = 0xcffaedfe
+
+# Static libraries, which lipo can put in fat files like any other slice
+ARCHIVE_MAGIC = b"!<arch>\n"
+ARCHIVE_MEMBER_HEADER_SIZE = 60
+# BSD ar puts long member names right after the header, and gives their length in the name field
+ARCHIVE_LONG_NAME_PREFIX = b"#1/"
+ARCHIVE_SYMBOL_TABLE_PREFIX = b"__.SYMDEF"
+
+MH_FILETYPES = {
+    0x1: "object",
+    0x2: "execute",
+    0x6: "dylib",
+    0x7: "dylinker",
+    0x8: "bundle",
+    0x9: "dylib_stub",
+    0xa: "dsym",
+}
+
+LC_REQ_DYLD = 0x80000000
+LC_SEGMENT = 0x1
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_SEGMENT_64 = 0x19
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LC_CODE_SIGNATURE = 0x1d
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+
+DYLIB_LOAD_COMMANDS = {LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB, LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB}
+
+CPU_TYPES = {
+    (7, False): "i386",
+    (7, True): "x86_64",
+    (12, False): "arm",
+    (12, True): "arm64",
+    (18, False): "ppc",
+    (18, True): "ppc64",
+}
+CPU_ARCH_ABI64 = 0x01000000
+CPU_ARCH_ABI64_32 = 0x02000000
+
+# References to these are expected to be found on the user's system, or are relative to the bundle.
+ALLOWED_REFERENCE_PREFIXES = ("/usr/", "/System/", "@executable_path/", "@rpath/", "@loader_path/")
+
+INDEX_VERSION = 1
+
+
+class MachOError(Exception):
+    pass
+
+
+def get_arch_name(cputype):
+    if cputype & CPU_ARCH_ABI64_32 and cputype & 0xffffff == 12:
+        return "arm64_32"
+    name = CPU_TYPES.get((cputype & 0xffffff, bool(cputype & CPU_ARCH_ABI64)))
+    if name is None:
+        return "cputype-{}".format(cputype)
+    return name
+
+
+def read_lc_str(command, offset):
+    return command[offset:].split(b"\0", 1)[0].decode("utf-8", errors="surrogateescape")
+
+
+def read_load_commands(f, offset):
+    # Reads the Mach-O header starting at offset in the file object f, and returns its fields along with each load
+    # command as (cmd, offset of the command within the slice, bytes).
+    f.seek(offset)
+    magic_bytes = f.read(4)
+    if len(magic_bytes) < 4:
+        raise MachOError("Truncated Mach-O header")
+    magic = struct.unpack(">I", magic_bytes)[0]
+    if magic in (MH_MAGIC, MH_MAGIC_64):
+        endian = ">"
+    elif magic in (MH_CIGAM, MH_CIGAM_64):
+        endian = "<"
+    else:
+        raise MachOError("Bad Mach-O magic 0x{:08x}".format(magic))
+    is_64 = magic in (MH_MAGIC_64, MH_CIGAM_64)
+
+    header = f.read(28 if is_64 else 24)
+    if len(header) < 24:
+        raise MachOError("Truncated Mach-O header")
+    cputype, cpusubtype, filetype, ncmds, sizeofcmds, flags = struct.unpack(endian + "iiIIII", header[:24])
+    header_size = 32 if is_64 else 28
+
+    commands = f.read(sizeofcmds)
+    if len(commands) < sizeofcmds:
+        raise MachOError("Truncated load commands")
+
+    load_commands = []
+    position = 0
+    for _ in range(ncmds):
+        if position + 8 > sizeofcmds:
+            raise MachOError("Load command extends past sizeofcmds")
+        cmd, cmdsize = struct.unpack(endian + "II", commands[position:position + 8])
+        if cmdsize < 8 or position + cmdsize > sizeofcmds:
+            raise MachOError("Bad load command size {}".format(cmdsize))
+        load_commands.append((cmd, header_size + position, commands[position:position + cmdsize]))
+        position += cmdsize
+
+    return {
+        "endian": endian,
+        "is_64": is_64,
+        "header_size": header_size,
+        "cputype": cputype,
+        "cpusubtype": cpusubtype,
+        "filetype": filetype,
+        "ncmds": ncmds,
+        "sizeofcmds": sizeofcmds,
+        "commands": load_commands,
+    }
+
+
+def get_lc_str_offset(header, command):
+    # The offset of the string in a dylib or rpath load command, which always comes right after cmd and cmdsize
+    return struct.unpack(header["endian"] + "I", command[8:12])[0]
+
+
+def get_first_section_offset(header):
+    # The file offset of the first section's contents, which is where the space for load commands ends.  Returns
+    # None if there are no sections with contents in the file.
+    first = None
+    for cmd, _, command in header["commands"]:
+        if cmd == LC_SEGMENT_64:
+            segment_format, section_format, section_offset_field = "16sQQQQiiII", "16s16sQQIIIIIIII", 48
+        elif cmd == LC_SEGMENT:
+            segment_format, section_format, section_offset_field = "16sIIIIiiII", "16s16sIIIIIIIII", 40
+        else:
+            continue
+        segment_size = 8 + struct.calcsize(header["endian"] + segment_format)
+        section_size = struct.calcsize(header["endian"] + section_format)
+        nsects = struct.unpack(header["endian"] + segment_format, command[8:segment_size])[-2]
+        for i in range(nsects):
+            section = command[segment_size + i * section_size:segment_size + (i + 1) * section_size]
+            section_offset = struct.unpack(header["endian"] + "I",
+                                           section[section_offset_field:section_offset_field + 4])[0]
+            if section_offset and (first is None or section_offset < first):
+                first = section_offset
+    return first
+
+
+def parse_slice(f, offset):
+    # Parses the Mach-O header and load commands starting at offset in the file object f.
+    header = read_load_commands(f, offset)
+
+    result = {
+        "arch": get_arch_name(header["cputype"]),
+        "cputype": header["cputype"],
+        "cpusubtype": header["cpusubtype"] & 0xffffff,
+        "filetype": MH_FILETYPES.get(header["filetype"], str(header["filetype"])),
+        "id": None,
+        "dylibs": [],
+        "rpaths": [],
+        "signed": False,
+    }
+
+    for cmd, _, command in header["commands"]:
+        if cmd in DYLIB_LOAD_COMMANDS:
+            result["dylibs"].append(read_lc_str(command, get_lc_str_offset(header, command)))
+        elif cmd == LC_ID_DYLIB:
+            result["id"] = read_lc_str(command, get_lc_str_offset(header, command))
+        elif cmd == LC_RPATH:
+            result["rpaths"].append(read_lc_str(command, get_lc_str_offset(header, command)))
+        elif cmd == LC_CODE_SIGNATURE:
+            result["signed"] = True
+
+    return result
+
+
+def parse_archive_slice(f, offset, size):
+    # Parses the static library of size bytes starting at offset in the file object f.  Its architecture is the one of
+    # the first Mach-O object in it, like lipo decides.
+    position = offset + len(ARCHIVE_MAGIC)
+    while position + ARCHIVE_MEMBER_HEADER_SIZE <= offset + size:
+        f.seek(position)
+        member_header = f.read(ARCHIVE_MEMBER_HEADER_SIZE)
+        if len(member_header) < ARCHIVE_MEMBER_HEADER_SIZE or member_header[58:60] != b"`\n":
+            raise MachOError("Bad archive member header at offset {}".format(position))
+        name = member_header[:16].rstrip(b" ")
+        try:
+            member_size = int(member_header[48:58])
+        except ValueError:
+            raise MachOError("Bad archive member size at offset {}".format(position))
+        data_offset = position + ARCHIVE_MEMBER_HEADER_SIZE
+        if name.startswith(ARCHIVE_LONG_NAME_PREFIX):
+            name_length = int(name[len(ARCHIVE_LONG_NAME_PREFIX):])
+            name = f.read(name_length).rstrip(b"\0")
+            data_offset += name_length
+        if not name.startswith(ARCHIVE_SYMBOL_TABLE_PREFIX):
+            f.seek(data_offset)
+            magic_bytes = f.read(4)
+            if len(magic_bytes) == 4 and struct.unpack(">I", magic_bytes)[0] in (MH_MAGIC, MH_MAGIC_64, MH_CIGAM,
+                                                                               MH_CIGAM_64):
+                header = read_load_commands(f, data_offset)
+                return {
+                    "arch": get_arch_name(header["cputype"]),
+                    "cputype": header["cputype"],
+                    "cpusubtype": header["cpusubtype"] & 0xffffff,
+                    "filetype": "archive",
+                    "id": None,
+                    "dylibs": [],
+                    "rpaths": [],
+                    "signed": False,
+                }
+        position += ARCHIVE_MEMBER_HEADER_SIZE + member_size
+        position += position % 2
+    raise MachOError("No Mach-O objects in the archive at offset {}".format(offset))
+
+
+def parse_macho(f, archives=False):
+    # Parses a thin or fat Mach-O file from the file object f.  Returns a dict with a list of slices, one per
+    # architecture, or None if the file isn't Mach-O.  Static libraries in fat files are always parsed, but thin ones
+    # are only treated as Mach-O if archives is True.
+    magic_bytes = f.read(8)
+    if len(magic_bytes) < 8:
+        return None
+    file_size = f.seek(0, os.SEEK_END)
+    f.seek(len(magic_bytes))
+    if magic_bytes == ARCHIVE_MAGIC:
+        if not archives:
+            return None
+        archive_slice = parse_archive_slice(f, 0, file_size)
+        archive_slice["offset"] = 0
+        archive_slice["size"] = file_size
+        return {"fat": False, "slices": [archive_slice]}
+    magic, nfat_arch = struct.unpack(">II", magic_bytes)
+
+    if magic in (FAT_MAGIC, FAT_MAGIC_64):
+        # Java class files share the fat magic; their "nfat_arch" is the class file version, which is >= 45
+        if nfat_arch == 0 or nfat_arch >= 45:
+            return None
+        is_64 = magic == FAT_MAGIC_64
+        entry_size = 32 if is_64 else 20
+        table = f.read(entry_size * nfat_arch)
+        if len(table) < entry_size * nfat_arch:
+            raise MachOError("Truncated fat header")
+        slices = []
+        for i in range(nfat_arch):
+            entry = table[i * entry_size:(i + 1) * entry_size]
+            if is_64:
+                cputype, cpusubtype, offset, size, align = struct.unpack(">iiQQI", entry[:28])
+            else:
+                cputype, cpusubtype, offset, size, align = struct.unpack(">iiIII", entry)
+            f.seek(offset)
+            if f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC:
+                macho_slice = parse_archive_slice(f, offset, size)
+            else:
+                macho_slice = parse_slice(f, offset)
+            macho_slice["offset"] = offset
+            macho_slice["size"] = size
+            macho_slice["align"] = align
+            slices.append(macho_slice)
+        return {"fat": True, "slices": slices}
+
+    if struct.unpack(">I", magic_bytes[:4])[0] not in (MH_MAGIC, MH_MAGIC_64, MH_CIGAM, MH_CIGAM_64):
+        return None
+    macho_slice = parse_slice(f, 0)
+    macho_slice["offset"] = 0
+    macho_slice["size"] = file_size
+    return {"fat": False, "slices": [macho_slice]}
+
+
+def read_macho(path, archives=False):
+    # Returns the parsed Mach-O details for path, or None if it isn't a Mach-O file.
+    with open(path, "rb") as f:
+        return parse_macho(f, archives)
+
+
+def get_default_align(cputype):
+    # lipo aligns arm slices to 16K pages, and everything else to 4K pages
+    return 14 if cputype & 0xffffff == 12 else 12
+
+
+def read_slices(path):
+    # Returns (cputype, cpusubtype, align, bytes) for each architecture in a thin or fat Mach-O file or static library.
+    with open(path, "rb") as f:
+        macho = parse_macho(f, archives=True)
+        if macho is None:
+            raise MachOError("{} is not a Mach-O file".format(path))
+        slices = []
+        for macho_slice in macho["slices"]:
+            f.seek(macho_slice["offset"])
+            data = f.read(macho_slice["size"])
+            align = macho_slice["align"] if macho["fat"] else get_default_align(macho_slice["cputype"])
+            slices.append((macho_slice["cputype"], macho_slice["cpusubtype"], align, data))
+    return slices
+
+
+def write_fat(output_path, input_paths):
+    # Combines the architectures of the input files into one fat file, like `lipo -create`.  Slices are ordered with
+    # arm64 last, like lipo does, and each is aligned as lipo would align it.
+    slices = {}
+    for input_path in input_paths:
+        for cputype, cpusubtype, align, data in read_slices(input_path):
+            key = (cputype, cpusubtype)
+            if key in slices:
+                raise MachOError("{} has {} more than once".format(output_path, get_arch_name(cputype)))
+            slices[key] = (cputype, cpusubtype, align, data)
+
+    ordered = sorted(slices.values(), key=lambda s: (s[2], s[0]))
+    offset = 8 + 20 * len(ordered)
+    entries = []
+    for cputype, cpusubtype, align, data in ordered:
+        offset = (offset + (1 << align) - 1) & ~((1 << align) - 1)
+        entries.append((cputype, cpusubtype, offset, len(data), align))
+        offset += len(data)
+    if offset > 0xffffffff:
+        raise MachOError("{} is too large for a 32-bit fat header".format(output_path))
+
+    with open(output_path, "wb") as f:
+        f.write(struct.pack(">II", FAT_MAGIC, len(entries)))
+        for entry in entries:
+            f.write(struct.pack(">iiIII", *entry))
+        for entry, (_, _, _, data) in zip(entries, ordered):
+            f.write(b"\0" * (entry[2] - f.tell()))
+            f.write(data)
+
+
+def summarize(macho):
+    # Flattens the slices of a parsed Mach-O file into the details most callers want.
+    summary = {
+        "fat": macho["fat"],
+        "archs": [],
+        "filetype": macho["slices"][0]["filetype"],
+        "id": None,
+        "dylibs": [],
+        "rpaths": [],
+        "signed": all(macho_slice["signed"] for macho_slice in macho["slices"]),
+        "slices": macho["slices"],
+    }
+    for macho_slice in macho["slices"]:
+        summary["archs"].append(macho_slice["arch"])
+        summary["id"] = summary["id"] or macho_slice["id"]
+        for key in ("dylibs", "rpaths"):
+            for value in macho_slice[key]:
+                if value not in summary[key]:
+                    summary[key].append(value)
+    return summary
+
+
+def index_file(path):
+    try:
+        macho = read_macho(path)
+    except (OSError, MachOError) as e:
+        return path, {"error": str(e)}
+    if macho is None:
+        return path, None
+    return path, summarize(macho)
+
+
+def find_candidate_files(root):
+    # Every regular file under root, without following symlinks, found with a single scandir walk.
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+        except OSError as e:
+            logging.warning("Unable to read {}: {}".format(directory, e))
+
+
+def build_index(root, jobs=None):
+    # Parses every Mach-O file under root in parallel, and returns the index as a dict keyed by path relative to root.
+    files = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        for path, details in executor.map(index_file, find_candidate_files(root), chunksize=64):
+            if details is not None:
+                files[os.path.relpath(path, root)] = details
+    return {"version": INDEX_VERSION, "root": os.path.abspath(root), "files": dict(sorted(files.items()))}
+
+
+def write_index(index, index_path):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def load_index(index_path):
+    with open(index_path) as f:
+        index = json.load(f)
+    if index.get("version") != INDEX_VERSION:
+        raise MachOError("{} is not a version {} Mach-O index. Rebuild it.".format(index_path, INDEX_VERSION))
+    return index
+
+
+def get_unreadable_files(index):
+    # Returns (path, error) for every file that looked like Mach-O but couldn't be parsed, like a truncated one
+    return [(path, details["error"]) for path, details in index["files"].items() if "error" in details]
+
+
+def get_bad_references(index):
+    # Returns (path, reference) for every install name or load command that points outside the bundle and the system.
+    bad = []
+    for path, details in index["files"].items():
+        if "error" in details:
+            continue
+        references = ([details["id"]] if details["id"] else []) + details["dylibs"]
+        for reference in references:
+            if not reference.startswith(ALLOWED_REFERENCE_PREFIXES):
+                bad.append((path, reference))
+    return bad
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Index and query the Mach-O files in a bundle.")
+    subparsers = parser.add_subparsers(dest="subparser_name", required=True)
+
+    index_parser = subparsers.add_parser("index", help="Parse every Mach-O file under a directory into an index.")
+    index_parser.add_argument("--jobs", type=int, help="Number of files to parse at once. Defaults to the number of cores.")
+    index_parser.add_argument("--output", "-o", required=True, help="Path to write the JSON index to.")
+    index_parser.add_argument("path", help="Directory to index, like a .app.")
+
+    list_parser = subparsers.add_parser("list", help="Print the relative path of each Mach-O file in an index. Files "
+                                                     "that can't be read are reported, and make the exit status 1.")
+    list_parser.add_argument("--arch", help="Only list files containing this architecture.")
+    list_parser.add_argument("index", help="Path to an index created with the index command.")
+
+    references_parser = subparsers.add_parser("bad-references",
+                                              help="Print references to libraries outside the bundle and the system, "
+                                                   "and Mach-O files that can't be read, and exit with status 1 if "
+                                                   "there are any.")
+    references_parser.add_argument("index", help="Path to an index created with the index command.")
+
+    show_parser = subparsers.add_parser("show", help="Print the indexed details of one file as JSON.")
+    show_parser.add_argument("index", help="Path to an index created with the index command.")
+    show_parser.add_argument("path", help="Path of the file, relative to the indexed directory.")
+
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+
+    if args.subparser_name == "index":
+        index = build_index(args.path, args.jobs)
+        write_index(index, args.output)
+        logging.info("Indexed {} Mach-O files under {}".format(len(index["files"]), args.path))
+    elif args.subparser_name == "list":
+        index = load_index(args.index)
+        for path, details in index["files"].items():
+            if "error" in details:
+                continue
+            if args.arch and args.arch not in details["archs"]:
+                continue
+            print(path)
+        unreadable = get_unreadable_files(index)
+        for path, error in unreadable:
+            print("{} can't be read: {}".format(path, error), file=sys.stderr)
+        if unreadable:
+            sys.exit(1)
+    elif args.subparser_name == "bad-references":
+        index = load_index(args.index)
+        unreadable = get_unreadable_files(index)
+        for path, error in unreadable:
+            print("{}:".format(path))
+            print("\tcan't be read: {}".format(error))
+        bad = get_bad_references(index)
+        last_path = None
+        for path, reference in bad:
+            if path != last_path:
+                print("{}:".format(path))
+                last_path = path
+            print("\t{}".format(reference))
+        if bad or unreadable:
+            sys.exit(1)
+    elif args.subparser_name == "show":
+        index = load_index(args.index)
+        if args.path not in index["files"]:
+            print("{} is not a Mach-O file in {}".format(args.path, args.index), file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(index["files"][args.path], indent=1))
+
+
+if __name__ == "__main__":
+    main()
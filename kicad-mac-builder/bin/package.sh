@@ -52,13 +52,9 @@ setup_dmg()
     # resize the template, and mount it
 
     if ! hdiutil resize -sectors "${DMG_SIZE}" "${TEMPLATE}"; then
-        hdiutil resize -limits kicadtemplate.dmg # TODO what is this? Does this work?
-        hdiutil resize -sectors 10167525 "${TEMPLATE}"
-        hdiutil resize -limits kicadtemplate.dmg
-        if ! hdiutil resize -sectors "${DMG_SIZE}" "${TEMPLATE}"; then
-          echo "Cannot resize template dmg, exiting."
-          exit 1
-        fi
+        echo "Cannot resize ${TEMPLATE} to ${DMG_SIZE} sectors. Its minimum, current and maximum sizes are:"
+        hdiutil resize -limits "${TEMPLATE}" || true
+        exit 1
     fi
     diskutil unmount /Volumes/"${MOUNT_NAME}" || true
     hdiutil attach "${TEMPLATE}" -noautoopen -mountpoint "${MOUNTPOINT}"
@@ -118,6 +114,9 @@ fixup_and_cleanup()
           --notarization-id "${DMG_NOTARIZATION_ID}" \
           --asc-provider "${ASC_PROVIDER}" \
           "${DMG_NAME}"
+      # apple.py keeps its state next to the DMG, so it can resume if it's interrupted.  Once it's done, the state
+      # isn't needed, and the DMG is about to be moved away from it.
+      rm -f ".${DMG_NAME}.notarization.json"
     fi
 
     mkdir -p "${DMG_DIR}"
@@ -191,7 +190,7 @@ case "${PACKAGE_TYPE}" in
     nightly)
         KICAD_GIT_REV=$(cd "${KICAD_SOURCE_DIR}" && git rev-parse --short HEAD)
         MOUNT_NAME='KiCad'
-        DMG_SIZE=15567525
+        DMG_SIZE=$("${SCRIPT_DIR}"/dmgsize.py --format sectors "${KICAD_INSTALL_DIR}" "${PACKAGING_DIR}"/background.png)
         if [ -z "$RELEASE_NAME" ]; then
             DMG_NAME=kicad-nightly-"${NOW}"-"${KICAD_GIT_REV}".dmg
         else
@@ -210,7 +209,7 @@ case "${PACKAGE_TYPE}" in
     unified)
         KICAD_GIT_REV=$(cd "${KICAD_SOURCE_DIR}" && git rev-parse --short HEAD)
         MOUNT_NAME='KiCad'
-        DMG_SIZE=15567525
+        DMG_SIZE=$("${SCRIPT_DIR}"/dmgsize.py --format sectors "${KICAD_INSTALL_DIR}" "${PACKAGING_DIR}"/background.png)
         if [ -z "$RELEASE_NAME" ]; then
             DMG_NAME=kicad-unified-"${NOW}"-"${KICAD_GIT_REV}".dmg
         else
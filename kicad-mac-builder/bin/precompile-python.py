@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Prepares the Python.framework inside KiCad.app: removes the parts of the standard library KiCad never uses, like the
+# test suites and IDLE, and then compiles every .py file, including wxPython, the pip requirements and pcbnew, into
+# checked-hash .pyc files with a pool of processes.  The bundle is read-only once it's signed, so anything not
+# precompiled here would be recompiled in memory every time the scripting console or an action plugin starts.
+
+# Checked-hash .pycs store a hash of their source instead of its mtime, so they stay valid when the bundle is copied
+# into the DMG and installed, and they're identical from build to build.  Files whose .pyc is already up to date are
+# skipped, so rerunning this is cheap.
+
+# The .pycs have to be written by the framework's own interpreter, so when this is run with a different Python, it
+# runs itself again with the framework's.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import glob
+import importlib.util
+import logging
+import os
+import py_compile
+import shutil
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+# Relative to the framework's version directory, like Python.framework/Versions/3.9
+DEFAULT_PRUNE_PATTERNS = [
+    "bin/idle*",
+    "lib/python*/idlelib",
+    "lib/python*/test",
+    "lib/python*/*/test",
+    "lib/python*/*/tests",
+    "lib/python*/turtledemo",
+    "lib/python*/tkinter/test",
+    "lib/python*/lib2to3/tests",
+    "share/doc",  # includes examples/Tools/pynche
+]
+
+# Flags in a .pyc header for a hash-based .pyc whose hash is checked against the source
+CHECKED_HASH_FLAGS = 0b11
+
+
+def get_version_dir(framework_path):
+    return os.path.realpath(os.path.join(framework_path, "Versions", "Current"))
+
+
+def get_framework_python(framework_path):
+    version_dir = get_version_dir(framework_path)
+    return os.path.join(version_dir, "bin", "python{}".format(os.path.basename(version_dir)))
+
+
+def is_framework_python(framework_path):
+    return os.path.realpath(sys.executable) == os.path.realpath(get_framework_python(framework_path))
+
+
+def prune(version_dir, patterns):
+    # Deletes whatever the patterns match.  Returns (number of files, bytes) removed.
+    files = 0
+    size = 0
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(version_dir, pattern))):
+            if not os.path.lexists(path):
+                # Inside something an earlier pattern already removed
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                for root, dirnames, filenames in os.walk(path):
+                    for filename in filenames:
+                        files += 1
+                        size += os.lstat(os.path.join(root, filename)).st_size
+                shutil.rmtree(path)
+            else:
+                files += 1
+                size += os.lstat(path).st_size
+                os.remove(path)
+            logging.debug("Pruned {}".format(os.path.relpath(path, version_dir)))
+    return files, size
+
+
+def find_sources(directories):
+    # Returns the .py files under the directories, and removes .pycs whose source is gone.
+    sources = []
+    for directory in directories:
+        for root, dirnames, filenames in os.walk(directory):
+            if os.path.basename(root) == "__pycache__":
+                source_dir = os.path.dirname(root)
+                for filename in filenames:
+                    module = filename.partition(".")[0]
+                    if filename.endswith(".pyc") and not os.path.exists(os.path.join(source_dir, module + ".py")):
+                        os.remove(os.path.join(root, filename))
+                continue
+            sources.extend(os.path.join(root, filename) for filename in filenames if filename.endswith(".py"))
+    return sorted(sources)
+
+
+def is_up_to_date(source_path, pyc_path):
+    try:
+        with open(pyc_path, "rb") as f:
+            header = f.read(16)
+        with open(source_path, "rb") as f:
+            source = f.read()
+    except OSError:
+        return False
+    return header[:4] == importlib.util.MAGIC_NUMBER and \
+        int.from_bytes(header[4:8], "little") == CHECKED_HASH_FLAGS and \
+        header[8:16] == importlib.util.source_hash(source)
+
+
+def compile_sources(source_paths):
+    # Runs in the worker processes.  Returns a list of (path, "compiled" | "up to date" | error message).
+    results = []
+    for source_path in source_paths:
+        pyc_path = importlib.util.cache_from_source(source_path)
+        if is_up_to_date(source_path, pyc_path):
+            results.append((source_path, "up to date"))
+            continue
+        try:
+            py_compile.compile(source_path, cfile=pyc_path, doraise=True,
+                               invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+            results.append((source_path, "compiled"))
+        except (py_compile.PyCompileError, OSError) as e:
+            results.append((source_path, str(e).strip()))
+    return results
+
+
+def precompile(source_paths, jobs=None):
+    # Returns ({"compiled": n, "up to date": n}, {path: error message}).
+    counts = {"compiled": 0, "up to date": 0}
+    failures = {}
+    jobs = jobs or os.cpu_count() or 1
+    # Most files take well under a millisecond to compile, so hand them out in batches
+    batch_size = max(1, min(64, len(source_paths) // (jobs * 4)))
+    batches = [source_paths[i:i + batch_size] for i in range(0, len(source_paths), batch_size)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for results in executor.map(compile_sources, batches):
+            for source_path, result in results:
+                if result in counts:
+                    counts[result] += 1
+                else:
+                    failures[source_path] = result
+    return counts, failures
+
+
+def prepare(framework_path, extra_directories, prune_patterns, jobs=None):
+    start_time = time.monotonic()
+    version_dir = get_version_dir(framework_path)
+    pruned_files, pruned_size = prune(version_dir, prune_patterns)
+
+    directories = [os.path.join(version_dir, "lib")]
+    for directory in extra_directories:
+        if os.path.isdir(directory):
+            directories.append(directory)
+        else:
+            logging.warning("Skipping {}, which isn't a directory".format(directory))
+
+    counts, failures = precompile(find_sources(directories), jobs)
+    for source_path, message in sorted(failures.items()):
+        # Some packages ship files that aren't meant to be imported, like Python 2 examples, so this isn't an error
+        logging.warning("Unable to compile {}: {}".format(source_path, message))
+
+    elapsed_time = time.monotonic() - start_time
+    logging.info("Pruned {} files ({:.1f} MB), compiled {} files, {} already up to date, {} failed, in {:.1f} "
+                 "seconds".format(pruned_files, pruned_size / 1024 ** 2, counts["compiled"], counts["up to date"],
+                                  len(failures), elapsed_time))
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Prune and precompile the Python.framework inside KiCad.app.")
+    parser.add_argument("--prune", action="append", dest="prune_patterns", default=[],
+                        help="Glob, relative to the framework's version directory, of something to remove, like "
+                             "lib/python*/ensurepip. May be repeated. Added to the default list.")
+    parser.add_argument("--no-default-prune", action="store_true",
+                        help="Don't remove the default list of unused parts: {}.".format(
+                            ", ".join(DEFAULT_PRUNE_PATTERNS)))
+    parser.add_argument("--jobs", type=int,
+                        help="Number of processes to compile with. Defaults to the number of cores.")
+    parser.add_argument("framework", help="Python.framework to prepare, like KiCad.app/Contents/Frameworks/Python.framework.")
+    parser.add_argument("directories", nargs="*",
+                        help="Other directories of Python to compile, like the one pcbnew.py is installed into.")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    if not is_framework_python(args.framework):
+        python = get_framework_python(args.framework)
+        # -B so the framework's Python doesn't write .pycs for this script into bin/
+        os.execv(python, [python, "-B", "-E", "-s", os.path.abspath(__file__)] + sys.argv[1:])
+
+    patterns = ([] if args.no_default_prune else DEFAULT_PRUNE_PATTERNS) + args.prune_patterns
+    prepare(args.framework, args.directories, patterns, args.jobs)
+
+
+if __name__ == "__main__":
+    main()
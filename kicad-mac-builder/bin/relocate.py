@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# Makes every Mach-O file in a bundle load its libraries from inside the bundle or from the system.
+# The whole bundle is indexed once with macho.py, and every install name change, install name ID and rpath each file
+# needs is planned before anything is modified.  References that can't be resolved are errors, and nothing is changed.
+# Each file is then rewritten in place when its load commands have room for the changes, or with a single
+# install_name_tool invocation when they don't.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import struct
+import subprocess
+import sys
+import time
+
+import macho
+
+logging.basicConfig(level=logging.INFO)
+
+# References to these are expected to be found on the user's system.  Unlike macho.ALLOWED_REFERENCE_PREFIXES, this
+# doesn't include all of /usr/, since /usr/local/ is where Homebrew is on Intel.
+SYSTEM_PREFIXES = ("/usr/lib/", "/System/")
+
+
+class RelocationError(Exception):
+    pass
+
+
+def get_library_key(path):
+    # What identifies a library regardless of where it is: the part from the .framework on for frameworks, like
+    # Python.framework/Versions/3.9/Python, and the file name for everything else.
+    parts = path.split("/")
+    for i, part in enumerate(parts):
+        if part.endswith(".framework"):
+            return "/".join(parts[i:])
+    return parts[-1]
+
+
+def get_executable_dirs(index):
+    # The directories @executable_path can refer to: those of the bundle's executables, like Contents/MacOS and the
+    # MacOS directories of the apps inside it.
+    return sorted({os.path.dirname(path) for path, details in index["files"].items()
+                   if details.get("filetype") == "execute"})
+
+
+def expand(reference, loader_dir, executable_dirs):
+    # Returns the bundle-relative paths a @loader_path or @executable_path reference could mean.
+    if reference.startswith("@loader_path/"):
+        return [os.path.normpath(os.path.join(loader_dir, reference[len("@loader_path/"):]))]
+    if reference.startswith("@executable_path/"):
+        return [os.path.normpath(os.path.join(executable_dir, reference[len("@executable_path/"):]))
+                for executable_dir in executable_dirs]
+    return []
+
+
+class Planner:
+
+    def __init__(self, index):
+        self.index = index
+        self.files = {path: details for path, details in index["files"].items() if "error" not in details}
+        self.executable_dirs = get_executable_dirs(index)
+        # dyld also searches the rpaths of the executable that's loading a library, so any executable's rpaths may be
+        # the ones that resolve a library's @rpath references.
+        self.executable_rpaths = {(os.path.dirname(path), rpath)
+                                  for path, details in self.files.items() if details["filetype"] == "execute"
+                                  for rpath in details["rpaths"]}
+        self.libraries = {}
+        for path in self.files:
+            self.libraries.setdefault(get_library_key(path), []).append(path)
+
+    def exists(self, relative_path):
+        return relative_path in self.files or os.path.exists(os.path.join(self.index["root"], relative_path))
+
+    def find_library(self, reference):
+        # Finds the file in the bundle a reference is meant to point at.  When there's more than one, the copy right in
+        # a Contents/Frameworks directory wins, rather than one deeper inside it, like in wxPython's site-packages.
+        key = get_library_key(reference)
+        candidates = self.libraries.get(key, [])
+        if len(candidates) > 1:
+            in_frameworks = [path for path in candidates
+                             if ("/" + path[:-len(key)].rstrip("/")).endswith("/Contents/Frameworks")]
+            if len(in_frameworks) == 1:
+                return in_frameworks[0]
+            raise RelocationError("{} could be any of {}".format(reference, ", ".join(sorted(candidates))))
+        return candidates[0] if candidates else None
+
+    def get_rpath_dirs(self, path, rpaths):
+        loader_dir = os.path.dirname(path)
+        dirs = []
+        for rpath in rpaths:
+            dirs.extend(expand(rpath.rstrip("/") + "/", loader_dir, self.executable_dirs))
+        for executable_dir, rpath in self.executable_rpaths:
+            dirs.extend(expand(rpath.rstrip("/") + "/", executable_dir, self.executable_dirs))
+        return dirs
+
+    def resolves(self, path, reference, rpaths):
+        loader_dir = os.path.dirname(path)
+        if reference.startswith("@rpath/"):
+            return any(self.exists(os.path.join(rpath_dir, reference[len("@rpath/"):]))
+                       for rpath_dir in self.get_rpath_dirs(path, rpaths))
+        return any(self.exists(candidate) for candidate in expand(reference, loader_dir, self.executable_dirs))
+
+    def plan_file(self, path, details):
+        # Returns ({"changes": [(old, new)], "id": new id or None, "add_rpaths": [...]}, [unresolved references])
+        loader_dir = os.path.dirname(path)
+        plan = {"changes": [], "id": None, "add_rpaths": []}
+        unresolved = []
+        rpaths = list(details["rpaths"])
+
+        if details["filetype"] == "dylib" and details["id"] and not details["id"].startswith(("@", ) + SYSTEM_PREFIXES):
+            plan["id"] = "@rpath/{}".format(get_library_key(path))
+
+        for reference in details["dylibs"]:
+            if reference.startswith(SYSTEM_PREFIXES):
+                continue
+            if reference.startswith("@") and self.resolves(path, reference, rpaths):
+                continue
+
+            target = self.find_library(reference)
+            if target is None:
+                unresolved.append(reference)
+                continue
+            if reference.startswith("@rpath/") and target.endswith("/" + reference[len("@rpath/"):]):
+                # The library is there, the file just doesn't have an rpath that finds it
+                target_dir = target[:-len(reference[len("@rpath/"):])].rstrip("/")
+                rpath = "@loader_path/{}".format(os.path.relpath(target_dir, loader_dir))
+                if rpath not in rpaths:
+                    rpaths.append(rpath)
+                    plan["add_rpaths"].append(rpath)
+            else:
+                plan["changes"].append((reference, "@loader_path/{}".format(os.path.relpath(target, loader_dir))))
+
+        return plan, unresolved
+
+    def plan(self):
+        # Returns ({path: plan} for the files that need changes, {path: [unresolved references]}).
+        plans = {}
+        unresolved = {}
+        for path, details in sorted(self.files.items()):
+            plan, file_unresolved = self.plan_file(path, details)
+            if plan["changes"] or plan["id"] or plan["add_rpaths"]:
+                plans[path] = plan
+            if file_unresolved:
+                unresolved[path] = file_unresolved
+        return plans, unresolved
+
+
+def get_rpath_command(header, rpath):
+    encoded = rpath.encode("utf-8") + b"\0"
+    alignment = 8 if header["is_64"] else 4
+    cmdsize = (12 + len(encoded) + alignment - 1) // alignment * alignment
+    return struct.pack(header["endian"] + "III", macho.LC_RPATH, cmdsize, 12) + encoded.ljust(cmdsize - 12, b"\0")
+
+
+def get_in_place_edits(data, slice_offset, plan):
+    # Works out the writes that apply the plan to one slice without moving anything.  Returns a list of
+    # (file offset, bytes), or None if the load commands don't have room.
+    f = io.BytesIO(data)
+    header = macho.read_load_commands(f, slice_offset)
+    changes = dict(plan["changes"])
+    edits = []
+
+    for cmd, command_offset, command in header["commands"]:
+        if cmd in macho.DYLIB_LOAD_COMMANDS or (cmd == macho.LC_ID_DYLIB and plan["id"]):
+            name_offset = macho.get_lc_str_offset(header, command)
+            name = macho.read_lc_str(command, name_offset)
+            new_name = plan["id"] if cmd == macho.LC_ID_DYLIB else changes.get(name)
+            if new_name is None:
+                continue
+            encoded = new_name.encode("utf-8") + b"\0"
+            if len(encoded) > len(command) - name_offset:
+                return None
+            edits.append((slice_offset + command_offset + name_offset, encoded.ljust(len(command) - name_offset, b"\0")))
+
+    if plan["add_rpaths"]:
+        new_commands = b"".join(get_rpath_command(header, rpath) for rpath in plan["add_rpaths"])
+        end_of_commands = header["header_size"] + header["sizeofcmds"]
+        first_section_offset = macho.get_first_section_offset(header)
+        if first_section_offset is None or end_of_commands + len(new_commands) > first_section_offset:
+            return None
+        padding = data[slice_offset + end_of_commands:slice_offset + end_of_commands + len(new_commands)]
+        if padding.strip(b"\0"):
+            return None
+        # codesign expects LC_CODE_SIGNATURE to stay last, so new commands go in front of it
+        last_cmd, last_offset, last_command = header["commands"][-1]
+        if last_cmd == macho.LC_CODE_SIGNATURE:
+            edits.append((slice_offset + last_offset, new_commands + last_command))
+        else:
+            edits.append((slice_offset + end_of_commands, new_commands))
+        ncmds_offset = slice_offset + 16
+        edits.append((ncmds_offset, struct.pack(header["endian"] + "II", header["ncmds"] + len(plan["add_rpaths"]),
+                                                header["sizeofcmds"] + len(new_commands))))
+    return edits
+
+
+def get_install_name_tool_command(path, plan):
+    command = ["install_name_tool"]
+    for old, new in plan["changes"]:
+        command.extend(["-change", old, new])
+    if plan["id"]:
+        command.extend(["-id", plan["id"]])
+    for rpath in plan["add_rpaths"]:
+        command.extend(["-add_rpath", rpath])
+    command.append(path)
+    return command
+
+
+def apply_plan(path, plan, in_place=True):
+    # Returns "in place" or "install_name_tool", depending on how the file was changed.
+    if in_place:
+        with open(path, "rb") as f:
+            data = f.read()
+        parsed = macho.parse_macho(io.BytesIO(data))
+        edits = []
+        for macho_slice in parsed["slices"]:
+            slice_edits = get_in_place_edits(data, macho_slice["offset"], plan)
+            if slice_edits is None:
+                edits = None
+                break
+            edits.extend(slice_edits)
+        if edits is not None:
+            with open(path, "r+b") as f:
+                for offset, edit in edits:
+                    f.seek(offset)
+                    f.write(edit)
+            return "in place"
+
+    subprocess.run(get_install_name_tool_command(path, plan), check=True, stdout=subprocess.PIPE,
+                   stderr=subprocess.STDOUT)
+    return "install_name_tool"
+
+
+def relocate(bundle_path, jobs=None, in_place=True, dry_run=False):
+    # Plans and applies the changes for a bundle.  Returns the plans.  Raises RelocationError, without changing
+    # anything, if any references can't be resolved.
+    start_time = time.monotonic()
+    index = macho.build_index(bundle_path, jobs)
+    plans, unresolved = Planner(index).plan()
+    if unresolved:
+        lines = []
+        for path, references in sorted(unresolved.items()):
+            lines.append("{}:".format(path))
+            lines.extend("\t{}".format(reference) for reference in references)
+        raise RelocationError("Unable to find these libraries in {} or the system:\n{}".format(
+            bundle_path, "\n".join(lines)))
+    if dry_run:
+        return plans
+
+    methods = {"in place": 0, "install_name_tool": 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        futures = {executor.submit(apply_plan, os.path.join(bundle_path, path), plan, in_place): path
+                   for path, plan in plans.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                methods[future.result()] += 1
+            except subprocess.CalledProcessError as e:
+                raise RelocationError("install_name_tool failed on {}:\n{}".format(
+                    futures[future], e.output.decode("utf-8", errors="replace")))
+
+    elapsed_time = time.monotonic() - start_time
+    logging.info("Relocated {} files, {} in place and {} with install_name_tool, in {:.1f} seconds".format(
+        len(plans), methods["in place"], methods["install_name_tool"], elapsed_time))
+    return plans
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Make the Mach-O files in a bundle load libraries from the bundle.")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of files to parse or change at once. Defaults to the number of cores.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the planned changes as JSON, and change nothing.")
+    parser.add_argument("--no-in-place", dest="in_place", action="store_false",
+                        help="Always use install_name_tool, even when a file could be changed in place.")
+    parser.add_argument("path", help="Bundle to relocate, like KiCad.app.")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    try:
+        plans = relocate(args.path, args.jobs, args.in_place, args.dry_run)
+    except RelocationError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    if args.dry_run:
+        print(json.dumps(plans, indent=1, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# Mirrors an install directory, like the output of the footprints or packages3d projects, into a directory inside
+# KiCad.app.  A manifest of what was staged last time, with each file's size, mtime and hash, lets a rebuild copy only
+# the files that changed and delete the ones that went away.  Files are hardlinked when the source and destination are
+# on the same filesystem, cloned when the filesystem supports it, and copied otherwise.
+
+# Several install directories are staged into the same destination, so only the files listed in this source's manifest
+# are ever deleted.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+MANIFEST_VERSION = 1
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def walk_source(root):
+    # Returns {relative path: os.stat_result} for the files and symlinks under root, without following symlinks.
+    entries = {}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    entries[os.path.relpath(entry.path, root)] = entry.stat(follow_symlinks=False)
+    return entries
+
+
+def load_manifest(manifest_path, source, destination):
+    # A manifest for a different source or destination tells us nothing about what's in this destination.
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("source") != source or \
+            manifest.get("destination") != destination:
+        return {}
+    return manifest.get("files", {})
+
+
+def write_manifest(manifest_path, source, destination, files):
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "source": source, "destination": destination, "files": files}, f)
+    os.replace(tmp_path, manifest_path)
+
+
+_clonefile = None
+
+
+def clone_file(source, destination):
+    # Uses clonefile(2) on macOS, so APFS shares the blocks until one of the files is modified.  Returns False when
+    # cloning isn't possible, like across volumes or on other filesystems.
+    global _clonefile
+    if sys.platform != "darwin":
+        return False
+    if _clonefile is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _clonefile = libc.clonefile
+        _clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    return _clonefile(os.fsencode(source), os.fsencode(destination), 0) == 0
+
+
+def stage_file(source, destination, use_links):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if use_links:
+        try:
+            os.link(source, destination)
+            return "linked"
+        except OSError:
+            pass
+    if clone_file(source, destination):
+        return "cloned"
+    shutil.copy2(source, destination)
+    return "copied"
+
+
+def destination_is_intact(destination, entry):
+    # Later steps may replace identical files with symlinks to each other, so follow symlinks and only compare sizes.
+    try:
+        return os.stat(destination).st_size == entry["size"]
+    except OSError:
+        return False
+
+
+def is_same_file(source, destination):
+    try:
+        return os.path.samefile(source, destination) and not os.path.islink(destination)
+    except OSError:
+        return False
+
+
+def plan(source, destination, previous_files, jobs=None):
+    # Works out which files need to be staged.  Returns (new manifest entries, paths to stage, paths to delete).
+    current = walk_source(source)
+    files = {}
+    to_stage = []
+    to_hash = []
+    # Hardlinked files that were rewritten in place, so don't need staging, but whose content changed
+    changed_in_place = []
+
+    for relative_path, st in current.items():
+        previous = previous_files.get(relative_path)
+        if os.path.islink(os.path.join(source, relative_path)):
+            entry = {"symlink": os.readlink(os.path.join(source, relative_path))}
+            files[relative_path] = entry
+            if previous != entry or not os.path.lexists(os.path.join(destination, relative_path)):
+                to_stage.append(relative_path)
+            continue
+
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": None}
+        files[relative_path] = entry
+        if previous is None or "symlink" in previous or \
+                not destination_is_intact(os.path.join(destination, relative_path), previous):
+            to_stage.append(relative_path)
+        elif (previous["size"], previous["mtime_ns"]) == (entry["size"], entry["mtime_ns"]):
+            entry["sha256"] = previous["sha256"]
+        elif is_same_file(os.path.join(source, relative_path), os.path.join(destination, relative_path)):
+            # Hardlinked last time, so whatever happened to the source happened to the destination too
+            changed_in_place.append(relative_path)
+        elif previous["size"] != entry["size"]:
+            to_stage.append(relative_path)
+        else:
+            # Touched, but maybe not changed, like when a project reinstalls everything
+            to_hash.append(relative_path)
+
+    def hash_pair(relative_path):
+        # Files aren't hashed when they're staged, so the first time one is touched, compare it to the staged copy
+        previous_sha256 = previous_files[relative_path]["sha256"] or \
+            hash_file(os.path.join(destination, relative_path))
+        return hash_file(os.path.join(source, relative_path)), previous_sha256
+
+    if to_hash:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            for relative_path, (sha256, previous_sha256) in zip(to_hash, executor.map(hash_pair, to_hash)):
+                files[relative_path]["sha256"] = sha256
+                if sha256 != previous_sha256:
+                    to_stage.append(relative_path)
+
+    to_delete = sorted(set(previous_files) - set(current))
+
+    # dedupe.py replaces duplicate files with symlinks to an identical file.  If that file is changing or going away,
+    # the files that link to it have to be staged again too.
+    changing = {os.path.join(destination, relative_path) for relative_path in to_stage + to_delete + changed_in_place}
+    if changing:
+        for relative_path, entry in files.items():
+            destination_path = os.path.join(destination, relative_path)
+            if "symlink" in entry or relative_path in to_stage or not os.path.islink(destination_path):
+                continue
+            link_target = os.path.normpath(os.path.join(os.path.dirname(destination_path),
+                                                        os.readlink(destination_path)))
+            if link_target in changing:
+                to_stage.append(relative_path)
+
+    return files, sorted(set(to_stage)), to_delete
+
+
+def remove_empty_parents(path, root):
+    directory = os.path.dirname(path)
+    while directory != root and directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def stage(source, destination, manifest_path, use_links=True, jobs=None):
+    # Makes destination contain everything in source, and returns counts of what was done.
+    start_time = time.monotonic()
+    source = os.path.abspath(source)
+    destination = os.path.abspath(destination)
+    previous_files = load_manifest(manifest_path, source, destination)
+    files, to_stage, to_delete = plan(source, destination, previous_files, jobs)
+    counts = {"unchanged": len(files) - len(to_stage), "linked": 0, "cloned": 0, "copied": 0, "symlinked": 0,
+              "deleted": 0}
+
+    for relative_path in to_delete:
+        path = os.path.join(destination, relative_path)
+        if os.path.lexists(path):
+            os.remove(path)
+            counts["deleted"] += 1
+            remove_empty_parents(path, destination)
+
+    for relative_path in to_stage:
+        os.makedirs(os.path.dirname(os.path.join(destination, relative_path)), exist_ok=True)
+
+    def handle(relative_path):
+        source_path = os.path.join(source, relative_path)
+        destination_path = os.path.join(destination, relative_path)
+        if "symlink" in files[relative_path]:
+            if os.path.lexists(destination_path):
+                os.remove(destination_path)
+            os.symlink(files[relative_path]["symlink"], destination_path)
+            return "symlinked"
+        return stage_file(source_path, destination_path, use_links)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        for result in executor.map(handle, to_stage):
+            counts[result] += 1
+
+    # Only record the manifest once everything is staged, so an interrupted run starts over rather than trusting it
+    write_manifest(manifest_path, source, destination, files)
+
+    elapsed_time = time.monotonic() - start_time
+    logging.debug("Staging took {} seconds".format(elapsed_time))
+    return counts
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Mirror an install directory into a directory inside KiCad.app.")
+    parser.add_argument("--manifest", required=True,
+                        help="Path to the manifest of what was staged last time. Keep one per source.")
+    parser.add_argument("--copy", action="store_true",
+                        help="Always clone or copy files, instead of hardlinking them.")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of files to hash or stage at once. Defaults to the number of cores.")
+    parser.add_argument("source", help="Directory to stage, like the footprints install directory.")
+    parser.add_argument("destination", help="Directory to stage into, like KiCad.app/Contents/SharedSupport.")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    counts = stage(args.source, args.destination, args.manifest, use_links=not args.copy, jobs=args.jobs)
+    logging.info("Staged {} into {}: {}".format(args.source, args.destination,
+                                                ", ".join("{} {}".format(count, result)
+                                                          for result, count in counts.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Merges two single-architecture trees, like the ones `ditto --arch` creates, into one Universal tree.
+# Each file is looked at once: identical files are hardlinked (or copied, across filesystems), Mach-O files and static
+# libraries are combined into fat files by a pool of workers, like `lipo -create`, and files that only exist in one of
+# the trees are reported rather than silently skipped.
+
+# Try not to use any packages that aren't included with Python, please.
+
+import argparse
+import concurrent.futures
+import filecmp
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import macho
+
+logging.basicConfig(level=logging.INFO)
+
+
+def walk_tree(root):
+    # Returns {relative path: "dir" | "file" | "symlink"} for everything under root, without following symlinks.
+    entries = {}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                relative_path = os.path.relpath(entry.path, root)
+                if entry.is_symlink():
+                    entries[relative_path] = "symlink"
+                elif entry.is_dir():
+                    entries[relative_path] = "dir"
+                    stack.append(entry.path)
+                else:
+                    entries[relative_path] = "file"
+    return entries
+
+
+def is_macho(path):
+    try:
+        return macho.read_macho(path, archives=True) is not None
+    except (OSError, macho.MachOError):
+        return False
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def copy_entry(source, destination, kind):
+    if kind == "symlink":
+        os.symlink(os.readlink(source), destination)
+    else:
+        link_or_copy(source, destination)
+
+
+def merge_macho(first_path, second_path, output_path):
+    macho.write_fat(output_path, [first_path, second_path])
+    shutil.copystat(first_path, output_path)
+
+
+def classify(first_root, second_root, relative_path):
+    # Decides what to do with a file that exists in both trees.
+    first_path = os.path.join(first_root, relative_path)
+    second_path = os.path.join(second_root, relative_path)
+    first_is_macho = is_macho(first_path)
+    second_is_macho = is_macho(second_path)
+    if first_is_macho and second_is_macho:
+        return "merge"
+    if first_is_macho or second_is_macho:
+        return "mismatched"
+    if filecmp.cmp(first_path, second_path, shallow=False):
+        return "identical"
+    return "differing"
+
+
+def merge_trees(first_root, second_root, output_root, jobs=None):
+    # Merges first_root and second_root into output_root, which must not exist yet.  When non-Mach-O files differ,
+    # the version from first_root is used.  Returns a report of what was done.
+    start_time = time.monotonic()
+    first_entries = walk_tree(first_root)
+    second_entries = walk_tree(second_root)
+
+    report = {
+        "first": os.path.abspath(first_root),
+        "second": os.path.abspath(second_root),
+        "output": os.path.abspath(output_root),
+        "merged": [],
+        "identical": 0,
+        "differing": [],
+        "mismatched": [],
+        "only_in_first": [],
+        "only_in_second": [],
+        "kind_conflicts": [],
+    }
+
+    os.makedirs(output_root)
+    for relative_path in sorted(set(first_entries) | set(second_entries)):
+        if first_entries.get(relative_path) == "dir" or second_entries.get(relative_path) == "dir":
+            os.makedirs(os.path.join(output_root, relative_path), exist_ok=True)
+
+    common_files = []
+    for relative_path in sorted(set(first_entries) | set(second_entries)):
+        first_kind = first_entries.get(relative_path)
+        second_kind = second_entries.get(relative_path)
+        if "dir" in (first_kind, second_kind):
+            if first_kind != second_kind and None not in (first_kind, second_kind):
+                report["kind_conflicts"].append(relative_path)
+            continue
+
+        destination = os.path.join(output_root, relative_path)
+        if second_kind is None:
+            report["only_in_first"].append(relative_path)
+            copy_entry(os.path.join(first_root, relative_path), destination, first_kind)
+        elif first_kind is None:
+            report["only_in_second"].append(relative_path)
+            copy_entry(os.path.join(second_root, relative_path), destination, second_kind)
+        elif first_kind == "symlink" or second_kind == "symlink":
+            if first_kind != second_kind or \
+                    os.readlink(os.path.join(first_root, relative_path)) != \
+                    os.readlink(os.path.join(second_root, relative_path)):
+                report["kind_conflicts"].append(relative_path)
+            copy_entry(os.path.join(first_root, relative_path), destination, first_kind)
+        else:
+            common_files.append(relative_path)
+
+    def handle(relative_path):
+        first_path = os.path.join(first_root, relative_path)
+        second_path = os.path.join(second_root, relative_path)
+        destination = os.path.join(output_root, relative_path)
+        result = classify(first_root, second_root, relative_path)
+        if result == "merge":
+            merge_macho(first_path, second_path, destination)
+        else:
+            link_or_copy(first_path, destination)
+        return relative_path, result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        for relative_path, result in executor.map(handle, common_files):
+            if result == "identical":
+                report["identical"] += 1
+            else:
+                report["merged" if result == "merge" else result].append(relative_path)
+
+    for key in report:
+        if isinstance(report[key], list):
+            report[key].sort()
+
+    elapsed_time = time.monotonic() - start_time
+    logging.debug("Merging took {} seconds".format(elapsed_time))
+    return report
+
+
+def parse_args(arg_list=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Merge two single-architecture trees into a Universal tree.")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of files to compare or merge at once. Defaults to the number of cores.")
+    parser.add_argument("--report", help="Path to write a JSON report of the merge to.")
+    parser.add_argument("--strict", action="store_true",
+                        help="Exit with an error if any files exist in only one tree, or differ without being Mach-O.")
+    parser.add_argument("first", help="First tree, like the output of `ditto --arch arm64`. Used when files differ.")
+    parser.add_argument("second", help="Second tree, like the output of `ditto --arch x86_64`.")
+    parser.add_argument("output", help="Directory to create the merged tree in. Must not exist.")
+    return parser.parse_args(arg_list)
+
+
+def main():
+    args = parse_args()
+    report = merge_trees(args.first, args.second, args.output, args.jobs)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+
+    logging.info("Merged {} Mach-O files, linked {} identical files".format(len(report["merged"]),
+                                                                           report["identical"]))
+    problems = False
+    for key, description in (("only_in_first", "only in {}".format(args.first)),
+                             ("only_in_second", "only in {}".format(args.second)),
+                             ("differing", "different and not Mach-O, used {}".format(args.first)),
+                             ("mismatched", "Mach-O in only one tree, used {}".format(args.first)),
+                             ("kind_conflicts", "a different kind of file in each tree, used {}".format(args.first))):
+        for relative_path in report[key]:
+            logging.warning("{} is {}".format(relative_path, description))
+            problems = True
+
+    if problems and args.strict:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,21 @@ if [ ! -e "$1" ]; then
     exit 1
 fi
 
+SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+
+INDEX=$(mktemp)
+trap 'rm -f "$INDEX"' EXIT
+
 echo "Checking $1 for non-relative and non-system references."
-find "$1" -type f -print0 | xargs -0 otool -L 2>/dev/null | grep '^\t' | grep -v '^\t/usr/\|^\t/System/\|^\t@executable_path/\|^\t@rpath/\|^\t@loader_path/'
-if [ "$?" -eq 1 ]; then
+if ! "${SCRIPT_DIR}/macho.py" index --output "$INDEX" "$1"; then
+    echo "Unable to index $1."
+    exit 1
+fi
+
+if "${SCRIPT_DIR}/macho.py" bad-references "$INDEX"; then
     echo "No issues found."
 else
     echo "Issues found."
     echo "References with issues are indented."
-    find "$1" -type f -print0 | xargs -0 otool -L 2>/dev/null | grep -v 'is not an object file' | grep -v '^\t/usr/\|^\t/System/\|^\t@executable_path/\|^\t@rpath/\|^\t@loader_path/'
     exit 1
 fi
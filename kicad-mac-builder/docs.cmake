@@ -1,19 +1,29 @@
-if ( SKIP_DOCS_UPDATE )
-    # Don't download docs from <URL>; use the contents of <DOWNLOAD_DIR> instead
-    set(docs_DOWNLOAD_COMMAND_OVERRIDE DOWNLOAD_COMMAND echo "Using contents of <DOWNLOAD_DIR> instead of downloading ${DOCS_TARBALL_URL}")
+# The docs tarball isn't extracted here.  bin/install-docs.py streams just the help out of it into KiCad.app.
+get_filename_component(docs_TARBALL_NAME ${DOCS_TARBALL_URL} NAME)
+
+if(DEFINED SHARED_ASSETS_BUILD_DIR)
+    # The docs were already downloaded in another build directory, like for the two halves of a universal build
+    add_custom_target(docs)
+    set(docs_TARBALL ${SHARED_ASSETS_BUILD_DIR}/docs/src/${docs_TARBALL_NAME})
 else()
-    set(docs_DOWNLOAD_COMMAND_OVERRIDE )
-endif()
+    if ( SKIP_DOCS_UPDATE )
+        # Don't download docs from <URL>; use the tarball already in <DOWNLOAD_DIR> instead
+        set(docs_DOWNLOAD_COMMAND_OVERRIDE DOWNLOAD_COMMAND echo "Using contents of <DOWNLOAD_DIR> instead of downloading ${DOCS_TARBALL_URL}")
+    else()
+        set(docs_DOWNLOAD_COMMAND_OVERRIDE )
+    endif()
 
-ExternalProject_Add(
-    docs
-    PREFIX  docs
-    URL ${DOCS_TARBALL_URL}
-    ${docs_DOWNLOAD_COMMAND_OVERRIDE}
-    CONFIGURE_COMMAND ""
-    BUILD_COMMAND ""
-    INSTALL_COMMAND ""
-)
+    ExternalProject_Add(
+        docs
+        PREFIX  docs
+        URL ${DOCS_TARBALL_URL}
+        DOWNLOAD_NO_EXTRACT 1
+        ${docs_DOWNLOAD_COMMAND_OVERRIDE}
+        CONFIGURE_COMMAND ""
+        BUILD_COMMAND ""
+        INSTALL_COMMAND ""
+    )
 
-ExternalProject_Get_Property(docs SOURCE_DIR)
-set(docs_SOURCE_DIR ${SOURCE_DIR} )
\ No newline at end of file
+    ExternalProject_Get_Property(docs DOWNLOAD_DIR)
+    set(docs_TARBALL ${DOWNLOAD_DIR}/${docs_TARBALL_NAME} )
+endif()
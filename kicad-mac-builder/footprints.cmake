@@ -1,10 +1,16 @@
-ExternalProject_Add(
-    footprints
-    PREFIX  footprints
-    GIT_REPOSITORY ${FOOTPRINTS_URL}
-    GIT_TAG ${FOOTPRINTS_TAG}
-    CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
-)
+if(DEFINED SHARED_ASSETS_BUILD_DIR)
+    # The footprints were already built in another build directory, like for the two halves of a universal build
+    add_custom_target(footprints)
+    set(footprints_INSTALL_DIR ${SHARED_ASSETS_BUILD_DIR}/footprints/src/footprints-build/output)
+else()
+    ExternalProject_Add(
+        footprints
+        PREFIX  footprints
+        GIT_REPOSITORY ${FOOTPRINTS_URL}
+        GIT_TAG ${FOOTPRINTS_TAG}
+        CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
+    )
 
-ExternalProject_Get_Property(footprints BINARY_DIR)
-set(footprints_INSTALL_DIR ${BINARY_DIR}/output)
+    ExternalProject_Get_Property(footprints BINARY_DIR)
+    set(footprints_INSTALL_DIR ${BINARY_DIR}/output)
+endif()
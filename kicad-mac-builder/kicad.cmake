@@ -64,10 +64,8 @@ ExternalProject_Add_Step(
     COMMENT "Installing docs into KiCad.app"
     DEPENDS docs
     DEPENDEES install
-    COMMAND mkdir -p ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/help/
-    COMMAND cp -r ${docs_SOURCE_DIR}/share/doc/kicad/help/ ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/help/
-    COMMAND find ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/help -name "*.epub" -type f -delete
-    COMMAND find ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/help -name "*.pdf" -type f -delete
+    COMMAND mkdir -p ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
+    COMMAND ${BIN_DIR}/install-docs.py ${docs_TARBALL} ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/help
 )
 
 ExternalProject_Add_Step(
@@ -88,7 +86,7 @@ ExternalProject_Add_Step(
     DEPENDS footprints
     DEPENDEES install
     COMMAND mkdir -p ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
-    COMMAND cp -r ${footprints_INSTALL_DIR}/. ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
+    COMMAND ${BIN_DIR}/stage.py --manifest ${CMAKE_BINARY_DIR}/staging/footprints.json ${footprints_INSTALL_DIR} ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
 )
 
 ExternalProject_Add_Step(
@@ -98,7 +96,7 @@ ExternalProject_Add_Step(
     DEPENDS symbols
     DEPENDEES install
     COMMAND mkdir -p ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
-    COMMAND cp -r ${symbols_INSTALL_DIR}/. ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
+    COMMAND ${BIN_DIR}/stage.py --manifest ${CMAKE_BINARY_DIR}/staging/symbols.json ${symbols_INSTALL_DIR} ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
 )
 
 ExternalProject_Add_Step(
@@ -108,7 +106,7 @@ ExternalProject_Add_Step(
     DEPENDS templates
     DEPENDEES install
     COMMAND mkdir -p ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
-    COMMAND cp -r ${templates_INSTALL_DIR}/. ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
+    COMMAND ${BIN_DIR}/stage.py --manifest ${CMAKE_BINARY_DIR}/staging/templates.json ${templates_INSTALL_DIR} ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
 )
 
 ExternalProject_Add_Step(
@@ -118,7 +116,36 @@ ExternalProject_Add_Step(
     DEPENDS packages3d
     DEPENDEES install
     COMMAND mkdir -p ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
-    COMMAND cp -r ${packages3d_INSTALL_DIR}/. ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
+    COMMAND ${BIN_DIR}/stage.py --manifest ${CMAKE_BINARY_DIR}/staging/packages3d.json ${packages3d_INSTALL_DIR} ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/
+)
+
+ExternalProject_Add_Step(
+    kicad
+    dedupe-libraries
+    COMMENT "Replacing duplicate footprint and 3D model files in KiCad.app with symlinks"
+    DEPENDEES install-footprints-into-app install-packages3d-into-app
+    COMMAND ${BIN_DIR}/dedupe.py --cache ${CMAKE_BINARY_DIR}/staging/dedupe.json --report ${CMAKE_BINARY_DIR}/staging/dedupe-report.json ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/3dmodels ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/footprints
+)
+
+ExternalProject_Add_Step(
+    kicad
+    index-libraries
+    COMMENT "Indexing the symbol and footprint libraries in KiCad.app"
+    DEPENDEES install-symbols-into-app install-footprints-into-app
+    COMMAND ${BIN_DIR}/libindex.py build --report ${CMAKE_BINARY_DIR}/staging/libindex-report.json --output ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/library-index.bin ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport
+)
+
+# PYTHON_PRUNE_PATTERNS can list more globs, relative to Python.framework/Versions/${PYTHON_X_Y_VERSION}, to leave out
+foreach( pattern ${PYTHON_PRUNE_PATTERNS} )
+    list( APPEND PYTHON_PRUNE_ARGS --prune ${pattern} )
+endforeach()
+
+ExternalProject_Add_Step(
+    kicad
+    prepare-python
+    COMMENT "Pruning and precompiling Python in KiCad.app"
+    DEPENDEES install
+    COMMAND ${BIN_DIR}/precompile-python.py ${PYTHON_PRUNE_ARGS} ${KICAD_INSTALL_DIR}/KiCad.app/Contents/Frameworks/Python.framework ${KICAD_INSTALL_DIR}/KiCad.app/Contents/Frameworks/python ${KICAD_INSTALL_DIR}/KiCad.app/Contents/SharedSupport/scripting
 )
 
 # if cmake REDISTRIBUTABLE is set, then do this step
@@ -127,11 +154,8 @@ if(DEFINED REDISTRIBUTABLE)
         kicad
         fix-loading
         COMMENT "Checking and fixing bundle to make sure it's relocatable"
-        DEPENDEES install-docs-into-app install collect-licenses install-footprints-into-app install-symbols-into-app install-templates-into-app install-packages3d-into-app # demos?
-        # Since we're currently ignoring the exit status, let's make sure wrangle-bundle is installed
-        COMMAND echo "Looking for wrangle-bundle..."
-        COMMAND which wrangle-bundle
-        COMMAND wrangle-bundle --fix --python-version ${PYTHON_X_Y_VERSION} ${KICAD_INSTALL_DIR}/kicad.app || true
+        DEPENDEES install-docs-into-app install collect-licenses install-footprints-into-app install-symbols-into-app install-templates-into-app install-packages3d-into-app dedupe-libraries index-libraries prepare-python # demos?
+        COMMAND ${BIN_DIR}/relocate.py ${KICAD_INSTALL_DIR}/KiCad.app
     )
 
     ExternalProject_Add_Step(
@@ -147,7 +171,7 @@ else()
             kicad
             sign-app
             COMMENT "Signing KiCad.app and its contents"
-            DEPENDEES install-docs-into-app install collect-licenses install-footprints-into-app install-symbols-into-app install-templates-into-app install-packages3d-into-app # demos?
+            DEPENDEES install-docs-into-app install collect-licenses install-footprints-into-app install-symbols-into-app install-templates-into-app install-packages3d-into-app dedupe-libraries index-libraries prepare-python # demos?
             # we can't modify KiCad.app after this without resigning
             COMMAND "${BIN_DIR}/apple.py" sign --certificate-id "${SIGNING_CERTIFICATE_ID}" ${HARDENED_RUNTIME_ARG} --entitlements "${BIN_DIR}/../signing/entitlements.plist" "${KICAD_INSTALL_DIR}/KiCad.app"
     )
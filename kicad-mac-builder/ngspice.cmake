@@ -3,7 +3,7 @@ include(ExternalProject)
 ExternalProject_Add(
     ngspice
     PREFIX  ngspice
-    GIT_REPOSITORY git://git.code.sf.net/p/ngspice/ngspice
+    GIT_REPOSITORY ${NGSPICE_URL}
     GIT_TAG ngspice-44
     UPDATE_COMMAND      ""
     PATCH_COMMAND       ""
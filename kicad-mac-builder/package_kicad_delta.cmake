@@ -0,0 +1,21 @@
+if( RELEASE_NAME )
+    set( DELTA_NAME_ARG --name ${RELEASE_NAME} )
+endif()
+
+ExternalProject_Add(
+    package-kicad-delta
+    DEPENDS kicad
+    PREFIX package-kicad-delta
+    DOWNLOAD_COMMAND ""
+    UPDATE_COMMAND   ""
+    PATCH_COMMAND ""
+    CONFIGURE_COMMAND ""
+    BUILD_COMMAND ""
+    INSTALL_COMMAND ${BIN_DIR}/delta.py package
+                    --base-dir ${DELTA_BASE_DIR}
+                    --output-dir ${DMG_DIR}
+                    ${DELTA_NAME_ARG}
+                    ${KICAD_INSTALL_DIR}
+)
+
+SET_TARGET_PROPERTIES(package-kicad-delta PROPERTIES EXCLUDE_FROM_ALL True)
@@ -1,11 +1,17 @@
-ExternalProject_Add(
-    packages3d
-    PREFIX  packages3d
-    GIT_REPOSITORY ${PACKAGES3D_URL}
-    GIT_TAG ${PACKAGES3D_TAG}
-    #GIT_PROGRESS 1 #TODO uncomment when the official KiCad CMake gets updated...
-    CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
-)
+if(DEFINED SHARED_ASSETS_BUILD_DIR)
+    # The packages3d were already built in another build directory, like for the two halves of a universal build
+    add_custom_target(packages3d)
+    set(packages3d_INSTALL_DIR ${SHARED_ASSETS_BUILD_DIR}/packages3d/src/packages3d-build/output)
+else()
+    ExternalProject_Add(
+        packages3d
+        PREFIX  packages3d
+        GIT_REPOSITORY ${PACKAGES3D_URL}
+        GIT_TAG ${PACKAGES3D_TAG}
+        #GIT_PROGRESS 1 #TODO uncomment when the official KiCad CMake gets updated...
+        CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
+    )
 
-ExternalProject_Get_Property(packages3d BINARY_DIR)
-set(packages3d_INSTALL_DIR ${BINARY_DIR}/output)
+    ExternalProject_Get_Property(packages3d BINARY_DIR)
+    set(packages3d_INSTALL_DIR ${BINARY_DIR}/output)
+endif()
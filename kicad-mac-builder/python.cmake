@@ -36,7 +36,7 @@ endif()
 ExternalProject_Add(
     python
     PREFIX  python
-    GIT_REPOSITORY https://github.com/gregneagle/relocatable-python.git
+    GIT_REPOSITORY ${RELOCATABLE_PYTHON_URL}
     GIT_TAG main
     CONFIGURE_COMMAND 	""
     UPDATE_COMMAND      ""
@@ -1,10 +1,16 @@
-ExternalProject_Add(
-    symbols
-    PREFIX  symbols
-    GIT_REPOSITORY ${SYMBOLS_URL}
-    GIT_TAG ${SYMBOLS_TAG}
-    CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
-)
+if(DEFINED SHARED_ASSETS_BUILD_DIR)
+    # The symbols were already built in another build directory, like for the two halves of a universal build
+    add_custom_target(symbols)
+    set(symbols_INSTALL_DIR ${SHARED_ASSETS_BUILD_DIR}/symbols/src/symbols-build/output)
+else()
+    ExternalProject_Add(
+        symbols
+        PREFIX  symbols
+        GIT_REPOSITORY ${SYMBOLS_URL}
+        GIT_TAG ${SYMBOLS_TAG}
+        CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
+    )
 
-ExternalProject_Get_Property(symbols BINARY_DIR)
-set(symbols_INSTALL_DIR ${BINARY_DIR}/output)
+    ExternalProject_Get_Property(symbols BINARY_DIR)
+    set(symbols_INSTALL_DIR ${BINARY_DIR}/output)
+endif()
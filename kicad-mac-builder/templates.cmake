@@ -1,10 +1,16 @@
-ExternalProject_Add(
-    templates
-    PREFIX  templates
-    GIT_REPOSITORY ${TEMPLATES_URL}
-    GIT_TAG ${TEMPLATES_TAG}
-    CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
-)
+if(DEFINED SHARED_ASSETS_BUILD_DIR)
+    # The templates were already built in another build directory, like for the two halves of a universal build
+    add_custom_target(templates)
+    set(templates_INSTALL_DIR ${SHARED_ASSETS_BUILD_DIR}/templates/src/templates-build/output)
+else()
+    ExternalProject_Add(
+        templates
+        PREFIX  templates
+        GIT_REPOSITORY ${TEMPLATES_URL}
+        GIT_TAG ${TEMPLATES_TAG}
+        CMAKE_ARGS "-DCMAKE_INSTALL_PREFIX=<BINARY_DIR>/output"
+    )
 
-ExternalProject_Get_Property(templates BINARY_DIR)
-set(templates_INSTALL_DIR ${BINARY_DIR}/output)
+    ExternalProject_Get_Property(templates BINARY_DIR)
+    set(templates_INSTALL_DIR ${BINARY_DIR}/output)
+endif()
@@ -12,7 +12,7 @@ endif()
 ExternalProject_Add(
     wxwidgets
     PREFIX  wxwidgets
-    GIT_REPOSITORY https://github.com/peterkaczorowski/wxWidgets_kicad_macos-wx-3.2
+    GIT_REPOSITORY ${WXWIDGETS_URL}
     GIT_TAG kicad/macos-wx-3.2-apng-nishikawa
     CONFIGURE_COMMAND   CPPFLAGS=-D__ASSERT_MACROS_DEFINE_VERSIONS_WITHOUT_UNDERSCORES=1 MAC_OS_X_VERSION_MIN_REQUIRED=${MACOS_MIN_VERSION} CC=clang CXX=clang++ ./configure
                         --prefix=${wxwidgets_INSTALL_DIR}
@@ -55,7 +55,7 @@ ExternalProject_Add(
     wxpython
     DEPENDS python wxwidgets
     BUILD_IN_SOURCE     1
-    GIT_REPOSITORY https://github.com/wxWidgets/Phoenix.git
+    GIT_REPOSITORY ${WXPYTHON_URL}
     GIT_TAG 78938da1218483024b3a7acf55b5fb5513882916
     UPDATE_COMMAND      ""
     PATCH_COMMAND       ""
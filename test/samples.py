@@ -0,0 +1,139 @@
+# Builds small synthetic Mach-O files and static libraries for the tests, so they run anywhere without a compiler.
+# They only have what macho.py, universal.py and relocate.py read: headers, load commands, a __TEXT segment with one
+# section, and a code signature blob.
+
+import os
+import struct
+
+CPU_TYPES = {"arm64": (0x0100000c, 0), "x86_64": (0x01000007, 3)}
+
+MH_MAGIC_64 = 0xfeedfacf
+MH_OBJECT = 0x1
+MH_EXECUTE = 0x2
+MH_DYLIB = 0x6
+
+LC_SEGMENT_64 = 0x19
+LC_ID_DYLIB = 0xd
+LC_LOAD_DYLIB = 0xc
+LC_RPATH = 0x8000001c
+LC_CODE_SIGNATURE = 0x1d
+
+SEGMENT_SIZE = 72
+SECTION_SIZE = 80
+
+
+def pad(data, alignment=8):
+    return data + b"\0" * (-len(data) % alignment)
+
+
+def dylib_command(cmd, name):
+    name_bytes = pad(name.encode("utf-8") + b"\0")
+    return struct.pack("<IIIIII", cmd, 24 + len(name_bytes), 24, 2, 0x10000, 0x10000) + name_bytes
+
+
+def rpath_command(path):
+    path_bytes = pad(path.encode("utf-8") + b"\0")
+    return struct.pack("<III", LC_RPATH, 12 + len(path_bytes), 12) + path_bytes
+
+
+def make_macho(arch="arm64", filetype=MH_DYLIB, install_id=None, dylibs=(), rpaths=(), signed=False, padding=256,
+               text=b"\xc0\x03\x5f\xd6" * 16):
+    # Returns the bytes of a thin 64-bit little-endian Mach-O file.  padding is the free space after the load
+    # commands, which is what install_name_tool, and relocate.py's in-place edits, have to work with.
+    commands = []
+    if install_id:
+        commands.append(dylib_command(LC_ID_DYLIB, install_id))
+    commands.extend(dylib_command(LC_LOAD_DYLIB, dylib) for dylib in dylibs)
+    commands.extend(rpath_command(rpath) for rpath in rpaths)
+    ncmds = len(commands) + 1 + (1 if signed else 0)
+    sizeofcmds = SEGMENT_SIZE + SECTION_SIZE + sum(len(command) for command in commands) + (16 if signed else 0)
+    text_offset = 32 + sizeofcmds + padding
+    signature_offset = text_offset + len(text)
+    signature = b"\xfa\xde\x0c\xc0" + b"\0" * 28
+
+    segment = struct.pack("<II16sQQQQiiII", LC_SEGMENT_64, SEGMENT_SIZE + SECTION_SIZE, b"__TEXT", 0,
+                          signature_offset, 0, signature_offset, 5, 5, 1, 0)
+    section = struct.pack("<16s16sQQIIIIIIII", b"__text", b"__TEXT", text_offset, len(text), text_offset, 2, 0, 0,
+                          0x80000400, 0, 0, 0)
+    commands.insert(0, segment + section)
+    if signed:
+        commands.append(struct.pack("<IIII", LC_CODE_SIGNATURE, 16, signature_offset, len(signature)))
+
+    cputype, cpusubtype = CPU_TYPES[arch]
+    header = struct.pack("<IiiIIIII", MH_MAGIC_64, cputype, cpusubtype, filetype, ncmds, sizeofcmds, 0, 0)
+    data = header + b"".join(commands)
+    data += b"\0" * (text_offset - len(data)) + text
+    if signed:
+        data += signature
+    return data
+
+
+def archive_member(name, data):
+    # BSD ar, with the name after the header like Apple's ar writes it
+    name_bytes = pad(name.encode("utf-8") + b"\0")
+    header = "{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}`\n".format("#1/{}".format(len(name_bytes)), 0, 0, 0, 644,
+                                                          len(name_bytes) + len(data))
+    return header.encode("ascii") + name_bytes + pad(data, 2)
+
+
+def make_archive(arch="arm64", names=("a.o", "b.o")):
+    # Returns the bytes of a static library of empty objects, with a symbol table first like ranlib leaves it
+    members = [archive_member("__.SYMDEF SORTED", b"\0" * 8)]
+    members.extend(archive_member(name, make_macho(arch, MH_OBJECT, padding=0)) for name in names)
+    return b"!<arch>\n" + b"".join(members)
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def make_fat(thin_files):
+    # Lays out a fat file the way lipo does, independently of macho.write_fat: a 32-bit fat header, then each slice,
+    # in the order given, aligned to 16K pages for arm64 and 4K for everything else
+    header = struct.pack(">II", 0xcafebabe, len(thin_files))
+    offset = 8 + 20 * len(thin_files)
+    entries = []
+    for data in thin_files:
+        cputype, cpusubtype = struct.unpack("<ii", data[4:12])
+        align = 14 if cputype & 0xffffff == 12 else 12
+        offset += -offset % (1 << align)
+        entries.append(struct.pack(">iiIII", cputype, cpusubtype, offset, len(data), align))
+        offset += len(data)
+    fat = header + b"".join(entries)
+    for entry, data in zip(entries, thin_files):
+        fat += b"\0" * (struct.unpack(">I", entry[8:12])[0] - len(fat)) + data
+    return fat
+
+
+# The checked-in samples in test/data/macho, and what makes them.  Run this file to write them again.
+CHECKED_IN_SAMPLES = {
+    # A library with an install name and a dependency that point outside the bundle and the system
+    "libfoo.dylib": lambda: make_macho("arm64", MH_DYLIB, install_id="/Users/kicad/build/kicad-dest/lib/libfoo.1.dylib",
+                                       dylibs=["/usr/lib/libSystem.B.dylib", "@rpath/libbar.dylib",
+                                               "/opt/homebrew/opt/gettext/lib/libintl.8.dylib"],
+                                       rpaths=["@loader_path/../Frameworks"]),
+    "libbar-arm64.dylib": lambda: make_macho("arm64", MH_DYLIB, install_id="@rpath/libbar.dylib",
+                                             dylibs=["/usr/lib/libSystem.B.dylib"]),
+    "libbar-x86_64.dylib": lambda: make_macho("x86_64", MH_DYLIB, install_id="@rpath/libbar.dylib",
+                                              dylibs=["/usr/lib/libSystem.B.dylib"]),
+    "libbar.dylib": lambda: make_fat([CHECKED_IN_SAMPLES["libbar-x86_64.dylib"](),
+                                      CHECKED_IN_SAMPLES["libbar-arm64.dylib"]()]),
+    "kicad": lambda: make_macho("x86_64", MH_EXECUTE, dylibs=["@rpath/libfoo.dylib", "/usr/lib/libc++.1.dylib"],
+                                rpaths=["@executable_path/../Frameworks"], signed=True),
+    "libstatic.a": lambda: make_archive("arm64"),
+    # A Java class file, which starts with the same magic as a fat file; version 52 is Java 8
+    "Foo.class": lambda: bytes.fromhex("cafebabe00000034") + b"\0" * 24,
+    "README.txt": lambda: b"Not Mach-O.\n",
+}
+
+
+def write_checked_in_samples(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, make in CHECKED_IN_SAMPLES.items():
+        write(os.path.join(directory, name), make())
+
+
+if __name__ == "__main__":
+    write_checked_in_samples(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "macho"))
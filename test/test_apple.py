@@ -0,0 +1,327 @@
+# Tests for kicad-mac-builder/bin/apple.py, with a fake codesign on PATH and a fake notary service
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import apple
+import samples
+
+# Logs when it starts and finishes with each path, and fails for the paths in FAKE_CODESIGN_FAIL
+FAKE_CODESIGN = """#!{python}
+import os
+import sys
+import time
+
+path = sys.argv[-1]
+with open(os.environ["FAKE_CODESIGN_LOG"], "a") as f:
+    f.write("start {{}}\\n".format(path))
+time.sleep(0.02)
+if path in os.environ.get("FAKE_CODESIGN_FAIL", "").split(os.pathsep):
+    sys.exit(1)
+with open(os.environ["FAKE_CODESIGN_LOG"], "a") as f:
+    f.write("end {{}}\\n".format(path))
+"""
+
+
+class FakeCodesignTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+        bin_dir = os.path.join(self.tmp_dir, "bin")
+        os.makedirs(bin_dir)
+        codesign = samples.write(os.path.join(bin_dir, "codesign"),
+                                 FAKE_CODESIGN.format(python=sys.executable).encode("utf-8"))
+        os.chmod(codesign, 0o755)
+        self.log_path = os.path.join(self.tmp_dir, "codesign.log")
+        environ = mock.patch.dict(os.environ, {"PATH": bin_dir + os.pathsep + os.environ["PATH"],
+                                               "FAKE_CODESIGN_LOG": self.log_path})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        self.app = os.path.join(self.tmp_dir, "KiCad.app")
+        self.write("Contents/MacOS/kicad", samples.make_macho("arm64", samples.MH_EXECUTE))
+        self.write("Contents/Frameworks/libfoo.dylib", samples.make_macho("arm64"))
+        self.write("Contents/Frameworks/Python.framework/Versions/3.9/Python", samples.make_macho("arm64"))
+        self.write("Contents/Applications/pcbnew.app/Contents/MacOS/pcbnew",
+                   samples.make_macho("arm64", samples.MH_EXECUTE))
+        self.write("Contents/Resources/readme.txt", b"Not code.\n")
+
+    def write(self, relative_path, data):
+        path = os.path.join(self.app, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return samples.write(path, data)
+
+    def path(self, relative_path=""):
+        return os.path.normpath(os.path.join(self.app, relative_path))
+
+    def read_log(self):
+        try:
+            with open(self.log_path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        os.remove(self.log_path)
+        return [tuple(line.split(" ", 1)) for line in lines]
+
+    def sign(self, jobs=4):
+        apple.sign(self.app, "-", hardened_runtime=True, secure_timestamp=False, jobs=jobs)
+
+
+class SignTest(FakeCodesignTestCase):
+
+    def test_paths_are_signed_inside_out(self):
+        self.sign()
+        log = self.read_log()
+        signed = [path for event, path in log if event == "end"]
+        self.assertEqual(sorted(signed), sorted([
+            self.path(),
+            self.path("Contents/MacOS/kicad"),
+            self.path("Contents/Frameworks/libfoo.dylib"),
+            self.path("Contents/Frameworks/Python.framework"),
+            self.path("Contents/Frameworks/Python.framework/Versions/3.9/Python"),
+            self.path("Contents/Applications/pcbnew.app"),
+            self.path("Contents/Applications/pcbnew.app/Contents/MacOS/pcbnew"),
+        ]))
+
+        # Nothing starts before everything inside of it has finished
+        for i, (event, path) in enumerate(log):
+            if event != "start":
+                continue
+            finished = {p for e, p in log[:i] if e == "end"}
+            for other in signed:
+                if other.startswith(path + os.sep):
+                    self.assertIn(other, finished, "{} was signed before {}".format(path, other))
+
+        # The independent paths inside KiCad.app were signed at the same time
+        self.assertNotEqual([event for event, _ in log], ["start", "end"] * len(signed))
+
+    def test_only_changes_are_signed_again(self):
+        self.sign()
+        self.read_log()
+        self.sign()
+        self.assertEqual(self.read_log(), [])
+
+        self.write("Contents/Applications/pcbnew.app/Contents/MacOS/pcbnew",
+                   samples.make_macho("arm64", samples.MH_EXECUTE, text=b"\0" * 64))
+        self.sign()
+        self.assertEqual([path for event, path in self.read_log() if event == "end"], [
+            self.path("Contents/Applications/pcbnew.app/Contents/MacOS/pcbnew"),
+            self.path("Contents/Applications/pcbnew.app"),
+            self.path(),
+        ])
+
+    def test_touched_files_are_not_signed_again(self):
+        self.sign()
+        self.read_log()
+        path = self.path("Contents/Frameworks/Python.framework/Versions/3.9/Python")
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.sign()
+        # The bundles around it are identified by their trees, which include mtimes
+        self.assertEqual([path for event, path in self.read_log() if event == "end"], [
+            self.path("Contents/Frameworks/Python.framework"),
+            self.path(),
+        ])
+
+        # The new mtime was recorded, so it isn't even rehashed next time
+        self.sign()
+        self.assertEqual(self.read_log(), [])
+        with mock.patch.object(apple, "hash_file") as hash_file:
+            apple.get_content_states([path], apple.load_signing_manifest(apple.get_signing_manifest_path(self.app)),
+                                     os.path.dirname(apple.get_signing_manifest_path(self.app)), 1)
+        hash_file.assert_not_called()
+
+    def test_a_failure_stops_the_bundles_around_it(self):
+        failing = self.path("Contents/Frameworks/Python.framework/Versions/3.9/Python")
+        with mock.patch.dict(os.environ, {"FAKE_CODESIGN_FAIL": failing}):
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.sign()
+        started = [path for event, path in self.read_log() if event == "start"]
+        self.assertIn(failing, started)
+        self.assertNotIn(self.path("Contents/Frameworks/Python.framework"), started)
+        self.assertNotIn(self.path(), started)
+        self.assertFalse(os.path.exists(apple.get_signing_manifest_path(self.app)))
+
+        # Nothing was recorded, so everything is signed next time
+        self.sign()
+        self.assertEqual(len([event for event, _ in self.read_log() if event == "end"]), 7)
+
+
+class PathsForSigningTest(FakeCodesignTestCase):
+
+    def test_paths_for_signing(self):
+        python_dir = "Contents/Frameworks/Python.framework/Versions/3.9"
+        os.chmod(self.write(python_dir + "/bin/pip3", b"#!/usr/bin/env python3\n"), 0o755)
+        os.chmod(self.write(python_dir + "/bin/python3.9", samples.make_macho("arm64", samples.MH_EXECUTE)), 0o755)
+        os.symlink("python3.9", self.path(python_dir + "/bin/python3"))
+        os.symlink("3.9", self.path("Contents/Frameworks/Python.framework/Versions/Current"))
+        # Not executable, or not in the framework's bin, so not signed
+        self.write(python_dir + "/bin/README", b"Not a script.\n")
+        os.chmod(self.write("Contents/SharedSupport/scripts/run.sh", b"#!/bin/sh\n"), 0o755)
+        self.write(python_dir + "/lib/python3.9/config-3.9-darwin/libpython3.9.a", samples.make_archive("arm64"))
+        self.write(python_dir + "/lib/python3.9/site-packages/Foo.class",
+                   bytes.fromhex("cafebabe00000034") + b"\0" * 24)
+        self.write("Contents/SharedSupport/3dmodels/R.3dshapes/R_0402.step", samples.make_macho("arm64"))
+
+        paths, categories = apple.get_kicad_paths_for_signing(self.app)
+        self.assertEqual(categories["scripts"], [self.path(python_dir + "/bin/pip3")])
+        self.assertEqual(categories["executables"], [
+            self.path("Contents/Applications/pcbnew.app/Contents/MacOS/pcbnew"),
+            self.path(python_dir + "/bin/python3.9"),
+            self.path("Contents/MacOS/kicad"),
+        ])
+        self.assertEqual(categories["archives"],
+                         [self.path(python_dir + "/lib/python3.9/config-3.9-darwin/libpython3.9.a")])
+        self.assertEqual(categories["frameworks"], [self.path("Contents/Frameworks/Python.framework")])
+        self.assertEqual(categories["apps"], [self.path("Contents/Applications/pcbnew.app"), self.path()])
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertEqual(len(paths), sum(len(category) for category in categories.values()))
+
+        # Inside out: nothing is signed after what contains it
+        for i, path in enumerate(paths):
+            for later in paths[i + 1:]:
+                self.assertFalse(later.startswith(path + os.sep), "{} is signed after {}".format(later, path))
+
+
+class SignPathsTest(unittest.TestCase):
+
+    def test_one_job_signs_in_order(self):
+        paths = ["/a.app/b.framework/lib", "/a.app/b.framework", "/a.app/c", "/a.app"]
+        signed = []
+        apple.sign_paths(paths, 1, signed.append)
+        self.assertEqual(signed, ["/a.app/b.framework/lib", "/a.app/c", "/a.app/b.framework", "/a.app"])
+
+    def test_the_first_failure_is_raised(self):
+        def sign_func(path):
+            if path == "/a.app/c":
+                raise ValueError(path)
+
+        with self.assertRaises(ValueError):
+            apple.sign_paths(["/a.app/b", "/a.app/c", "/a.app"], 2, sign_func)
+
+
+class FakeNotaryClient(apple.NotaryClient):
+    # Accepts everything after a couple of checks, unless it's told otherwise
+
+    def __init__(self, statuses=("In Progress", "In Progress", "Accepted"), status_errors=0, rejected=()):
+        self.statuses = {}
+        self.default_statuses = list(statuses)
+        self.rejected = rejected
+        self.status_errors = status_errors
+        self.submitted = []
+        self.stapled = []
+
+    async def submit(self, upload_path):
+        submission_id = "submission-{}".format(len(self.submitted))
+        self.submitted.append(upload_path)
+        self.statuses[submission_id] = ["In Progress", "Invalid"] if upload_path in self.rejected \
+            else list(self.default_statuses)
+        return submission_id
+
+    async def get_status(self, submission_id):
+        if self.status_errors:
+            self.status_errors -= 1
+            raise apple.NotarizationError("The network is down")
+        statuses = self.statuses[submission_id]
+        return statuses.pop(0) if len(statuses) > 1 else statuses[0]
+
+    async def get_log(self, submission_id):
+        return "The log for {}".format(submission_id)
+
+    async def staple(self, path):
+        # Stapling changes the file, like stapler adds the ticket
+        self.stapled.append(path)
+        with open(path, "ab") as f:
+            f.write(b"ticket")
+
+
+class NotarizeTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dmg = samples.write(os.path.join(tmp_dir.name, "kicad.dmg"), b"dmg")
+        self.other_dmg = samples.write(os.path.join(tmp_dir.name, "kicad-extras.dmg"), b"extras")
+
+    def notarize(self, client, paths, **kwargs):
+        asyncio.run(apple.notarize_paths(client, paths, initial_interval=0.01, max_interval=0.02, **kwargs))
+
+    def test_an_incomplete_client_cannot_be_created(self):
+        class IncompleteClient(apple.NotaryClient):
+            async def submit(self, upload_path):
+                return "id"
+
+        with self.assertRaises(TypeError):
+            IncompleteClient()
+
+    def test_notarize(self):
+        client = FakeNotaryClient()
+        self.notarize(client, [self.dmg, self.other_dmg])
+        self.assertEqual(sorted(client.submitted), sorted([self.dmg, self.other_dmg]))
+        self.assertEqual(sorted(client.stapled), sorted([self.dmg, self.other_dmg]))
+        state = apple.load_notarization_state(apple.get_notarization_state_path(self.dmg))
+        self.assertEqual(state["status"], apple.NOTARY_ACCEPTED)
+        self.assertEqual(state["stapled_content"]["size"], len(b"dmgticket"))
+
+        # Already stapled, so there's nothing to do
+        client = FakeNotaryClient()
+        self.notarize(client, [self.dmg])
+        self.assertEqual((client.submitted, client.stapled), ([], []))
+
+    def test_resume(self):
+        client = FakeNotaryClient()
+        self.notarize(client, [self.dmg], wait=False)
+        self.assertEqual((client.submitted, client.stapled), ([self.dmg], []))
+
+        # The next run waits on the same submission, rather than submitting again
+        resumed_client = FakeNotaryClient()
+        resumed_client.statuses = client.statuses
+        self.notarize(resumed_client, [self.dmg])
+        self.assertEqual((resumed_client.submitted, resumed_client.stapled), ([], [self.dmg]))
+
+    def test_changed_content_is_submitted_again(self):
+        self.notarize(FakeNotaryClient(), [self.dmg], wait=False)
+        samples.write(self.dmg, b"a new dmg")
+        client = FakeNotaryClient()
+        self.notarize(client, [self.dmg], wait=False)
+        self.assertEqual(client.submitted, [self.dmg])
+
+    def test_failures(self):
+        # A rejected submission fails with its log, but doesn't stop the others
+        client = FakeNotaryClient(rejected=[self.dmg])
+        with self.assertLogs(level="ERROR") as logs:
+            with self.assertRaises(apple.NotarizationError):
+                self.notarize(client, [self.dmg, self.other_dmg])
+        self.assertIn("The log for submission-", "\n".join(logs.output))
+        self.assertEqual(client.stapled, [self.other_dmg])
+
+    def test_status_checks_are_retried(self):
+        client = FakeNotaryClient(status_errors=apple.MAX_STATUS_FAILURES - 1)
+        self.notarize(client, [self.dmg])
+        self.assertEqual(client.stapled, [self.dmg])
+
+        client = FakeNotaryClient(status_errors=apple.MAX_STATUS_FAILURES)
+        with self.assertRaises(apple.NotarizationError):
+            self.notarize(client, [self.other_dmg])
+
+    def test_timeout(self):
+        client = FakeNotaryClient(statuses=("In Progress",))
+        with self.assertRaises(apple.NotarizationError):
+            self.notarize(client, [self.dmg], timeout=0.05)
+        # It can be waited on again later
+        state = apple.load_notarization_state(apple.get_notarization_state_path(self.dmg))
+        self.assertEqual(state["status"], apple.NOTARY_IN_PROGRESS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,582 @@
+# Tests for build.py that don't need macOS, Homebrew or a build.  Run with `python3 -m unittest discover test` from the
+# top of the repo.
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import build
+
+
+class HostProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        build._host_probes = None
+        self.addCleanup(setattr, build, "_host_probes", None)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.rosetta_returncode = 1
+        self.commands_run = []
+
+    def run_host_probe(self, command):
+        self.commands_run.append(command)
+        if command == build.HOST_PROBES["rosetta"]:
+            return {"returncode": self.rosetta_returncode, "output": ""}
+        return {"returncode": 0, "output": "1"}
+
+    def get_host_probes(self):
+        build._host_probes = None
+        with mock.patch.object(build, "run_host_probe", self.run_host_probe):
+            return build.get_host_probes(self.cache_dir.name)
+
+    def test_rosetta_is_never_cached(self):
+        self.assertEqual(self.get_host_probes()["rosetta"]["returncode"], 1)
+        with open(os.path.join(self.cache_dir.name, build.HOST_PROBE_CACHE_FILENAME)) as f:
+            self.assertNotIn("rosetta", json.load(f)["probes"])
+
+        # Installing Rosetta is noticed on the next run, and only Rosetta is probed again
+        self.rosetta_returncode = 0
+        self.commands_run = []
+        self.assertEqual(self.get_host_probes()["rosetta"]["returncode"], 0)
+        self.assertEqual(self.commands_run, [build.HOST_PROBES["rosetta"]])
+
+    def test_failures_are_not_cached(self):
+        with mock.patch.object(build, "run_host_probe", lambda command: {"returncode": 1, "output": ""}):
+            build.get_host_probes(self.cache_dir.name)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir.name, build.HOST_PROBE_CACHE_FILENAME)))
+
+
+class UniversalBuildTestCase(unittest.TestCase):
+    # An Apple Silicon Mac with Rosetta and both Homebrews
+
+    HOST = {
+        "cores": "8",
+        "macos_version": "13.0",
+        "host_architecture": "Apple M1",
+        "env_architecture": "arm64",
+        "memory": str(16 * 1024 ** 3),
+    }
+
+    def setUp(self):
+        build._host_probes = None
+        self.addCleanup(setattr, build, "_host_probes", None)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.build_dir = os.path.join(tmp_dir.name, "build")
+        run_host_probe = mock.patch.object(build, "run_host_probe", self.run_host_probe)
+        run_host_probe.start()
+        self.addCleanup(run_host_probe.stop)
+
+    def run_host_probe(self, command):
+        for name, probe_command in build.HOST_PROBES.items():
+            if command == probe_command:
+                return {"returncode": 0, "output": self.HOST.get(name, "")}
+
+    def parse_args(self, *args):
+        return build.parse_args(["--arch", "universal", "--build-dir", self.build_dir, "--kicad-source-dir",
+                                 self.build_dir] + list(args))
+
+
+class UniversalBuildPlanTest(UniversalBuildTestCase):
+
+    def test_plan(self):
+        stages = build.get_universal_build_plan(self.parse_args("--jobs", "8", "--target", "kicad"))
+        self.assertEqual([[name for name, command, env, cwd in stage] for stage in stages],
+                         [["shared assets"], ["arm64", "x86_64"], ["thin arm64", "thin x86_64"], ["merge"],
+                          ["ad-hoc sign"]])
+
+        [(_, shared_command, _, _)] = stages[0]
+        self.assertEqual(shared_command[shared_command.index("--target") + 1:][:len(build.SHARED_ASSET_TARGETS)],
+                         build.SHARED_ASSET_TARGETS)
+
+        arch_commands = {name: (command, env) for name, command, env, cwd in stages[1]}
+        for arch, (command, env) in arch_commands.items():
+            self.assertEqual(command[command.index("--arch") + 1], arch)
+            self.assertEqual(command[command.index("--jobs") + 1], "4")
+            self.assertEqual(command[command.index("--build-dir") + 1], os.path.join(self.build_dir, arch))
+            self.assertEqual(command[command.index("--shared-assets-dir") + 1],
+                             os.path.join(self.build_dir, "shared"))
+            self.assertEqual(command[command.index("--target") + 1], "kicad")
+            self.assertIn("--skip-git-mirror-update", command)
+            self.assertTrue(env["PATH"].startswith(build.ARCH_BREW_PREFIXES[arch] + "/bin:"))
+        self.assertEqual(arch_commands["x86_64"][0][:2], ["arch", "-x86_64"])
+        self.assertNotEqual(arch_commands["arm64"][0][0], "arch")
+
+        [(_, merge_command, _, _)] = stages[3]
+        self.assertEqual(merge_command[-1], os.path.join(self.build_dir, "universal", "dest"))
+
+    def test_package_stage(self):
+        dmg_dir = os.path.join(self.build_dir, "out")
+        stages = build.get_universal_build_plan(self.parse_args(
+            "--target", "kicad", "package-kicad-unified", "package-kicad-delta", "--dmg-dir", dmg_dir,
+            "--release-name", "9.0.0", "--signing-identity", "Developer ID"))
+        # The architectures only build, and the packaging runs on the merged, signed bundle
+        for name, command, env, cwd in stages[1]:
+            self.assertEqual(command[command.index("--target") + 1], "kicad")
+            self.assertFalse([arg for arg in command if arg.startswith("package-")])
+        self.assertEqual(stages[4][0][0], "ad-hoc sign")
+        package_stage = {name: (command, env, cwd) for name, command, env, cwd in stages[5]}
+        self.assertEqual(sorted(package_stage), ["package-kicad-delta", "package-kicad-unified"])
+
+        dest_dir = os.path.join(self.build_dir, "universal", "dest")
+        command, env, cwd = package_stage["package-kicad-unified"]
+        self.assertEqual(os.path.basename(command[0]), "package.sh")
+        self.assertEqual(env["KICAD_INSTALL_DIR"], dest_dir)
+        self.assertEqual(env["DMG_DIR"], dmg_dir)
+        self.assertEqual(env["RELEASE_NAME"], "9.0.0")
+        self.assertEqual(env["SIGNING_IDENTITY"], "Developer ID")
+        self.assertEqual(env["KICAD_SOURCE_DIR"], self.build_dir)
+        self.assertEqual(cwd, os.path.join(self.build_dir, "universal", "package"))
+
+        command, env, cwd = package_stage["package-kicad-delta"]
+        self.assertEqual(command[1:], ["package", "--base-dir", os.path.join(self.build_dir, "delta-base"),
+                                       "--output-dir", dmg_dir, "--name", "9.0.0", dest_dir])
+
+    def test_only_build_targets(self):
+        stages = build.get_universal_build_plan(self.parse_args("--target", "package-kicad-unified"))
+        # Everything is built, since --target only asked for packaging
+        for name, command, env, cwd in stages[1]:
+            self.assertNotIn("--target", command)
+        self.assertEqual([name for name, command, env, cwd in stages[-1]], ["package-kicad-unified"])
+
+    def test_unsupported_options(self):
+        for args in (["--dmg-notarization-id", "id"], ["--app-notarization-id", "id"], ["--asc-provider", "team"],
+                     ["--apple-developer-username", "someone@example.com"], ["--target", "package-extras"],
+                     ["--target", "package-kicad-nightly"]):
+            with mock.patch("sys.stderr"), self.assertRaises(SystemExit, msg=args):
+                self.parse_args(*args)
+        # package.sh needs KiCad's source, which --disk-budget prunes when it's cloned
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit):
+            build.parse_args(["--arch", "universal", "--build-dir", self.build_dir, "--disk-budget",
+                              "--target", "package-kicad-unified"])
+
+    def test_forwarded_args_parse(self):
+        # What a universal build gives each architecture has to be something build.py accepts
+        args = self.parse_args("--release-name", "9.0.0", "--disk-budget", "--redistributable")
+        for arch in build.ARCH_BREW_PREFIXES:
+            arch_args = build.parse_args(["--arch", arch, "--build-dir", os.path.join(self.build_dir, arch)] +
+                                         build.get_forwarded_args(args))
+            self.assertEqual(arch_args.release_name, "9.0.0")
+            self.assertTrue(arch_args.disk_budget)
+            self.assertTrue(arch_args.redistributable)
+            self.assertEqual(arch_args.kicad_source_dir, args.kicad_source_dir)
+
+    def test_stages_run_in_order(self):
+        # Stub commands stand in for the builds; each logs its name when it starts and finishes
+        log_path = os.path.join(self.build_dir, "log")
+
+        def stub(name, sleep=0.0, returncode=0):
+            code = "import sys, time\n" \
+                   "open(sys.argv[1], 'a').write('start {name}\\n')\n" \
+                   "time.sleep({sleep})\n" \
+                   "open(sys.argv[1], 'a').write('end {name}\\n')\n" \
+                   "sys.exit({returncode})".format(name=name, sleep=sleep, returncode=returncode)
+            return name, [sys.executable, "-c", code, log_path], None, None
+
+        stages = [[stub("shared")], [stub("arm64", 0.5), stub("x86_64", 0.5)], [stub("merge", returncode=1)],
+                  [stub("sign")]]
+        args = self.parse_args()
+        with mock.patch.object(build, "get_universal_build_plan", return_value=stages), \
+                mock.patch.object(build, "print_summary"):
+            with self.assertRaises(subprocess.CalledProcessError):
+                build.build_universal(args)
+
+        with open(log_path) as f:
+            log = f.read().splitlines()
+        self.assertEqual(log[:2], ["start shared", "end shared"])
+        # Both architectures run at the same time
+        self.assertEqual(sorted(log[2:4]), ["start arm64", "start x86_64"])
+        self.assertEqual(sorted(log[4:6]), ["end arm64", "end x86_64"])
+        # The failed merge stops the build before signing
+        self.assertEqual(log[6:], ["start merge", "end merge"])
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+
+    def command(self, code):
+        return [sys.executable, "-c", code]
+
+    def test_commands_run_at_the_same_time(self):
+        start_time = time.monotonic()
+        timings = build.run_concurrently([("a", self.command("import time; time.sleep(2)"), None, None),
+                                          ("b", self.command("import time; time.sleep(2)"), None, None)])
+        # Finishing is only noticed every half a second
+        self.assertLess(time.monotonic() - start_time, 3.5)
+        self.assertEqual(sorted(name for name, start, end in timings), ["a", "b"])
+        for name, start, end in timings:
+            self.assertGreaterEqual(end - start, 2)
+
+    def test_a_failure_stops_the_others(self):
+        start_time = time.monotonic()
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            build.run_concurrently([("slow", self.command("import time; time.sleep(60)"), None, None),
+                                    ("broken", self.command("import sys; sys.exit(3)"), None, None)])
+        self.assertLess(time.monotonic() - start_time, 10)
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.cmd, "broken")
+
+    def test_a_failure_stops_what_the_others_started(self):
+        # Like make under a per-architecture build.py, which terminating build.py alone would leave running
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            started_path = os.path.join(tmp_dir, "started")
+            finished_path = os.path.join(tmp_dir, "finished")
+            grandchild = "import time; time.sleep(2); open({!r}, 'w').close()".format(finished_path)
+            child = "import subprocess, sys, time\n" \
+                    "subprocess.Popen([sys.executable, '-c', {!r}])\n" \
+                    "open({!r}, 'w').close()\n" \
+                    "time.sleep(60)".format(grandchild, started_path)
+            broken = "import os, sys, time\n" \
+                     "while not os.path.exists({!r}): time.sleep(0.1)\n" \
+                     "sys.exit(3)".format(started_path)
+            with self.assertRaises(subprocess.CalledProcessError):
+                build.run_concurrently([("build", self.command(child), None, None),
+                                        ("broken", self.command(broken), None, None)])
+            time.sleep(3)
+            self.assertFalse(os.path.exists(finished_path))
+
+    def test_cwd(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cwd = os.path.join(tmp_dir, "package")
+            build.run_concurrently([("pwd", self.command("open('here', 'w').close()"), None, cwd)])
+            self.assertTrue(os.path.exists(os.path.join(cwd, "here")))
+
+
+class GitMirrorTest(unittest.TestCase):
+    # Local bare repositories stand in for the upstream ones
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.mirror_dir = os.path.join(self.tmp_dir, "mirrors")
+        environ = mock.patch.dict(os.environ, {"GIT_AUTHOR_NAME": "KiCad", "GIT_AUTHOR_EMAIL": "kicad@example.com",
+                                               "GIT_COMMITTER_NAME": "KiCad", "GIT_COMMITTER_EMAIL": "kicad@example.com",
+                                               "GIT_CONFIG_NOSYSTEM": "1", "HOME": self.tmp_dir})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.upstream = self.make_upstream("kicad-symbols")
+
+    def git(self, *args):
+        return subprocess.run(["git"] + list(args), check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True).stdout.strip()
+
+    def make_upstream(self, name):
+        upstream = os.path.join(self.tmp_dir, "upstream", name + ".git")
+        self.git("init", "--quiet", "--bare", upstream)
+        work = os.path.join(self.tmp_dir, "work", name)
+        self.git("clone", "--quiet", upstream, work)
+        self.commit(work, "first")
+        return upstream
+
+    def commit(self, work, message, branch="master"):
+        self.git("-C", work, "checkout", "--quiet", "-B", branch)
+        self.git("-C", work, "commit", "--quiet", "--allow-empty", "-m", message)
+        self.git("-C", work, "push", "--quiet", "origin", branch)
+        return self.git("-C", work, "rev-parse", "HEAD")
+
+    def get_branches(self, git_dir):
+        return self.git("--git-dir", git_dir, "for-each-ref", "--format=%(refname:short) %(objectname)",
+                        "refs/heads").splitlines()
+
+    def test_mirror_is_created_and_updated(self):
+        mirror = build.update_git_mirror(self.mirror_dir, self.upstream)
+        self.assertEqual(mirror, build.get_git_mirror_path(self.mirror_dir, self.upstream))
+        self.assertTrue(os.path.basename(mirror).startswith("kicad-symbols-"))
+        self.assertEqual(self.get_branches(mirror), self.get_branches(self.upstream))
+
+        work = os.path.join(self.tmp_dir, "work", "kicad-symbols")
+        self.commit(work, "second")
+        self.commit(work, "feature", branch="feature")
+        self.assertEqual(build.update_git_mirror(self.mirror_dir, self.upstream), mirror)
+        self.assertEqual(self.get_branches(mirror), self.get_branches(self.upstream))
+
+        # Branches deleted upstream are pruned
+        self.git("--git-dir", self.upstream, "branch", "-D", "feature")
+        build.update_git_mirror(self.mirror_dir, self.upstream)
+        self.assertEqual(self.get_branches(mirror), self.get_branches(self.upstream))
+
+    def test_skipping_the_update(self):
+        self.assertIsNone(build.update_git_mirror(self.mirror_dir, self.upstream, fetch=False))
+        mirror = build.update_git_mirror(self.mirror_dir, self.upstream)
+        branches = self.get_branches(mirror)
+        self.commit(os.path.join(self.tmp_dir, "work", "kicad-symbols"), "second")
+        self.assertEqual(build.update_git_mirror(self.mirror_dir, self.upstream, fetch=False), mirror)
+        self.assertEqual(self.get_branches(mirror), branches)
+
+    def test_offline(self):
+        # A mirror that can't be fetched is still used
+        mirror = build.update_git_mirror(self.mirror_dir, self.upstream)
+        shutil.rmtree(self.upstream)
+        self.assertEqual(build.update_git_mirror(self.mirror_dir, self.upstream), mirror)
+
+        # Without a mirror, the build clones directly, and no half-made mirror is left behind
+        missing = os.path.join(self.tmp_dir, "upstream", "missing.git")
+        self.assertIsNone(build.update_git_mirror(self.mirror_dir, missing))
+        self.assertFalse(os.path.exists(build.get_git_mirror_path(self.mirror_dir, missing)))
+        self.assertFalse(os.path.exists(build.get_git_mirror_path(self.mirror_dir, missing) + ".tmp"))
+
+    def test_get_git_repositories(self):
+        args = argparse.Namespace(kicad_mac_builder_cmake_dir=os.path.join(os.path.dirname(build.__file__),
+                                                                           "kicad-mac-builder"),
+                                  kicad_source_dir=None, kicad_git_url=None, git_urls=[], git_mirror_dir=None,
+                                  skip_git_mirror_update=False)
+        names = sorted(build.get_git_urls(args))
+        self.assertIn("SYMBOLS_URL", names)
+
+        # Everything comes from one of two upstreams, so they're mirrored once each
+        kicad = self.make_upstream("kicad")
+        args.kicad_git_url = kicad
+        args.git_urls = ["{}={}".format(name, self.upstream) for name in names if name != "KICAD_URL"]
+        args.git_mirror_dir = self.mirror_dir
+        repositories = build.get_git_repositories(args)
+        self.assertEqual(repositories["KICAD_URL"], build.get_git_mirror_path(self.mirror_dir, kicad))
+        for name in names:
+            if name != "KICAD_URL":
+                self.assertEqual(repositories[name], build.get_git_mirror_path(self.mirror_dir, self.upstream))
+        self.assertEqual(len([name for name in os.listdir(self.mirror_dir) if name.endswith(".git")]), 2)
+
+        # Without a mirror directory, the URLs are used as they are
+        args.git_mirror_dir = None
+        self.assertEqual(build.get_git_repositories(args)["KICAD_URL"], kicad)
+
+
+class DiskBudgetTest(unittest.TestCase):
+    # A synthetic build directory, with the CMakeFiles/Makefile2 make reads the targets' dependencies from, a
+    # build.make per project with a rule for each step's stamp, and stamps from a build an hour ago
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.build_dir = os.path.join(self.tmp_dir, "build")
+        self.mtime = time.time() - 3600
+        print_mock = mock.patch("builtins.print")
+        print_mock.start()
+        self.addCleanup(print_mock.stop)
+
+    def add_project(self, project, rules, depends=(), in_all=True, build_dir=None):
+        # rules is [(stamp, [stamps it depends on])], in the order they were made
+        build_dir = build_dir or self.build_dir
+        os.makedirs(os.path.join(build_dir, "CMakeFiles", "{}.dir".format(project)))
+        with open(os.path.join(build_dir, "CMakeFiles", "{}.dir".format(project), "build.make"), "w") as f:
+            for target, prerequisites in rules:
+                f.write("{}: {}\n\tmkdir -p $(@D) && touch $@\n\n".format(target, " ".join(prerequisites)))
+                self.touch(os.path.join(build_dir, target))
+        with open(os.path.join(build_dir, "CMakeFiles", "Makefile2"), "a") as f:
+            if in_all:
+                f.write("all: CMakeFiles/{}.dir/all\n".format(project))
+            for dependency in depends:
+                f.write("CMakeFiles/{}.dir/all: CMakeFiles/{}.dir/all\n".format(project, dependency))
+        if project in build.DISK_BUDGET_PRUNABLE:
+            for path in build.DISK_BUDGET_PRUNABLE[project][0]:
+                os.makedirs(os.path.join(build_dir, path))
+                with open(os.path.join(build_dir, path, "README"), "w") as f:
+                    f.write("{}\n".format(project))
+
+    def touch(self, path, mtime=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a"):
+            pass
+        if mtime is None:
+            self.mtime += 1
+            mtime = self.mtime
+        os.utime(path, (mtime, mtime))
+
+    def stamp(self, project, step):
+        return "{}/{}-{}".format(build.get_disk_budget_stamp_dir(project), project, step)
+
+    def add_asset(self, project, build_dir=None):
+        self.add_project(project, [(self.stamp(project, "install"), []),
+                                   ("CMakeFiles/{}-complete".format(project), [self.stamp(project, "install")])],
+                         build_dir=build_dir)
+
+    def add_full_build(self):
+        self.add_asset("symbols")
+        self.add_asset("packages3d")
+        symbols_step = self.stamp("kicad", "install-symbols-into-app")
+        packages3d_step = self.stamp("kicad", "install-packages3d-into-app")
+        self.add_project("kicad", [(symbols_step, [self.stamp("symbols", "install")]),
+                                   (packages3d_step, [self.stamp("packages3d", "install")]),
+                                   ("CMakeFiles/kicad-complete", [symbols_step, packages3d_step])],
+                         depends=["symbols", "packages3d"])
+        self.add_project("package-extras",
+                         [("CMakeFiles/package-extras-complete", [self.stamp("packages3d", "install")])],
+                         depends=["packages3d"], in_all=False)
+
+    def is_pruned(self, project, build_dir=None):
+        build_dir = build_dir or self.build_dir
+        pruned = [os.path.exists(os.path.join(build_dir, path)) for path in build.DISK_BUDGET_PRUNABLE[project][0]]
+        self.assertEqual(len(set(pruned)), 1)
+        if not pruned[0]:
+            # make mustn't build it again
+            self.assertTrue(os.path.isdir(os.path.join(build_dir, build.get_disk_budget_stamp_dir(project))))
+        return not pruned[0]
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_consumers(self):
+        self.add_full_build()
+        self.assertEqual(build.DiskBudget(self.build_dir, None).pending,
+                         {"symbols": [("kicad", "install-symbols-into-app")],
+                          "packages3d": [("kicad", "install-packages3d-into-app")],
+                          "kicad": [("kicad", None)]})
+        # Only package-extras and what it depends on are built
+        self.assertEqual(build.DiskBudget(self.build_dir, ["package-extras"]).pending,
+                         {"packages3d": [("package-extras", None)]})
+
+    def test_prune_once_every_consumer_is_finished(self):
+        self.add_full_build()
+        disk_budget = build.DiskBudget(self.build_dir, ["kicad", "package-extras"], interval=0.05)
+        disk_budget.start()
+        self.addCleanup(disk_budget.stop)
+
+        # From the last build, so they don't count
+        self.touch(os.path.join(self.build_dir, self.stamp("kicad", "install-symbols-into-app")), time.time() - 60)
+        time.sleep(0.3)
+        self.assertFalse(self.is_pruned("symbols"))
+        self.touch(os.path.join(self.build_dir, self.stamp("kicad", "install-symbols-into-app")), time.time())
+        self.wait_for(lambda: self.is_pruned("symbols"))
+
+        # packages3d waits for package-extras too
+        self.touch(os.path.join(self.build_dir, self.stamp("kicad", "install-packages3d-into-app")), time.time())
+        time.sleep(0.3)
+        self.assertFalse(self.is_pruned("packages3d"))
+        disk_budget.observe_make_output("\x1b[0m[ 95%] Built target package-extras\n")
+        self.wait_for(lambda: self.is_pruned("packages3d"))
+
+        self.assertFalse(self.is_pruned("kicad"))
+        disk_budget.stop()
+        disk_budget.finish()
+        self.assertTrue(self.is_pruned("kicad"))
+        self.assertEqual(build.load_disk_budget_state(self.build_dir)[0], {"symbols", "packages3d", "kicad"})
+
+    def test_nothing_is_pruned_in_the_shared_assets_build(self):
+        for project in build.SHARED_ASSET_TARGETS:
+            if project in build.DISK_BUDGET_PRUNABLE:
+                self.add_asset(project)
+        disk_budget = build.DiskBudget(self.build_dir, build.SHARED_ASSET_TARGETS)
+        self.assertEqual(disk_budget.pending, {})
+        disk_budget.finish()
+        for project in build.SHARED_ASSET_TARGETS:
+            if project in build.DISK_BUDGET_PRUNABLE:
+                self.assertFalse(self.is_pruned(project))
+
+        # And a build that uses them from there doesn't prune them either
+        arch_dir = os.path.join(self.tmp_dir, "arm64")
+        self.add_project("kicad", [(self.stamp("kicad", "install-symbols-into-app"), []),
+                                   ("CMakeFiles/kicad-complete", [self.stamp("kicad", "install-symbols-into-app")])],
+                         build_dir=arch_dir)
+        self.assertEqual(build.DiskBudget(arch_dir, None).pending, {"kicad": [("kicad", None)]})
+
+    def test_restart_pruned_projects(self):
+        self.add_full_build()
+        build.prune_project(self.build_dir, "symbols")
+        build.prune_project(self.build_dir, "packages3d")
+
+        # Nothing that needs them would run, so they stay pruned
+        build.restart_pruned_projects(self.build_dir)
+        self.assertTrue(self.is_pruned("symbols"))
+        self.assertTrue(self.is_pruned("packages3d"))
+
+        # kicad has to install the symbols again, so they start over
+        os.remove(os.path.join(self.build_dir, self.stamp("kicad", "install-symbols-into-app")))
+        build.restart_pruned_projects(self.build_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.build_dir, build.get_disk_budget_stamp_dir("symbols"))))
+        self.assertTrue(self.is_pruned("packages3d"))
+        self.assertEqual(build.load_disk_budget_state(self.build_dir)[0], {"packages3d"})
+
+    def test_revisions_of_pruned_checkouts(self):
+        environ = mock.patch.dict(os.environ, {"GIT_AUTHOR_NAME": "KiCad", "GIT_AUTHOR_EMAIL": "kicad@example.com",
+                                               "GIT_COMMITTER_NAME": "KiCad", "GIT_COMMITTER_EMAIL": "kicad@example.com",
+                                               "GIT_CONFIG_NOSYSTEM": "1", "HOME": self.tmp_dir})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.add_full_build()
+        checkout = os.path.join(self.build_dir, "symbols", "src", "symbols")
+        for command in (["init", "--quiet"], ["commit", "--quiet", "--allow-empty", "-m", "first"]):
+            subprocess.run(["git", "-C", checkout] + command, check=True)
+        revision = build.get_git_revision(checkout)
+        args = argparse.Namespace(build_dir=self.build_dir, shared_assets_dir=None, kicad_source_dir=None)
+        self.assertEqual(build.get_git_revisions(args)["symbols"], revision)
+
+        build.prune_project(self.build_dir, "symbols")
+        self.assertEqual(build.get_git_revisions(args)["symbols"], revision)
+
+        # Once it starts over, the old revision is forgotten
+        os.remove(os.path.join(self.build_dir, self.stamp("kicad", "install-symbols-into-app")))
+        build.restart_pruned_projects(self.build_dir)
+        self.assertNotIn("symbols", build.get_git_revisions(args))
+
+
+class PerfHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.args = argparse.Namespace(build_dir=os.path.join(tmp_dir.name, "build"), trace=None, disk_budget=False,
+                                       perf_history=os.path.join(tmp_dir.name, "perf-history.sqlite3"))
+        for patch in (mock.patch.object(build, "DiskUsageMonitor"), mock.patch("builtins.print")):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_a_history_failure_does_not_hide_the_build_failure(self):
+        failure = subprocess.CalledProcessError(2, ["make"])
+        with mock.patch.object(build, "run_build", side_effect=failure), \
+                mock.patch.object(build, "record_perf_history", side_effect=sqlite3.OperationalError("locked")):
+            with self.assertRaises(subprocess.CalledProcessError) as context:
+                build.build(self.args, os.environ["PATH"])
+        self.assertIs(context.exception, failure)
+
+    def test_a_history_failure_does_not_fail_the_build(self):
+        with mock.patch.object(build, "run_build"), \
+                mock.patch.object(build, "record_perf_history", side_effect=sqlite3.OperationalError("locked")) \
+                as record_perf_history:
+            build.build(self.args, os.environ["PATH"])
+        self.assertTrue(record_perf_history.call_args[0][2])
+
+
+class FailureExcerptTest(unittest.TestCase):
+
+    def test_failure_lines(self):
+        for line in ["pcbnew/board.cpp:12:5: error: use of undeclared identifier 'foo'",
+                     "common/richio.h:1:10: fatal error: 'wx/wx.h' file not found",
+                     "swig/kicad.i:42: Error: Syntax error in input(1).",
+                     "clang: error: linker command failed with exit code 1",
+                     "error: subprocess-exited-with-error",
+                     "CMake Error at cmake/FindwxWidgets.cmake:3 (message):",
+                     "make[2]: *** [pcbnew/CMakeFiles/pcbnew.dir/board.cpp.o] Error 1"]:
+            self.assertTrue(build.FAILURE_LINE_RE.search(line), line)
+
+    def test_lines_that_only_mention_errors(self):
+        for line in ["/usr/bin/c++ -Werror=return-type -Wno-error=deprecated-declarations -c common/richio_error.cpp",
+                     "[ 10%] Building CXX object common/CMakeFiles/common.dir/richio_error.cpp.o",
+                     "-- Performing Test HAVE_ERROR_H - Success",
+                     "-- Installing: /Users/kicad/build/kicad-dest/include/error.h"]:
+            self.assertFalse(build.FAILURE_LINE_RE.search(line), line)
+
+    def test_excerpt_starts_before_the_first_failure(self):
+        output_tail = ["/usr/bin/c++ -Werror -c {}.cpp\n".format(i) for i in range(100)]
+        output_tail[60] = "pcbnew/board.cpp:12:5: error: use of undeclared identifier 'foo'\n"
+        with mock.patch("builtins.print") as print_mock:
+            build.print_failure_excerpt(output_tail)
+        excerpt = print_mock.call_args[0][0]
+        self.assertIn("-c {}.cpp\n".format(60 - build.FAILURE_EXCERPT_CONTEXT_LINES), excerpt)
+        self.assertNotIn("-c {}.cpp\n".format(60 - build.FAILURE_EXCERPT_CONTEXT_LINES - 1), excerpt)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+# Tests for kicad-mac-builder/bin/delta.py, making and applying deltas between synthetic builds
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import delta
+import samples
+
+
+class DeltaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.old = os.path.join(self.tmp_dir, "old")
+        self.new = os.path.join(self.tmp_dir, "new")
+
+        self.write(self.old, "KiCad.app/Contents/MacOS/kicad",
+                   samples.make_macho("arm64", samples.MH_EXECUTE, dylibs=["@rpath/libkicad.dylib"],
+                                      text=bytes(range(256)) * 64))
+        self.write(self.old, "KiCad.app/Contents/Frameworks/libkicad.dylib",
+                   samples.make_macho("arm64", install_id="@rpath/libkicad.dylib"))
+        self.write(self.old, "KiCad.app/Contents/Resources/unchanged.txt", b"Same in both.\n")
+        self.write(self.old, "KiCad.app/Contents/Resources/removed.txt", b"Only in the old build.\n")
+        self.write(self.old, "KiCad.app/Contents/Resources/replaced", b"A file, and then a directory.\n")
+        self.write(self.old, "demos/old-demo.kicad_pro", b"{}\n")
+        os.symlink("Versions/Current/Python", os.path.join(self.old, "KiCad.app", "Contents", "Python"))
+
+        shutil.copytree(self.old, self.new, symlinks=True)
+        self.write(self.new, "KiCad.app/Contents/MacOS/kicad",
+                   samples.make_macho("arm64", samples.MH_EXECUTE, dylibs=["@rpath/libkicad.dylib"],
+                                      text=bytes(range(256)) * 64 + b"new code"))
+        self.write(self.new, "KiCad.app/Contents/Resources/added.txt", b"Only in the new build.\n")
+        self.write(self.new, "KiCad.app/Contents/Resources/replaced/inside.txt", b"Now a directory.\n")
+        self.write(self.new, "demos/new-demo.kicad_pro", b"{}\n")
+        os.remove(os.path.join(self.new, "KiCad.app", "Contents", "Resources", "removed.txt"))
+        os.chmod(os.path.join(self.new, "KiCad.app", "Contents", "Resources", "unchanged.txt"), 0o600)
+        os.remove(os.path.join(self.new, "KiCad.app", "Contents", "Python"))
+        os.symlink("Versions/3.9/Python", os.path.join(self.new, "KiCad.app", "Contents", "Python"))
+
+    def write(self, root, relative_path, data):
+        path = os.path.join(root, relative_path)
+        if os.path.isfile(os.path.dirname(path)):
+            os.remove(os.path.dirname(path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return samples.write(path, data)
+
+    def install(self, tree):
+        # What a tester has after copying the DMG's KiCad folder into /Applications
+        installed = os.path.join(self.tmp_dir, "installed")
+        shutil.copytree(tree, installed, symlinks=True, ignore=lambda directory, names: (
+            ["demos"] if directory == tree else []))
+        return installed
+
+    def make_delta(self, base_tree=None):
+        delta_path = os.path.join(self.tmp_dir, "old-to-new.kdelta")
+        report = delta.create_delta(delta.make_manifest(self.old, name="old"), delta.make_manifest(self.new, name="new"),
+                                    self.new, delta_path, base_tree, jobs=2)
+        return delta_path, report
+
+
+class ManifestTest(DeltaTestCase):
+
+    def test_manifest(self):
+        manifest = delta.make_manifest(self.old, jobs=2, name="old")
+        self.assertEqual(sorted(manifest["files"]), [
+            "KiCad.app/Contents/Frameworks/libkicad.dylib",
+            "KiCad.app/Contents/MacOS/kicad",
+            "KiCad.app/Contents/Resources/removed.txt",
+            "KiCad.app/Contents/Resources/replaced",
+            "KiCad.app/Contents/Resources/unchanged.txt",
+        ])
+        self.assertTrue(manifest["files"]["KiCad.app/Contents/MacOS/kicad"]["macho"])
+        self.assertNotIn("macho", manifest["files"]["KiCad.app/Contents/Resources/unchanged.txt"])
+        self.assertEqual(manifest["symlinks"], {"KiCad.app/Contents/Python": "Versions/Current/Python"})
+        self.assertEqual(delta.get_label(manifest), "old")
+
+    def test_demos_are_left_out(self):
+        # package.sh moves them to the top of the DMG, so an installed KiCad doesn't have them
+        manifest = delta.make_manifest(self.new)
+        self.assertFalse([path for path in list(manifest["files"]) + manifest["directories"]
+                          if path.startswith("demos")])
+        self.assertEqual(delta.verify_tree(manifest, self.install(self.new)), ([], []))
+
+    def test_cache(self):
+        cache_path = os.path.join(self.tmp_dir, "hashes.json")
+        manifest = delta.make_manifest(self.old, cache_path=cache_path)
+        with mock.patch.object(delta, "hash_and_identify") as hash_and_identify:
+            self.assertEqual(delta.make_manifest(self.old, cache_path=cache_path), manifest)
+        hash_and_identify.assert_not_called()
+
+
+class ApplyTest(DeltaTestCase):
+
+    def assertMatchesNew(self, tree):
+        self.assertEqual(delta.verify_tree(delta.make_manifest(self.new), tree), ([], []))
+
+    def test_round_trip(self):
+        delta_path, report = self.make_delta()
+        self.assertEqual(report["files"], 3)
+        self.assertEqual(report["patches"], 0)
+        self.assertEqual(report["removed"], 2)
+
+        installed = self.install(self.old)
+        self.assertEqual(delta.apply_delta(delta_path, installed, jobs=2), {"written": 3, "skipped": 0, "removed": 2})
+        self.assertMatchesNew(installed)
+        info, _ = delta.load_delta(delta_path)
+        self.assertEqual(delta.verify_tree(info["manifest"], installed), ([], []))
+        self.assertFalse(os.path.exists(os.path.join(installed, delta.STAGING_DIRNAME)))
+
+    def test_round_trip_with_patches(self):
+        delta_path, report = self.make_delta(base_tree=self.old)
+        self.assertEqual(report["patches"], 1)
+        self.assertEqual(report["files"], 2)
+
+        installed = self.install(self.old)
+        delta.apply_delta(delta_path, installed)
+        self.assertMatchesNew(installed)
+
+    def test_patch_round_trip(self):
+        base_path = os.path.join(self.old, "KiCad.app", "Contents", "MacOS", "kicad")
+        new_path = os.path.join(self.new, "KiCad.app", "Contents", "MacOS", "kicad")
+        patch_path = os.path.join(self.tmp_dir, "patch")
+        with open(new_path, "rb") as f:
+            new = f.read()
+        # Most of the new file is copied from the base
+        self.assertLess(delta.write_patch(base_path, new_path, patch_path), len(new) / 4)
+
+        output_path = os.path.join(self.tmp_dir, "output")
+        with delta.lzma.open(patch_path) as patch, open(output_path, "wb") as output:
+            delta.apply_patch(base_path, patch, output)
+        with open(output_path, "rb") as f:
+            self.assertEqual(f.read(), new)
+
+    def test_resume(self):
+        delta_path, _ = self.make_delta(base_tree=self.old)
+        installed = self.install(self.old)
+        # Interrupted after the new files were moved into place, but before the symlinks were made
+        with mock.patch.object(delta.os, "symlink", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                delta.apply_delta(delta_path, installed)
+        self.assertTrue(delta.verify_tree(delta.make_manifest(self.new), installed)[0])
+        self.assertFalse(os.path.exists(os.path.join(installed, delta.STAGING_DIRNAME)))
+
+        self.assertEqual(delta.apply_delta(delta_path, installed), {"written": 0, "skipped": 3, "removed": 2})
+        self.assertMatchesNew(installed)
+
+    def test_mismatched_base(self):
+        delta_path, _ = self.make_delta(base_tree=self.old)
+        installed = self.install(self.old)
+        self.write(installed, "KiCad.app/Contents/MacOS/kicad", b"Some other build.\n")
+        before = delta.make_manifest(installed)
+        with self.assertRaisesRegex(delta.DeltaError, "KiCad.app/Contents/MacOS/kicad"):
+            delta.apply_delta(delta_path, installed)
+        # Nothing was touched
+        self.assertEqual(delta.make_manifest(installed), before)
+
+    def test_verify_problems(self):
+        installed = self.install(self.new)
+        manifest = delta.make_manifest(self.new)
+        self.write(installed, "KiCad.app/Contents/Resources/added.txt", b"Changed.\n")
+        os.remove(os.path.join(installed, "KiCad.app", "Contents", "Resources", "unchanged.txt"))
+        self.write(installed, "KiCad.app/Contents/Resources/extra.txt", b"Not in the manifest.\n")
+        self.assertEqual(delta.verify_tree(manifest, installed), (
+            ["KiCad.app/Contents/Resources/added.txt is different",
+             "KiCad.app/Contents/Resources/unchanged.txt is missing"],
+            ["KiCad.app/Contents/Resources/extra.txt"]))
+
+
+class PackageTest(DeltaTestCase):
+
+    def test_package(self):
+        base_dir = os.path.join(self.tmp_dir, "delta-base")
+        output_dir = os.path.join(self.tmp_dir, "dmg")
+        self.assertIsNone(delta.package(self.old, base_dir, output_dir, name="old"))
+        # Only the Mach-O files are kept to patch against
+        self.assertEqual(sorted(delta.walk_tree(os.path.join(base_dir, "files"))[0]),
+                         ["KiCad.app/Contents/Frameworks/libkicad.dylib", "KiCad.app/Contents/MacOS/kicad"])
+
+        delta_path = delta.package(self.new, base_dir, output_dir, name="new")
+        self.assertEqual(os.path.basename(delta_path), "kicad-delta-old-to-new.kdelta")
+        self.assertTrue(os.path.exists(os.path.join(output_dir, "kicad-manifest-new.json")))
+        self.assertEqual(delta.load_manifest(os.path.join(base_dir, "manifest.json"))["name"], "new")
+
+        installed = self.install(self.old)
+        delta.apply_delta(delta_path, installed)
+        self.assertEqual(delta.verify_tree(delta.make_manifest(self.new), installed), ([], []))
+
+        # Nothing changed, so there's no delta
+        self.assertIsNone(delta.package(self.new, base_dir, output_dir, name="new"))
+
+
+class CheckPathTest(unittest.TestCase):
+
+    def test_check_path(self):
+        delta.check_path("KiCad.app/Contents/MacOS/kicad")
+        delta.check_path("KiCad.app/Contents/..foo")
+        for path in ("/Applications/KiCad/KiCad.app", "../KiCad", "KiCad.app/../../KiCad", "KiCad.app/Contents/..",
+                     "", "."):
+            with self.assertRaises(delta.DeltaError, msg=path):
+                delta.check_path(path)
+
+    def test_apply_rejects_bad_paths(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            root = os.path.join(tmp_dir, "KiCad")
+            os.makedirs(root)
+            info = {"version": delta.DELTA_VERSION, "base": {"id": "0" * 64, "name": None},
+                    "target": {"id": "1" * 64, "name": None}, "changes": [], "modes": {}, "symlinks": {},
+                    "directories": [], "removed": ["../outside"], "manifest": {}}
+            with open(os.path.join(tmp_dir, "outside"), "w") as f:
+                f.write("Not KiCad's.\n")
+            with mock.patch.object(delta, "load_delta", return_value=(info, {})):
+                with self.assertRaises(delta.DeltaError):
+                    delta.apply_delta("bad.kdelta", root)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, "outside")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+# Tests for kicad-mac-builder/bin/dmgsize.py, against synthetic trees
+
+import math
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import dmgsize
+
+BLOCK_SIZE = 4096
+
+
+class DmgSizeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = os.path.join(tmp_dir.name, "KiCad")
+        os.makedirs(os.path.join(self.root, "KiCad.app", "Contents"))
+
+    def write(self, relative_path, size):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+
+class MeasureTest(DmgSizeTestCase):
+
+    def test_files_are_rounded_up_to_blocks(self):
+        self.write("KiCad.app/Contents/a", 1)
+        self.write("KiCad.app/Contents/b", BLOCK_SIZE)
+        self.write("KiCad.app/Contents/c", BLOCK_SIZE + 1)
+        # The root, KiCad.app, Contents and three files
+        self.assertEqual(dmgsize.measure([self.root], BLOCK_SIZE), (4 * BLOCK_SIZE, 6))
+
+    def test_empty_files_take_no_blocks(self):
+        self.write("empty", 0)
+        self.assertEqual(dmgsize.measure([self.root], BLOCK_SIZE), (0, 4))
+
+    def test_symlinks_take_a_block_and_are_not_followed(self):
+        self.write("big", 10 * BLOCK_SIZE)
+        os.symlink("big", os.path.join(self.root, "link"))
+        os.symlink("KiCad.app", os.path.join(self.root, "app-link"))
+        self.assertEqual(dmgsize.measure([self.root], BLOCK_SIZE), (12 * BLOCK_SIZE, 6))
+
+    def test_hardlinks(self):
+        path = self.write("a", 3 * BLOCK_SIZE)
+        os.link(path, os.path.join(self.root, "b"))
+        # rsync -a makes a copy of each link
+        self.assertEqual(dmgsize.measure([self.root], BLOCK_SIZE), (6 * BLOCK_SIZE, 5))
+        # rsync -H keeps them linked, but each is still a catalog entry
+        self.assertEqual(dmgsize.measure([self.root], BLOCK_SIZE, count_hardlinks_once=True), (3 * BLOCK_SIZE, 5))
+
+    def test_several_paths(self):
+        path = self.write("a", 1)
+        self.assertEqual(dmgsize.measure([path, os.path.join(self.root, "KiCad.app")], BLOCK_SIZE),
+                         (BLOCK_SIZE, 3))
+
+
+class EstimateTest(DmgSizeTestCase):
+
+    def test_estimate(self):
+        for i in range(10):
+            self.write("KiCad.app/Contents/{}".format(i), 100 * 1024)
+        for filesystem, settings in dmgsize.FILESYSTEMS.items():
+            details = dmgsize.estimate([self.root], filesystem, headroom=0.1)
+            self.assertEqual(details["data_bytes"], 10 * 100 * 1024)
+            self.assertEqual(details["entries"], 13)
+            self.assertEqual(details["metadata_bytes"], 13 * settings["entry_overhead"])
+            self.assertEqual(details["size"] % BLOCK_SIZE, 0)
+
+            # Everything, plus the headroom, fits
+            content = details["data_bytes"] + details["metadata_bytes"]
+            needed = (content + details["filesystem_overhead_bytes"]) * 1.1
+            self.assertGreaterEqual(details["size"], needed)
+            self.assertLess(details["size"], needed + BLOCK_SIZE)
+
+    def test_the_overhead_settles(self):
+        # The journal and bitmap depend on the volume size, so check the overhead is the one for the final size
+        self.write("big", 200 * 1024 ** 2)
+        details = dmgsize.estimate([self.root], "hfs+", headroom=0)
+        self.assertEqual(details["filesystem_overhead_bytes"],
+                         dmgsize.get_filesystem_overhead("hfs+", details["size"]))
+
+    def test_headroom(self):
+        self.write("a", 10 * 1024 ** 2)
+        without = dmgsize.estimate([self.root], headroom=0)["size"]
+        with_headroom = dmgsize.estimate([self.root], headroom=0.5)["size"]
+        self.assertAlmostEqual(with_headroom / without, 1.5, places=2)
+
+
+class FormatSizeTest(unittest.TestCase):
+
+    def test_format_size(self):
+        size = 3 * 1024 ** 2 + 512
+        self.assertEqual(dmgsize.format_size(size, "bytes"), str(size))
+        self.assertEqual(dmgsize.format_size(size, "sectors"), str(size // 512))
+        self.assertEqual(dmgsize.format_size(size, "dmgbuild"), "{}k".format(math.ceil(size / 1024)))
+        self.assertEqual(dmgsize.format_size(2048, "dmgbuild"), "2k")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# Tests for kicad-mac-builder/bin/install-docs.py, with a small docs tarball
+
+import importlib
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+install_docs = importlib.import_module("install-docs")
+
+HELP = "kicad-doc-HEAD/share/doc/kicad/help/"
+
+
+class InstallDocsTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.tarball = os.path.join(self.tmp_dir, "kicad-doc-HEAD.tar.gz")
+        self.destination = os.path.join(self.tmp_dir, "KiCad.app", "Contents", "SharedSupport", "help")
+        os.makedirs(os.path.dirname(self.destination))
+
+    def make_tarball(self, files=(), symlinks=()):
+        with tarfile.open(self.tarball, "w:gz") as tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+            for name, linkname in symlinks:
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+
+    def test_install(self):
+        self.make_tarball(files=[(HELP + "en/kicad.html", b"<html></html>\n"),
+                                 (HELP + "en/kicad.pdf", b"%PDF\n"),
+                                 (HELP + "en/images/icon.png", b"PNG\n"),
+                                 ("kicad-doc-HEAD/share/doc/kicad/README", b"Not help.\n")])
+        self.assertTrue(install_docs.install_docs(self.tarball, self.destination))
+        installed = sorted(os.path.relpath(os.path.join(root, name), self.destination)
+                           for root, dirnames, filenames in os.walk(self.destination) for name in filenames)
+        self.assertEqual(installed, ["en/images/icon.png", "en/kicad.html"])
+
+        # The same tarball isn't installed again, even when it's downloaded again
+        self.assertFalse(install_docs.install_docs(self.tarball, self.destination))
+        os.utime(self.tarball)
+        self.assertFalse(install_docs.install_docs(self.tarball, self.destination))
+
+    def test_links_outside_the_help_are_skipped(self):
+        self.make_tarball(files=[(HELP + "en/kicad.html", b"<html></html>\n")],
+                          symlinks=[(HELP + "en/index.html", "kicad.html"),
+                                    (HELP + "fr", "en"),
+                                    (HELP + "en/absolute", "/etc/passwd"),
+                                    (HELP + "en/relative", "../../../../Frameworks/Python.framework"),
+                                    (HELP + "en/climbs-back", "../../help/en/kicad.html"),
+                                    (HELP + "sneaky", "fr/../../help")])
+        with mock.patch.object(install_docs.logging, "warning") as warning:
+            install_docs.install_docs(self.tarball, self.destination)
+        self.assertEqual(os.readlink(os.path.join(self.destination, "en", "index.html")), "kicad.html")
+        self.assertEqual(os.readlink(os.path.join(self.destination, "fr")), "en")
+        for name in ("en/absolute", "en/relative", "en/climbs-back", "sneaky"):
+            self.assertFalse(os.path.lexists(os.path.join(self.destination, name)), name)
+        self.assertEqual(warning.call_count, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+# Tests for kicad-mac-builder/bin/libindex.py, against a few small symbol and footprint libraries
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import libindex
+
+SYMBOLS = rb'''(kicad_symbol_lib (version 20231120) (generator "kicad_symbol_editor")
+  (symbol "R" (pin_numbers hide) (in_bom yes) (on_board yes)
+    (property "Reference" "R" (at 2.032 0 90) (effects (font (size 1.27 1.27))))
+    (property "Description" "Resistor, \"US\" :) or (EU" (at 0 0 0) (effects (font (size 1.27 1.27)) hide))
+    (property "ki_keywords" "R res resistor" (at 0 0 0) (effects (font (size 1.27 1.27)) hide))
+    (symbol "R_0_1"
+      (rectangle (start -1.016 -2.54) (end 1.016 2.54) (stroke (width 0.254) (type default)) (fill (type none)))
+    )
+    (symbol "R_1_1"
+      (pin passive line (at 0 3.81 270) (length 1.27) (name "~" (effects (font (size 1.27 1.27))))
+        (number "1" (effects (font (size 1.27 1.27)))))
+      (pin passive line (at 0 -3.81 90) (length 1.27) (name "~" (effects (font (size 1.27 1.27))))
+        (number "2" (effects (font (size 1.27 1.27)))))
+    )
+  )
+  (symbol "R_Small" (extends "R")
+    (property "Reference" "R" (at 0.762 0.508 0) (effects (font (size 1.27 1.27)) (justify left)))
+    (property "ki_keywords" "small" (at 0 0 0) (effects (font (size 1.27 1.27)) hide))
+  )
+  (symbol "R_Tiny" (extends "R_Small")
+    (property "Description" "Tiny resistor" (at 0 0 0) (effects (font (size 1.27 1.27)) hide))
+  )
+)
+'''
+
+FOOTPRINT = rb'''(footprint "R_0603_1608Metric" (version 20240108) (generator "pcbnew")
+  (layer "F.Cu")
+  (descr "Resistor SMD 0603 (1608 Metric), \"square\" (rectangular) end terminal")
+  (tags "resistor")
+  (fp_text reference "REF**" (at 0 -1.43 0) (layer "F.SilkS") (effects (font (size 1 1) (thickness 0.15))))
+  (pad "1" smd roundrect (at -0.825 0) (size 0.8 0.95) (layers "F.Cu" "F.Paste" "F.Mask"))
+  (pad "2" smd roundrect (at 0.825 0) (size 0.8 0.95) (layers "F.Cu" "F.Paste" "F.Mask"))
+  (pad "2" thru_hole circle (at 1.5 0) (size 0.5 0.5) (drill 0.3) (layers "*.Cu"))
+  (pad "" np_thru_hole circle (at 0 1.5) (size 1 1) (drill 1) (layers "*.Cu" "*.Mask"))
+  (pad "MH" np_thru_hole circle (at 0 -1.5) (size 1 1) (drill 1) (layers "*.Cu" "*.Mask"))
+)
+'''
+
+
+class LibraryIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = os.path.join(tmp_dir.name, "SharedSupport")
+        self.write("symbols/Device.kicad_sym", SYMBOLS)
+        self.write("footprints/Resistor_SMD.pretty/R_0603_1608Metric.kicad_mod", FOOTPRINT)
+        # Not in a .pretty directory, so not a footprint library
+        self.write("footprints/README.kicad_mod", FOOTPRINT)
+        self.index_path = os.path.join(tmp_dir.name, "library-index.bin")
+
+    def write(self, relative_path, data):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+class ParseTest(LibraryIndexTestCase):
+
+    def test_strings(self):
+        # The parentheses in the strings aren't lists, and the escaped quotes don't end them
+        lists = [(head, atoms) for head, atoms, start, end, parents in libindex.iter_lists(
+            b'(a "x (y" (b "\\"(\\"" c) (d ")") "e)")', {b"a", b"b", b"d"})]
+        self.assertEqual(lists, [(b"b", [b'"("', b"c"]), (b"d", [b")"]), (b"a", [b"x (y"])])
+
+        for data in (b'(a (b "(")', b'(a ")"))'):
+            with self.assertRaises(libindex.LibraryIndexError, msg=data):
+                list(libindex.iter_lists(data, {b"a"}))
+
+    def test_symbols(self):
+        records = libindex.parse_symbol_library(SYMBOLS, "Device", "symbols/Device.kicad_sym")
+        self.assertEqual([record[:6] for record in records], [
+            (libindex.SYMBOL, "Device", "R", "R res resistor", 'Resistor, "US" :) or (EU', 2),
+            # Derived symbols get what they don't have from the symbols they extend
+            (libindex.SYMBOL, "Device", "R_Small", "small", 'Resistor, "US" :) or (EU', 2),
+            (libindex.SYMBOL, "Device", "R_Tiny", "small", "Tiny resistor", 2),
+        ])
+        offset, length = records[1][7:]
+        self.assertTrue(SYMBOLS[offset:offset + length].startswith(b'(symbol "R_Small"'))
+        self.assertTrue(SYMBOLS[offset:offset + length].endswith(b")"))
+
+    def test_footprint(self):
+        record = libindex.parse_footprint(FOOTPRINT, "Resistor_SMD", "R_0603_1608Metric",
+                                          "footprints/Resistor_SMD.pretty/R_0603_1608Metric.kicad_mod")
+        # The mounting holes don't count, and neither does the second pad 2
+        self.assertEqual(record[:6], (libindex.FOOTPRINT, "Resistor_SMD", "R_0603_1608Metric", "resistor",
+                                      'Resistor SMD 0603 (1608 Metric), "square" (rectangular) end terminal', 2))
+        self.assertEqual(record[7:], (0, len(FOOTPRINT.rstrip())))
+
+    def test_failures(self):
+        self.write("symbols/Broken.kicad_sym", b'(kicad_symbol_lib (symbol "R"')
+        self.write("symbols/Empty.kicad_sym", b"")
+        records, failures, report = libindex.parse_libraries(self.root, jobs=1)
+        self.assertEqual(sorted(failures), ["symbols/Broken.kicad_sym", "symbols/Empty.kicad_sym"])
+        self.assertEqual((report["files"], report["symbols"], report["footprints"], report["failures"]), (4, 3, 1, 2))
+
+
+class IndexTest(LibraryIndexTestCase):
+
+    def setUp(self):
+        super().setUp()
+        report = libindex.build(self.root, self.index_path, jobs=2)
+        self.assertEqual((report["symbols"], report["footprints"], report["failures"]), (3, 1, 0))
+        self.index = libindex.LibraryIndex(self.index_path)
+        self.addCleanup(self.index.close)
+
+    def names(self, entries):
+        return [entry["name"] for entry in entries]
+
+    def test_entries(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.names(self.index), ["R", "R_Small", "R_Tiny", "R_0603_1608Metric"])
+        entry = self.index[1]
+        self.assertEqual(entry, {"kind": "symbol", "library": "Device", "name": "R_Small", "keywords": "small",
+                                 "description": 'Resistor, "US" :) or (EU', "count": 2,
+                                 "path": os.path.join("symbols", "Device.kicad_sym"), "offset": entry["offset"],
+                                 "length": entry["length"]})
+        self.assertTrue(self.index.read(entry, self.root).startswith('(symbol "R_Small" (extends "R")'))
+        with self.assertRaises(IndexError):
+            self.index[4]
+
+    def test_lookup(self):
+        self.assertEqual(self.names(self.index.lookup("r_small")), ["R_Small"])
+        self.assertEqual(self.index.lookup("r_0603_1608metric")[0]["count"], 2)
+        self.assertEqual(self.index.lookup("R_0603_1608Metric", kind="symbol"), [])
+        self.assertEqual(self.index.lookup("R_Sm"), [])
+
+    def test_get_postings(self):
+        self.assertEqual(self.index.get_postings("resistor"), {0, 1, 2, 3})
+        self.assertEqual(self.index.get_postings("sma"), {1, 2})
+        self.assertEqual(self.index.get_postings("tiny"), {2})
+        self.assertEqual(self.index.get_postings("zzz"), set())
+
+    def test_search(self):
+        self.assertEqual(self.names(self.index.search("small resist")), ["R_Small", "R_Tiny"])
+        self.assertEqual(self.names(self.index.search("resistor", kind="footprint")), ["R_0603_1608Metric"])
+        # Exact names first, then names that start with the query
+        self.assertEqual(self.names(self.index.search("R")), ["R", "R_0603_1608Metric", "R_Small", "R_Tiny"])
+        self.assertEqual(self.names(self.index.search("R", limit=2)), ["R", "R_0603_1608Metric"])
+        self.assertEqual(self.index.search("resistor capacitor"), [])
+        self.assertEqual(self.index.search("()"), [])
+
+    def test_not_an_index(self):
+        with open(self.index_path, "r+b") as f:
+            f.write(b"NOPE")
+        with self.assertRaises(libindex.LibraryIndexError):
+            libindex.LibraryIndex(self.index_path)
+        open(self.index_path, "wb").close()
+        with self.assertRaises(libindex.LibraryIndexError):
+            libindex.LibraryIndex(self.index_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
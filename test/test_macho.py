@@ -0,0 +1,164 @@
+# Tests for kicad-mac-builder/bin/macho.py, against the sample files in test/data/macho
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import macho
+import samples
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "macho")
+
+
+def sample(name):
+    return os.path.join(SAMPLES_DIR, name)
+
+
+class SamplesTest(unittest.TestCase):
+
+    def test_checked_in_samples_are_up_to_date(self):
+        # If this fails, run test/samples.py to write them again
+        for name, make in samples.CHECKED_IN_SAMPLES.items():
+            with open(sample(name), "rb") as f:
+                self.assertEqual(f.read(), make(), name)
+
+
+class ParseMachOTest(unittest.TestCase):
+
+    def test_thin_dylib(self):
+        parsed = macho.read_macho(sample("libfoo.dylib"))
+        self.assertFalse(parsed["fat"])
+        [macho_slice] = parsed["slices"]
+        self.assertEqual(macho_slice["arch"], "arm64")
+        self.assertEqual(macho_slice["filetype"], "dylib")
+        self.assertEqual(macho_slice["id"], "/Users/kicad/build/kicad-dest/lib/libfoo.1.dylib")
+        self.assertEqual(macho_slice["dylibs"], ["/usr/lib/libSystem.B.dylib", "@rpath/libbar.dylib",
+                                                 "/opt/homebrew/opt/gettext/lib/libintl.8.dylib"])
+        self.assertEqual(macho_slice["rpaths"], ["@loader_path/../Frameworks"])
+        self.assertFalse(macho_slice["signed"])
+        self.assertEqual(macho_slice["size"], os.path.getsize(sample("libfoo.dylib")))
+
+    def test_signed_executable(self):
+        summary = macho.summarize(macho.read_macho(sample("kicad")))
+        self.assertEqual(summary["archs"], ["x86_64"])
+        self.assertEqual(summary["filetype"], "execute")
+        self.assertTrue(summary["signed"])
+        self.assertIsNone(summary["id"])
+        self.assertEqual(summary["rpaths"], ["@executable_path/../Frameworks"])
+
+    def test_fat_dylib(self):
+        summary = macho.summarize(macho.read_macho(sample("libbar.dylib")))
+        self.assertTrue(summary["fat"])
+        self.assertEqual(summary["archs"], ["x86_64", "arm64"])
+        self.assertEqual(summary["id"], "@rpath/libbar.dylib")
+        self.assertEqual(summary["dylibs"], ["/usr/lib/libSystem.B.dylib"])
+
+    def test_first_section_offset(self):
+        with open(sample("libfoo.dylib"), "rb") as f:
+            header = macho.read_load_commands(f, 0)
+        self.assertEqual(macho.get_first_section_offset(header), 32 + header["sizeofcmds"] + 256)
+
+    def test_not_macho(self):
+        self.assertIsNone(macho.read_macho(sample("Foo.class")))
+        self.assertIsNone(macho.read_macho(sample("README.txt")))
+        self.assertIsNone(macho.read_macho(sample("libstatic.a")))
+
+    def test_truncated(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(sample("libfoo.dylib"), "rb") as f:
+                path = samples.write(os.path.join(tmp_dir, "truncated.dylib"), f.read()[:100])
+            with self.assertRaises(macho.MachOError):
+                macho.read_macho(path)
+
+
+class WriteFatTest(unittest.TestCase):
+
+    def test_matches_lipo_layout(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "libbar.dylib")
+            # Given in the other order, to check arm64 still ends up last
+            macho.write_fat(output_path, [sample("libbar-arm64.dylib"), sample("libbar-x86_64.dylib")])
+            with open(output_path, "rb") as f, open(sample("libbar.dylib"), "rb") as expected:
+                self.assertEqual(f.read(), expected.read())
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = os.path.join(tmp_dir.name, "KiCad.app")
+        shutil.copytree(SAMPLES_DIR, os.path.join(self.root, "Contents", "Frameworks"))
+        os.symlink("libbar.dylib", os.path.join(self.root, "Contents", "Frameworks", "libbar.1.dylib"))
+        with open(sample("kicad"), "rb") as f:
+            samples.write(os.path.join(self.root, "truncated"), f.read()[:64])
+
+    def test_build_index(self):
+        index = macho.build_index(self.root, jobs=2)
+        self.assertEqual(index["version"], macho.INDEX_VERSION)
+        self.assertEqual(sorted(index["files"]), [
+            "Contents/Frameworks/kicad",
+            "Contents/Frameworks/libbar-arm64.dylib",
+            "Contents/Frameworks/libbar-x86_64.dylib",
+            "Contents/Frameworks/libbar.dylib",
+            "Contents/Frameworks/libfoo.dylib",
+            "truncated",
+        ])
+        self.assertIn("error", index["files"]["truncated"])
+        self.assertEqual(index["files"]["Contents/Frameworks/libbar.dylib"]["archs"], ["x86_64", "arm64"])
+
+        index_path = os.path.join(self.root, "..", "index.json")
+        macho.write_index(index, index_path)
+        self.assertEqual(macho.load_index(index_path), index)
+
+    def test_get_bad_references(self):
+        index = macho.build_index(self.root)
+        self.assertEqual(sorted(macho.get_bad_references(index)), [
+            ("Contents/Frameworks/libfoo.dylib", "/Users/kicad/build/kicad-dest/lib/libfoo.1.dylib"),
+            ("Contents/Frameworks/libfoo.dylib", "/opt/homebrew/opt/gettext/lib/libintl.8.dylib"),
+        ])
+        self.assertEqual([path for path, error in macho.get_unreadable_files(index)], ["truncated"])
+
+    def run_main(self, *args):
+        # Returns (exit status, stdout, stderr)
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        parse_args = macho.parse_args
+        with mock.patch.object(macho, "parse_args", lambda: parse_args(list(args))), \
+                mock.patch("sys.stdout", stdout), mock.patch("sys.stderr", stderr):
+            try:
+                macho.main()
+                status = 0
+            except SystemExit as e:
+                status = e.code
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_unreadable_files_fail_the_checks(self):
+        # Like verify-app.sh does it, with a bundle whose references are all fine but for a damaged file
+        os.remove(os.path.join(self.root, "Contents", "Frameworks", "libfoo.dylib"))
+        index_path = os.path.join(self.root, "..", "index.json")
+        self.assertEqual(self.run_main("index", "--output", index_path, self.root)[0], 0)
+
+        status, stdout, stderr = self.run_main("bad-references", index_path)
+        self.assertEqual(status, 1)
+        self.assertTrue(stdout.startswith("truncated:\n\tcan't be read: "))
+
+        status, stdout, stderr = self.run_main("list", index_path)
+        self.assertEqual(status, 1)
+        self.assertNotIn("truncated", stdout.splitlines())
+        self.assertIn("Contents/Frameworks/kicad", stdout.splitlines())
+        self.assertTrue(stderr.startswith("truncated can't be read: "))
+
+        os.remove(os.path.join(self.root, "truncated"))
+        self.run_main("index", "--output", index_path, self.root)
+        self.assertEqual(self.run_main("bad-references", index_path), (0, "", ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
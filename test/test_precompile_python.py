@@ -0,0 +1,136 @@
+# Tests for kicad-mac-builder/bin/precompile-python.py, against a synthetic Python.framework whose interpreter is the
+# one running the tests
+
+import importlib
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+precompile_python = importlib.import_module("precompile-python")
+
+VERSION = "{}.{}".format(*sys.version_info[:2])
+
+
+class PrecompilePythonTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.framework = os.path.join(tmp_dir.name, "KiCad.app", "Contents", "Frameworks", "Python.framework")
+        self.version_dir = os.path.join(self.framework, "Versions", VERSION)
+        self.scripting = os.path.join(tmp_dir.name, "KiCad.app", "Contents", "SharedSupport", "scripting")
+        stdlib = "lib/python{}/".format(VERSION)
+
+        self.write("bin/idle3", "")
+        self.write(stdlib + "os.py", "sep = '/'\n")
+        self.write(stdlib + "json/__init__.py", "from .decoder import *\n")
+        self.write(stdlib + "json/decoder.py", "def loads(s):\n    return s\n")
+        self.write(stdlib + "json/tests/test_decode.py", "import json\n")
+        self.write(stdlib + "idlelib/idle.py", "import tkinter\n")
+        self.write(stdlib + "test/test_os.py", "import os\n")
+        self.write(stdlib + "unittest/test/test_case.py", "import unittest\n")
+        self.write(stdlib + "tkinter/test/test_widgets.py", "import tkinter\n")
+        self.write(stdlib + "turtledemo/clock.py", "import turtle\n")
+        self.write(stdlib + "lib2to3/tests/data/py2_test_grammar.py", "print 'Python 2'\n")
+        self.write("share/doc/python{}/examples/Tools/pynche/pynche.py".format(VERSION), "import tkinter\n")
+        # A module whose source was removed after it was compiled
+        self.write(stdlib + "__pycache__/gone.cpython-{}{}.pyc".format(*sys.version_info[:2]), "")
+        os.makedirs(os.path.join(self.version_dir, "bin"), exist_ok=True)
+        os.symlink(sys.executable, os.path.join(self.version_dir, "bin", "python" + VERSION))
+        os.symlink(VERSION, os.path.join(self.framework, "Versions", "Current"))
+
+        os.makedirs(self.scripting)
+        with open(os.path.join(self.scripting, "pcbnew.py"), "w") as f:
+            f.write("def GetBoard():\n    return None\n")
+
+    def write(self, relative_path, text):
+        path = os.path.join(self.version_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def get_files(self):
+        return sorted(os.path.relpath(os.path.join(root, filename), self.version_dir)
+                      for root, dirnames, filenames in os.walk(self.version_dir) for filename in filenames)
+
+    def prepare(self):
+        with self.assertLogs(level="INFO") as logs:
+            precompile_python.prepare(self.framework, [self.scripting],
+                                      precompile_python.DEFAULT_PRUNE_PATTERNS, jobs=2)
+        return [record.getMessage() for record in logs.records]
+
+    def test_prepare(self):
+        self.assertTrue(precompile_python.is_framework_python(self.framework))
+        messages = self.prepare()
+        cache_tag = sys.implementation.cache_tag
+        stdlib = "lib/python{}/".format(VERSION)
+        # The tests, IDLE and the docs are gone, but the code KiCad uses is left, and compiled
+        self.assertEqual(self.get_files(), sorted([
+            "bin/python" + VERSION,
+            stdlib + "os.py",
+            stdlib + "__pycache__/os.{}.pyc".format(cache_tag),
+            stdlib + "json/__init__.py",
+            stdlib + "json/__pycache__/__init__.{}.pyc".format(cache_tag),
+            stdlib + "json/decoder.py",
+            stdlib + "json/__pycache__/decoder.{}.pyc".format(cache_tag),
+        ]))
+        self.assertTrue(messages[-1].startswith("Pruned 9 files"), messages)
+        self.assertIn("compiled 4 files, 0 already up to date, 0 failed", messages[-1])
+
+        source_path = os.path.join(self.scripting, "pcbnew.py")
+        pyc_path = importlib.util.cache_from_source(source_path)
+        with open(pyc_path, "rb") as f:
+            header = f.read(16)
+        self.assertEqual(header[:4], importlib.util.MAGIC_NUMBER)
+        self.assertEqual(int.from_bytes(header[4:8], "little"), precompile_python.CHECKED_HASH_FLAGS)
+        self.assertTrue(precompile_python.is_up_to_date(source_path, pyc_path))
+
+        # Nothing needs compiling again, even when the sources were copied and their mtimes changed
+        os.utime(source_path, (0, 0))
+        messages = self.prepare()
+        self.assertIn("Pruned 0 files", messages[-1])
+        self.assertIn("compiled 0 files, 4 already up to date, 0 failed", messages[-1])
+
+        # Only what changed is
+        with open(source_path, "a") as f:
+            f.write("VERSION = 8\n")
+        self.assertFalse(precompile_python.is_up_to_date(source_path, pyc_path))
+        self.assertIn("compiled 1 files, 3 already up to date, 0 failed", self.prepare()[-1])
+        self.assertTrue(precompile_python.is_up_to_date(source_path, pyc_path))
+
+    def test_orphaned_pycs_are_removed(self):
+        self.prepare()
+        source_path = os.path.join(self.scripting, "pcbnew.py")
+        pyc_path = importlib.util.cache_from_source(source_path)
+        os.remove(source_path)
+        self.assertEqual(precompile_python.find_sources([self.scripting]), [])
+        self.assertFalse(os.path.exists(pyc_path))
+        self.assertFalse(precompile_python.is_up_to_date(source_path, pyc_path))
+
+    def test_failures_are_only_warnings(self):
+        with open(os.path.join(self.scripting, "example.py"), "w") as f:
+            f.write("print 'Python 2'\n")
+        messages = self.prepare()
+        self.assertTrue(messages[0].startswith("Unable to compile {}".format(os.path.join(self.scripting,
+                                                                                          "example.py"))))
+        self.assertIn("compiled 4 files, 0 already up to date, 1 failed", messages[-1])
+
+    def test_main_with_the_framework_python(self):
+        args = precompile_python.parse_args(["--no-default-prune", "--prune", "share/doc", "--jobs", "1",
+                                             self.framework, self.scripting])
+        with mock.patch.object(precompile_python, "parse_args", return_value=args), \
+                mock.patch.object(precompile_python.os, "execv") as execv, \
+                mock.patch.object(precompile_python, "prepare") as prepare:
+            precompile_python.main()
+        execv.assert_not_called()
+        prepare.assert_called_once_with(self.framework, [self.scripting], ["share/doc"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
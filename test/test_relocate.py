@@ -0,0 +1,174 @@
+# Tests for kicad-mac-builder/bin/relocate.py, against a synthetic bundle built from the samples
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import macho
+import relocate
+import samples
+
+HOMEBREW_LIBINTL = "/opt/homebrew/opt/gettext/lib/libintl.8.dylib"
+PYTHON_ID = "/Library/Frameworks/Python.framework/Versions/3.9/Python"
+
+
+class RelocateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.app = os.path.join(tmp_dir.name, "KiCad.app")
+
+        # Finds its libraries in Frameworks through its rpath, except for libintl, which still points at Homebrew
+        self.write("Contents/MacOS/kicad",
+                   samples.make_macho("arm64", samples.MH_EXECUTE,
+                                      dylibs=["/usr/lib/libSystem.B.dylib", "@rpath/libfoo.dylib", HOMEBREW_LIBINTL,
+                                              PYTHON_ID],
+                                      rpaths=["@executable_path/../Frameworks"], signed=True))
+        # Still has the install name it was built with, and needs an rpath to find libngspice in Contents/lib
+        self.write("Contents/Frameworks/libfoo.dylib",
+                   samples.make_macho("arm64", install_id="/Users/kicad/build/kicad-dest/lib/libfoo.dylib",
+                                      dylibs=["@rpath/libbar.dylib", "@rpath/libngspice.0.dylib"]))
+        self.write("Contents/Frameworks/libbar.dylib",
+                   samples.make_fat([samples.make_macho(arch, install_id="@rpath/libbar.dylib")
+                                     for arch in ("x86_64", "arm64")]))
+        self.write("Contents/Frameworks/libintl.8.dylib", samples.make_macho("arm64", install_id=HOMEBREW_LIBINTL))
+        self.write("Contents/Frameworks/Python.framework/Versions/3.9/Python",
+                   samples.make_macho("arm64", install_id=PYTHON_ID))
+        self.write("Contents/lib/libngspice.0.dylib", samples.make_macho("arm64", install_id="@rpath/libngspice.0.dylib"))
+        # A plugin that expects libbar next to it, rather than in Frameworks
+        self.write("Contents/PlugIns/sim.so",
+                   samples.make_macho("arm64", 0x8, dylibs=["@loader_path/libbar.dylib"]))
+        self.write("Contents/Resources/readme.txt", b"Not code.\n")
+
+    def write(self, relative_path, data):
+        path = os.path.join(self.app, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return samples.write(path, data)
+
+    def plan(self):
+        return relocate.Planner(macho.build_index(self.app)).plan()
+
+
+class PlannerTest(RelocateTestCase):
+
+    def test_plan(self):
+        plans, unresolved = self.plan()
+        self.assertEqual(unresolved, {})
+        self.assertEqual(plans, {
+            "Contents/Frameworks/Python.framework/Versions/3.9/Python": {
+                "changes": [], "id": "@rpath/Python.framework/Versions/3.9/Python", "add_rpaths": []},
+            "Contents/Frameworks/libfoo.dylib": {
+                "changes": [], "id": "@rpath/libfoo.dylib", "add_rpaths": ["@loader_path/../lib"]},
+            "Contents/Frameworks/libintl.8.dylib": {
+                "changes": [], "id": "@rpath/libintl.8.dylib", "add_rpaths": []},
+            "Contents/MacOS/kicad": {
+                "changes": [(HOMEBREW_LIBINTL, "@loader_path/../Frameworks/libintl.8.dylib"),
+                            (PYTHON_ID, "@loader_path/../Frameworks/Python.framework/Versions/3.9/Python")],
+                "id": None, "add_rpaths": []},
+            "Contents/PlugIns/sim.so": {
+                "changes": [("@loader_path/libbar.dylib", "@loader_path/../Frameworks/libbar.dylib")],
+                "id": None, "add_rpaths": []},
+        })
+
+    def test_unresolved(self):
+        self.write("Contents/PlugIns/sim.so",
+                   samples.make_macho("arm64", 0x8, dylibs=["/opt/local/lib/libmissing.dylib", "@rpath/libgone.dylib"]))
+        plans, unresolved = self.plan()
+        self.assertEqual(unresolved, {"Contents/PlugIns/sim.so": ["/opt/local/lib/libmissing.dylib",
+                                                                  "@rpath/libgone.dylib"]})
+        self.assertNotIn("Contents/PlugIns/sim.so", plans)
+
+    def test_the_copy_in_frameworks_wins(self):
+        self.write("Contents/SharedSupport/plugins/libintl.8.dylib", samples.make_macho("arm64"))
+        plans, _ = self.plan()
+        self.assertEqual(plans["Contents/MacOS/kicad"]["changes"][0],
+                         (HOMEBREW_LIBINTL, "@loader_path/../Frameworks/libintl.8.dylib"))
+
+        # So is wxPython's, but it isn't the one right in Frameworks
+        self.write("Contents/Frameworks/python/site-packages/wx/libintl.8.dylib", samples.make_macho("arm64"))
+        plans, _ = self.plan()
+        self.assertEqual(plans["Contents/MacOS/kicad"]["changes"][0],
+                         (HOMEBREW_LIBINTL, "@loader_path/../Frameworks/libintl.8.dylib"))
+
+        self.write("Contents/SharedSupport/more/libintl.8.dylib", samples.make_macho("arm64"))
+        os.remove(os.path.join(self.app, "Contents", "Frameworks", "libintl.8.dylib"))
+        with self.assertRaises(relocate.RelocationError):
+            self.plan()
+
+
+class InPlaceEditTest(RelocateTestCase):
+
+    def apply(self, data, plan):
+        edits = relocate.get_in_place_edits(data, 0, plan)
+        if edits is None:
+            return None
+        data = bytearray(data)
+        for offset, edit in edits:
+            data[offset:offset + len(edit)] = edit
+        return macho.parse_macho(io.BytesIO(bytes(data)))["slices"][0]
+
+    def test_names_and_rpaths(self):
+        data = samples.make_macho("arm64", install_id="/Users/kicad/lib/libfoo.dylib",
+                                  dylibs=["/usr/lib/libSystem.B.dylib", HOMEBREW_LIBINTL], rpaths=["@loader_path"])
+        edited = self.apply(data, {"changes": [(HOMEBREW_LIBINTL, "@rpath/libintl.8.dylib")],
+                                   "id": "@rpath/libfoo.dylib",
+                                   "add_rpaths": ["@loader_path/../Frameworks", "@loader_path/../lib"]})
+        self.assertEqual(edited["id"], "@rpath/libfoo.dylib")
+        self.assertEqual(edited["dylibs"], ["/usr/lib/libSystem.B.dylib", "@rpath/libintl.8.dylib"])
+        self.assertEqual(edited["rpaths"], ["@loader_path", "@loader_path/../Frameworks", "@loader_path/../lib"])
+
+    def test_code_signature_stays_last(self):
+        data = samples.make_macho("arm64", samples.MH_EXECUTE, signed=True)
+        edits = relocate.get_in_place_edits(data, 0, {"changes": [], "id": None, "add_rpaths": ["@loader_path"]})
+        data = bytearray(data)
+        for offset, edit in edits:
+            data[offset:offset + len(edit)] = edit
+        header = macho.read_load_commands(io.BytesIO(bytes(data)), 0)
+        self.assertEqual([cmd for cmd, offset, command in header["commands"]][-2:],
+                         [macho.LC_RPATH, macho.LC_CODE_SIGNATURE])
+        self.assertTrue(macho.parse_macho(io.BytesIO(bytes(data)))["slices"][0]["signed"])
+
+    def test_no_room(self):
+        # A longer name than the load command has room for
+        data = samples.make_macho("arm64", dylibs=["/a/libz.dylib"])
+        self.assertIsNone(self.apply(data, {"changes": [("/a/libz.dylib", "@loader_path/../Frameworks/libz.dylib")],
+                                            "id": None, "add_rpaths": []}))
+        # No padding after the load commands for a new rpath
+        data = samples.make_macho("arm64", padding=0)
+        self.assertIsNone(self.apply(data, {"changes": [], "id": None, "add_rpaths": ["@loader_path"]}))
+
+    def test_relocate(self):
+        with mock.patch.object(relocate.subprocess, "run") as run:
+            plans = relocate.relocate(self.app, jobs=2)
+        self.assertEqual(len(plans), 5)
+        # The plugin's new name is longer than its load command has room for, so only it needs install_name_tool
+        run.assert_called_once()
+        self.assertEqual(run.call_args[0][0], ["install_name_tool",
+                                               "-change", "@loader_path/libbar.dylib",
+                                               "@loader_path/../Frameworks/libbar.dylib",
+                                               os.path.join(self.app, "Contents", "PlugIns", "sim.so")])
+
+        # Everything else was changed in place
+        index = macho.build_index(self.app)
+        self.assertEqual(macho.get_bad_references(index), [])
+        self.assertEqual(list(relocate.Planner(index).plan()[0]), ["Contents/PlugIns/sim.so"])
+        self.assertEqual(index["files"]["Contents/Frameworks/libbar.dylib"]["archs"], ["x86_64", "arm64"])
+
+    def test_unresolved_references_change_nothing(self):
+        self.write("Contents/PlugIns/sim.so", samples.make_macho("arm64", 0x8, dylibs=["/opt/local/lib/libmissing.dylib"]))
+        with open(os.path.join(self.app, "Contents", "MacOS", "kicad"), "rb") as f:
+            before = f.read()
+        with self.assertRaises(relocate.RelocationError):
+            relocate.relocate(self.app)
+        with open(os.path.join(self.app, "Contents", "MacOS", "kicad"), "rb") as f:
+            self.assertEqual(f.read(), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+# Tests for kicad-mac-builder/bin/stage.py, against small synthetic install directories
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import dedupe
+import stage
+
+
+class StageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.source = os.path.join(tmp_dir.name, "src")
+        self.destination = os.path.join(tmp_dir.name, "dst")
+        self.manifest = os.path.join(tmp_dir.name, "staging", "manifest.json")
+        self.mtime_ns = 1_000_000_000_000_000_000
+
+    def write(self, relative_path, content):
+        # Each write gets a new mtime, like a reinstall would
+        path = os.path.join(self.source, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        self.mtime_ns += 1_000_000_000
+        os.utime(path, ns=(self.mtime_ns, self.mtime_ns))
+
+    def read(self, relative_path):
+        with open(os.path.join(self.destination, relative_path), "rb") as f:
+            return f.read()
+
+    def stage(self, use_links=True):
+        return stage.stage(self.source, self.destination, self.manifest, use_links=use_links)
+
+
+class DedupeInteractionTest(StageTestCase):
+
+    def test_links_to_a_hardlinked_file_rewritten_in_place_are_restaged(self):
+        content = b"x" * 8192
+        self.write("a/x.step", content)
+        self.write("a/y.step", content)
+        self.stage()
+        dedupe.dedupe([os.path.join(self.destination, "a")])
+        self.assertTrue(os.path.islink(os.path.join(self.destination, "a", "y.step")))
+
+        # Same size, so only the mtime gives it away, and the destination is the same inode as the source
+        self.write("a/x.step", b"z" * 8192)
+        self.assertTrue(os.path.samefile(os.path.join(self.source, "a", "x.step"),
+                                         os.path.join(self.destination, "a", "x.step")))
+        self.stage()
+        self.assertEqual(self.read("a/x.step"), b"z" * 8192)
+        self.assertEqual(self.read("a/y.step"), content)
+
+
+class IncrementalStageTest(StageTestCase):
+
+    def test_first_stage(self):
+        self.write("footprints/a.kicad_mod", b"a")
+        self.write("footprints/Lib.pretty/b.kicad_mod", b"b")
+        os.makedirs(self.source, exist_ok=True)
+        os.symlink("footprints", os.path.join(self.source, "link"))
+        counts = self.stage()
+        self.assertEqual((counts["linked"], counts["symlinked"], counts["unchanged"]), (2, 1, 0))
+        self.assertEqual(self.read("footprints/Lib.pretty/b.kicad_mod"), b"b")
+        self.assertEqual(os.readlink(os.path.join(self.destination, "link")), "footprints")
+
+    def test_only_changes_are_staged(self):
+        self.write("a", b"a")
+        self.write("b", b"b")
+        self.write("c", b"c")
+        self.stage(use_links=False)
+
+        self.write("b", b"bb")
+        self.write("d", b"d")
+        counts = self.stage(use_links=False)
+        self.assertEqual((counts["copied"], counts["unchanged"]), (2, 2))
+        self.assertEqual(self.read("b"), b"bb")
+        self.assertEqual(self.read("d"), b"d")
+
+        counts = self.stage(use_links=False)
+        self.assertEqual((counts["copied"], counts["unchanged"]), (0, 4))
+
+    def test_missing_destination_files_are_staged_again(self):
+        self.write("a", b"a")
+        self.stage()
+        os.remove(os.path.join(self.destination, "a"))
+        counts = self.stage()
+        self.assertEqual(counts["linked"], 1)
+        self.assertEqual(self.read("a"), b"a")
+
+    def test_a_manifest_for_another_destination_is_ignored(self):
+        self.write("a", b"a")
+        self.stage()
+        other_destination = self.destination + "-other"
+        counts = stage.stage(self.source, other_destination, self.manifest)
+        self.assertEqual(counts["linked"], 1)
+
+
+class DeleteTest(StageTestCase):
+
+    def test_stale_files_are_deleted(self):
+        self.write("a", b"a")
+        self.write("lib/old/b", b"b")
+        self.stage()
+        os.remove(os.path.join(self.source, "lib", "old", "b"))
+        counts = self.stage()
+        self.assertEqual(counts["deleted"], 1)
+        self.assertFalse(os.path.lexists(os.path.join(self.destination, "lib")))
+        self.assertEqual(self.read("a"), b"a")
+
+    def test_files_from_other_sources_are_kept(self):
+        # Several install directories are staged into SharedSupport, each with its own manifest
+        self.write("a", b"a")
+        self.stage()
+        other = os.path.join(self.destination, "other")
+        os.makedirs(other)
+        with open(os.path.join(other, "b"), "wb") as f:
+            f.write(b"b")
+        os.remove(os.path.join(self.source, "a"))
+        self.stage()
+        self.assertFalse(os.path.lexists(os.path.join(self.destination, "a")))
+        self.assertTrue(os.path.exists(os.path.join(other, "b")))
+
+
+class HashOnTouchTest(StageTestCase):
+
+    def test_touched_but_unchanged_files_are_not_copied(self):
+        self.write("a", b"a" * 100)
+        self.stage(use_links=False)
+        self.write("a", b"a" * 100)
+        with mock.patch.object(stage, "stage_file") as stage_file:
+            counts = self.stage(use_links=False)
+        stage_file.assert_not_called()
+        self.assertEqual(counts["unchanged"], 1)
+
+        # The hash is in the manifest now, so the next touch doesn't need the staged copy
+        self.write("a", b"a" * 100)
+        with mock.patch.object(stage, "hash_file", wraps=stage.hash_file) as hash_file:
+            self.stage(use_links=False)
+        hash_file.assert_called_once_with(os.path.join(self.source, "a"))
+
+    def test_touched_and_changed_files_are_copied(self):
+        self.write("a", b"a" * 100)
+        self.stage(use_links=False)
+        self.write("a", b"b" * 100)
+        counts = self.stage(use_links=False)
+        self.assertEqual(counts["copied"], 1)
+        self.assertEqual(self.read("a"), b"b" * 100)
+
+        self.write("a", b"c" * 100)
+        self.stage(use_links=False)
+        self.assertEqual(self.read("a"), b"c" * 100)
+
+    def test_untouched_files_are_not_hashed(self):
+        self.write("a", b"a")
+        self.stage(use_links=False)
+        with mock.patch.object(stage, "hash_file") as hash_file:
+            self.stage(use_links=False)
+        hash_file.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
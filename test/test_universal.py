@@ -0,0 +1,121 @@
+# Tests for kicad-mac-builder/bin/universal.py and the fat writer in macho.py, against synthetic trees
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kicad-mac-builder", "bin"))
+
+import macho
+import samples
+import universal
+
+
+class WriteFatTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_slices_are_aligned_and_arm64_is_last(self):
+        arm64 = samples.write(self.path("arm64"), samples.make_macho("arm64", install_id="@rpath/libfoo.dylib"))
+        x86_64 = samples.write(self.path("x86_64"), samples.make_macho("x86_64", install_id="@rpath/libfoo.dylib"))
+        macho.write_fat(self.path("fat"), [arm64, x86_64])
+
+        parsed = macho.read_macho(self.path("fat"))
+        self.assertTrue(parsed["fat"])
+        self.assertEqual([s["arch"] for s in parsed["slices"]], ["x86_64", "arm64"])
+        self.assertEqual([s["align"] for s in parsed["slices"]], [12, 14])
+        for macho_slice in parsed["slices"]:
+            self.assertEqual(macho_slice["offset"] % (1 << macho_slice["align"]), 0)
+            self.assertEqual(macho_slice["id"], "@rpath/libfoo.dylib")
+
+        # The slices are the thin files, byte for byte
+        with open(self.path("fat"), "rb") as f:
+            fat = f.read()
+        for macho_slice, path in zip(parsed["slices"], [x86_64, arm64]):
+            with open(path, "rb") as f:
+                self.assertEqual(fat[macho_slice["offset"]:macho_slice["offset"] + macho_slice["size"]], f.read())
+
+    def test_an_architecture_twice_is_an_error(self):
+        arm64 = samples.write(self.path("arm64"), samples.make_macho("arm64"))
+        with self.assertRaises(macho.MachOError):
+            macho.write_fat(self.path("fat"), [arm64, arm64])
+
+    def test_static_libraries(self):
+        arm64 = samples.write(self.path("arm64.a"), samples.make_archive("arm64"))
+        x86_64 = samples.write(self.path("x86_64.a"), samples.make_archive("x86_64"))
+        self.assertIsNone(macho.read_macho(arm64))
+        self.assertEqual(macho.read_macho(arm64, archives=True)["slices"][0]["arch"], "arm64")
+
+        macho.write_fat(self.path("fat.a"), [arm64, x86_64])
+        parsed = macho.read_macho(self.path("fat.a"))
+        self.assertEqual([(s["arch"], s["filetype"]) for s in parsed["slices"]],
+                         [("x86_64", "archive"), ("arm64", "archive")])
+
+    def test_archive_without_objects(self):
+        path = samples.write(self.path("empty.a"), b"!<arch>\n")
+        with self.assertRaises(macho.MachOError):
+            macho.read_macho(path, archives=True)
+
+
+class MergeTreesTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.first = os.path.join(tmp_dir.name, "arm64")
+        self.second = os.path.join(tmp_dir.name, "x86_64")
+        self.output = os.path.join(tmp_dir.name, "universal")
+
+    def write(self, root, relative_path, data):
+        path = os.path.join(root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return samples.write(path, data)
+
+    def test_merge(self):
+        for root, arch in ((self.first, "arm64"), (self.second, "x86_64")):
+            self.write(root, "MacOS/kicad", samples.make_macho(arch, samples.MH_EXECUTE))
+            self.write(root, "lib/libpython3.9.a", samples.make_archive(arch))
+            self.write(root, "Resources/same.txt", b"same")
+            self.write(root, "Resources/version.txt", arch.encode("ascii"))
+            os.symlink("same.txt", os.path.join(root, "Resources", "link"))
+        self.write(self.first, "Resources/only-arm64.txt", b"")
+        self.write(self.second, "lib/only-x86_64.dylib", samples.make_macho("x86_64"))
+        self.write(self.first, "lib/mismatched", samples.make_macho("arm64"))
+        self.write(self.second, "lib/mismatched", b"not Mach-O")
+
+        report = universal.merge_trees(self.first, self.second, self.output)
+        self.assertEqual(report["merged"], ["MacOS/kicad", "lib/libpython3.9.a"])
+        self.assertEqual(report["identical"], 1)
+        self.assertEqual(report["differing"], ["Resources/version.txt"])
+        self.assertEqual(report["mismatched"], ["lib/mismatched"])
+        self.assertEqual(report["only_in_first"], ["Resources/only-arm64.txt"])
+        self.assertEqual(report["only_in_second"], ["lib/only-x86_64.dylib"])
+        self.assertEqual(report["kind_conflicts"], [])
+
+        for relative_path in report["merged"]:
+            parsed = macho.read_macho(os.path.join(self.output, relative_path))
+            self.assertEqual(sorted(s["arch"] for s in parsed["slices"]), ["arm64", "x86_64"])
+        self.assertEqual(os.readlink(os.path.join(self.output, "Resources", "link")), "same.txt")
+        with open(os.path.join(self.output, "Resources", "version.txt")) as f:
+            self.assertEqual(f.read(), "arm64")
+        self.assertTrue(os.path.exists(os.path.join(self.output, "lib", "only-x86_64.dylib")))
+
+    def test_kind_conflicts(self):
+        self.write(self.first, "a/file", b"")
+        self.write(self.second, "a", b"")
+        os.makedirs(self.second, exist_ok=True)
+        os.symlink("x", os.path.join(self.first, "b"))
+        os.symlink("y", os.path.join(self.second, "b"))
+        report = universal.merge_trees(self.first, self.second, self.output)
+        self.assertEqual(report["kind_conflicts"], ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()